@@ -1,7 +1,83 @@
-from flask import Flask
+from flask import Flask, request, abort, jsonify
+import asyncio
+import atexit
+from datetime import datetime, timedelta
+import hmac
+import logging
 import os
+import threading
+import config
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+# Bot application and the event loop it runs on (webhook mode only)
+bot_app = None
+bot_loop = None
+
+# Worker processes the updates are routed to when BOT_WORKERS > 1
+sharded_bot = None
+
+def start_bot():
+    """Run the bot Application on a background event loop and register the webhook"""
+    global bot_app, bot_loop
+    if not config.WEBHOOK_SECRET:
+        # Without it anyone who finds the URL can post fake updates
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+    if config.BOT_WORKERS > 1:
+        return start_sharded_bot()
+    from bot import setup_bot
+    
+    bot_app = setup_bot()
+    bot_loop = asyncio.new_event_loop()
+    threading.Thread(target=bot_loop.run_forever, name="bot-loop", daemon=True).start()
+    run_on_bot_loop(_start_application())
+    atexit.register(stop_bot)
+
+def start_sharded_bot():
+    """Run the bot in worker processes, sharded by user, and register the webhook"""
+    global sharded_bot
+    from telegram import Bot
+    from sharding import ShardedBot
+    
+    sharded_bot = ShardedBot()
+    sharded_bot.start()
+    atexit.register(sharded_bot.stop)
+    
+    async def register():
+        async with Bot(config.BOT_TOKEN) as telegram_bot:
+            await set_webhook(telegram_bot)
+    asyncio.run(register())
+
+def stop_bot():
+    """Stop the Application and its event loop"""
+    run_on_bot_loop(_stop_application())
+    bot_loop.call_soon_threadsafe(bot_loop.stop)
+
+def run_on_bot_loop(coro, timeout=None):
+    """Run a coroutine on the bot's event loop from a Flask thread and wait for it"""
+    return asyncio.run_coroutine_threadsafe(coro, bot_loop).result(timeout)
+
+async def _start_application():
+    await bot_app.initialize()
+    # post_init/post_shutdown are only run automatically by run_polling()
+    if bot_app.post_init:
+        await bot_app.post_init(bot_app)
+    await bot_app.start()
+    await set_webhook(bot_app.bot)
+
+async def set_webhook(telegram_bot):
+    await telegram_bot.set_webhook(
+        url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=['message', 'callback_query']
+    )
+
+async def _stop_application():
+    await bot_app.stop()
+    await bot_app.shutdown()
+    if bot_app.post_shutdown:
+        await bot_app.post_shutdown(bot_app)
 
 @app.route('/')
 def home():
@@ -11,6 +87,91 @@ def home():
 def health():
     return "OK", 200
 
+@app.route('/metrics')
+def metrics():
+    """Expose bot metrics in the Prometheus text format"""
+    import metrics as bot_metrics
+    # In multi-worker mode the handlers run in the workers, so add up theirs
+    snapshots = sharded_bot.collect_metrics() if sharded_bot else []
+    return bot_metrics.render(snapshots), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/stats')
+def stats():
+    """Dispatch totals from the order rollup as JSON (?days=N, default today)"""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not config.STATS_TOKEN or not hmac.compare_digest(token, config.STATS_TOKEN):
+        abort(403)
+    
+    days = request.args.get('days', 1, type=int)
+    if days < 1:
+        abort(400)
+    end_day = datetime.now().date()
+    start_day = end_day - timedelta(days=days - 1)
+    rows = query_database('get_order_rollup', start_day.isoformat(), end_day.isoformat())
+    if rows is None:
+        abort(503)
+    
+    from utils import summarize_rollup
+    totals = summarize_rollup(rows, ())
+    return jsonify({
+        'from': start_day.isoformat(),
+        'to': end_day.isoformat(),
+        'totals': totals[0] if totals else {'orders': 0, 'items': 0, 'revenue': 0.0},
+        'by_channel': summarize_rollup(rows, ('channel', 'meal_slot')),
+        'by_cafe': summarize_rollup(rows, ('cafe',)),
+        'rows': rows
+    })
+
+def query_database(method, *args):
+    """Call an AsyncDatabase method from a Flask thread"""
+    if bot_loop is not None:
+        # Share the bot's client and cache, which live on its loop
+        from bot import db
+        return run_on_bot_loop(getattr(db, method)(*args), timeout=config.DB_TIMEOUT * 2)
+    
+    from database import AsyncDatabase
+    
+    async def call():
+        database = AsyncDatabase()
+        try:
+            return await getattr(database, method)(*args)
+        finally:
+            await database.close()
+    return asyncio.run(call())
+
+@app.route(config.WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Receive an update from Telegram and queue it into the Application"""
+    if bot_app is None and sharded_bot is None:
+        abort(503)
+    
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not config.WEBHOOK_SECRET or not hmac.compare_digest(secret, config.WEBHOOK_SECRET):
+        abort(403)
+    
+    if sharded_bot:
+        sharded_bot.route(request.get_json(force=True))
+        return "OK", 200
+    
+    from telegram import Update
+    update = Update.de_json(request.get_json(force=True), bot_app.bot)
+    # Acknowledge once queued; the Application processes the queue on its own loop.
+    # Otherwise answer 503 so Telegram retries the update later rather than it being lost
+    if not bot_loop.is_running():
+        logger.error("Bot loop is not running", extra={'update_id': update.update_id})
+        abort(503)
+    future = asyncio.run_coroutine_threadsafe(bot_app.update_queue.put(update), bot_loop)
+    try:
+        future.result(config.WEBHOOK_QUEUE_TIMEOUT)
+    except Exception as e:
+        future.cancel()
+        logger.error("Could not queue update", extra={'update_id': update.update_id, 'error': repr(e)})
+        abort(503)
+    return "OK", 200
+
+if config.WEBHOOK_URL:
+    start_bot()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
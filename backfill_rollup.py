@@ -0,0 +1,22 @@
+# === ORDER ROLLUP BACKFILL (run with: python backfill_rollup.py [YYYY-MM-DD]) ===
+# Recomputes order_rollup from the orders table, for every day or from the given
+# date on. Safe to run while the bot takes orders; place_order waits for it.
+import asyncio
+import sys
+
+from database import AsyncDatabase
+
+
+async def main(since=None):
+    db = AsyncDatabase()
+    try:
+        rows = await db.rebuild_order_rollup(since)
+    finally:
+        await db.close()
+    if rows is None:
+        sys.exit("Rollup rebuild failed")
+    print(f"Rebuilt order_rollup from {since or 'the first order'}: {rows} rows")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,462 @@
+# === BENCHMARKS (run with: python benchmark.py) ===
+import asyncio
+import time
+import tracemalloc
+
+from database import Database, AsyncDatabase
+from menu import MenuCatalog
+from utils import extract_numbers_from_text
+
+LATENCY = 0.02  # Simulated Supabase round-trip in seconds
+CONCURRENT_UPDATES = 200
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+# RPCs that return a scalar rather than rows
+RPC_RESULTS = {'user_balance': 100.0, 'set_balance': 100.0, 'snapshot_balances': 0}
+
+
+class FakeQuery:
+    """Stand-in for a PostgREST query builder that sleeps instead of calling the network"""
+
+    def __init__(self, latency: float, asynchronous: bool, data=None):
+        self.latency = latency
+        self.asynchronous = asynchronous
+        self.data = [{'balance': 100.0, 'order_number': 1000}] if data is None else data
+
+    def __getattr__(self, name):
+        # select/eq/update/insert/order/limit all just return the builder
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        if self.asynchronous:
+            return self._execute_async()
+        time.sleep(self.latency)
+        return FakeResponse(self.data)
+
+    async def _execute_async(self):
+        await asyncio.sleep(self.latency)
+        return FakeResponse(self.data)
+
+
+class FakeClient:
+    def __init__(self, latency: float = LATENCY, asynchronous: bool = False):
+        self.latency = latency
+        self.asynchronous = asynchronous
+
+    def table(self, name):
+        return FakeQuery(self.latency, self.asynchronous)
+
+    def rpc(self, name, params=None):
+        return FakeQuery(self.latency, self.asynchronous, RPC_RESULTS.get(name))
+
+    @property
+    def postgrest(self):
+        # AsyncDatabase.close() closes the connection pool through client.postgrest
+        return self
+
+    async def aclose(self):
+        pass
+
+
+async def bench_concurrent_updates():
+    """Concurrent balance updates through the sync and async data layers"""
+    sync_db = Database(FakeClient())
+    async_db = AsyncDatabase(FakeClient(asynchronous=True))
+
+    async def sync_handler(i):
+        # What the handlers used to do: a blocking call inside a coroutine
+        sync_db.update_user_balance(i, 50.0)
+
+    async def async_handler(i):
+        await async_db.update_user_balance(i, 50.0)
+
+    for label, handler in (("sync Database", sync_handler), ("AsyncDatabase", async_handler)):
+        started = time.perf_counter()
+        await asyncio.gather(*(handler(i) for i in range(CONCURRENT_UPDATES)))
+        elapsed = time.perf_counter() - started
+        print(f"{label:>16}: {CONCURRENT_UPDATES} updates in {elapsed:.2f}s "
+              f"({CONCURRENT_UPDATES / elapsed:.0f} updates/s)")
+
+
+async def bench_confirm_latency():
+    """Round-trips on the confirm path: read-modify-write vs the place_order RPC"""
+    db = AsyncDatabase(FakeClient(asynchronous=True))
+    order = {'user_telegram_id': 1, 'total_price': 13.3, 'order_number': 1000}
+
+    async def read_modify_write():
+        balance = await db.get_user_balance(1)
+        await db.update_user_balance(1, balance - order['total_price'])
+        await db.create_order(order)
+
+    async def single_rpc():
+        await db.place_order(order)
+
+    for label, confirm in (("balance+update+insert", read_modify_write), ("place_order RPC", single_rpc)):
+        started = time.perf_counter()
+        for _ in range(20):
+            await confirm()
+        elapsed = (time.perf_counter() - started) / 20
+        print(f"{label:>22}: {elapsed * 1000:.1f} ms per confirm")
+
+
+MENU = [
+    ('ሽሮ', ['shiro'], 45), ('ሽሮ ፍርፍር', ['shiro firfir'], 55), ('ፓስታ', ['pasta'], 50),
+    ('ፓስታ በስጋ', ['pasta with meat'], 80), ('ፍርፍር', ['firfir'], 50), ('እንቁላል', ['enkulal', 'egg'], 60),
+    ('አትክልት', ['atkilt', 'vegetable'], 40), ('ጥብስ', ['tibs'], 120), ('ምስር', ['misir', 'ምስር ወጥ'], 45),
+    ('በየአይነት', ['beyaynetu', 'አይነት'], 70), ('ሩዝ', ['rice'], 50), ('ጎመን', ['gomen'], 40),
+    ('ሻይ', ['tea'], 10), ('ቡና', ['coffee', 'buna'], 15), ('ጁስ', ['juice'], 35),
+]
+ORDERS = [
+    "2 ሽሮ እና 1 ፓስታ", "1 አይነት እና 1አትክልት", "shiro 2, pasta x1 and a tea", "3 በየአይነት",
+    "ፍርፍር 2 እና ሻይ", "1 ፓስታ በስጋ 2 ጁስ", "ምስር ወጥ 1 ሩዝ 1 ጎመን 1", "Tibs x2, coffee 2",
+]
+
+
+def bench_menu_parse():
+    """Parsing the food field with the menu matcher vs the old digit regex"""
+    catalog = MenuCatalog()
+    catalog.build({'cafe': cafe, 'name': name, 'aliases': aliases, 'price': price}
+                  for cafe in ('ሸዊት', 'ፍቄ', 'አስኳል', 'መሲ', 'ኤ.ኤም', 'ሻሽ') for name, aliases, price in MENU)
+    rounds = 20000
+    for label, parse in (("digit regex", extract_numbers_from_text), ("menu matcher", lambda text: catalog.price('ሸዊት', text))):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for order in ORDERS:
+                parse(order)
+        elapsed = time.perf_counter() - started
+        print(f"{label:>16}: {elapsed / (rounds * len(ORDERS)) * 1e6:.1f} µs per order")
+    for order in ORDERS[:3]:
+        print(f"{'':>16}  {order!r} -> {catalog.parse('ሸዊት', order)}")
+
+
+def bench_render():
+    """Per-update keyboard/text rendering: rebuilt every time vs prebuilt in cafes.py"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from cafes import CafeRegistry, CONFIRM_KEYBOARD, ORDER_NOW_KEYBOARD, ordering_page_text
+
+    registry = CafeRegistry()
+
+    def rebuilt():
+        InlineKeyboardMarkup([[InlineKeyboardButton(cafe, callback_data=cafe)] for cafe in registry.cafes]
+                             + [[InlineKeyboardButton("የካፌውን ሰም ያስገቡ", callback_data="custom_cafe_input")]])
+        InlineKeyboardMarkup([[InlineKeyboardButton("እዘዝ/Order now", callback_data="order_now")]])
+        InlineKeyboardMarkup([[InlineKeyboardButton("✅አረጋግጥ", callback_data="confirm_order"),
+                               InlineKeyboardButton("እንደገና ያስገቡ", callback_data="restart_order")]])
+        f"🍝የ **{'ሸዊት'}** ምግብ ቤት          ሜኑ ለማየት የስረኛውን ሊንክ ይጫኑ!!⬇️⬇️⬇️\n\n"
+
+    def prebuilt():
+        registry.keyboard
+        ORDER_NOW_KEYBOARD
+        CONFIRM_KEYBOARD
+        ordering_page_text('ሸዊት')
+
+    rounds = 5000
+    for label, render in (("rebuilt", rebuilt), ("prebuilt", prebuilt)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            render()
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        peak_bytes = 0
+        for _ in range(100):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            render()
+            peak_bytes += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+        print(f"{label:>16}: {elapsed / rounds * 1e6:.1f} µs, {peak_bytes / 100:.0f} B peak allocation per render")
+
+
+def bench_sharding(users: int = 400):
+    """Full ordering conversations through 1, 2 and 4 sharded worker processes"""
+    import functools
+    import os
+    import loadtest
+    from sharding import ShardedBot
+
+    flows = []
+    for i in range(users):
+        customer = loadtest.Customer(loadtest.user_id_for(i))
+        flows.append(customer.conversation() + [customer.press('confirm_order')])
+    # Interleave users the way they arrive at peak: everyone's step 1, then step 2, ...
+    updates = [flow[step] for step in range(len(flows[0])) for flow in flows]
+
+    print(f"{'':>16}  ({len(updates)} updates, {os.cpu_count()} CPUs)")
+    for workers in (1, 2, 4):
+        sharded = ShardedBot(workers, factory=functools.partial(loadtest.create_application, 0.0, 0.0, users))
+        sharded.start()
+        started = time.time()
+        for data in updates:
+            sharded.route(data)
+        finished = sharded.stop()
+        elapsed = max(finished_at for _, finished_at in finished) - started
+        print(f"{workers:>8} workers: {len(updates) / elapsed:.0f} updates/s")
+
+
+# Cold start: a fresh interpreter importing bot.py, then starting the Application the way
+# app.py does and handling one /start. Bot API calls are answered locally; the admin id
+# skips the users lookup, so no Supabase round-trip is timed.
+IMPORT_BUDGET = 0.6  # seconds
+FIRST_UPDATE_BUDGET = 1.0  # seconds, import included
+STARTUP_RUNS = 5
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+
+import asyncio
+import json
+import loadtest
+
+async def first_update():
+    resumed = time.perf_counter()
+    # The Supabase imports still count; only the client's network calls are faked,
+    # as in the other benchmarks, so this runs without a Supabase project
+    import supabase
+    from benchmark import FakeClient
+    bot.db.db._client = FakeClient(0.0, asynchronous=True)
+    application = bot.build_application(request=loadtest.FakeBotAPI())
+    bot.setup_handlers(application)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    await application.process_update(loadtest.Customer(1, application).message('/start'))
+    handled = time.perf_counter()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return handled - resumed
+
+startup = asyncio.run(first_update())
+print(json.dumps({'import': imported - started, 'first_update': imported - started + startup}))
+"""
+
+
+LOG_UPDATES = 5000
+LOG_WRITE_LATENCY = 0.0002  # A stdout pipe or terminal that is slow to drain
+
+
+class SlowStream:
+    """File-like sink whose writes block for a moment, like a congested stdout"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text: str):
+        if self.latency:
+            time.sleep(self.latency)
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def bench_logging():
+    """Logging cost per update on the event-loop thread: synchronous stream handler vs queue + JSON"""
+    import logging
+    import logging.handlers
+    import queue
+    import logs
+
+    def handle_update(logger, i):
+        # What one confirm logs: bound context, a few INFO lines and high-volume DEBUG timings
+        token = logs.bind(user_id=1000 + i, handler='confirm_order', state='CONFIRM_ORDER')
+        logger.debug("Handled update", extra={'duration_ms': 1.5})
+        logger.debug("Database call", extra={'method': 'place_order', 'duration_ms': 20.1})
+        logs.bind(order_number=i)
+        logger.info(f"Placed order #{i}", extra={'cafe': 'ሸዊት', 'channel': 'male_main', 'total_price': 13.3})
+        logger.info("Posted order to male_main")
+        logs.unbind(token)
+
+    for sink_label, latency in (("fast sink", 0.0), ("slow sink", LOG_WRITE_LATENCY)):
+        for label in ("sync text", "queue + JSON"):
+            stream = SlowStream(latency)
+            logger = logging.getLogger(f"bench.{label}.{sink_label}")
+            logger.propagate = False
+            listener = None
+            if label == "sync text":
+                # Before: basicConfig's StreamHandler, writing on the caller's thread, DEBUG unsampled
+                logger.setLevel(logging.DEBUG)
+                handler = logging.StreamHandler(stream)
+                handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+            else:
+                logger.setLevel(logging.DEBUG)
+                records = queue.SimpleQueue()
+                handler = logs.ContextQueueHandler(records)
+                handler.addFilter(logs.SamplingFilter(0.01))
+                handler.addFilter(logs.ContextFilter())
+                output = logging.StreamHandler(stream)
+                output.setFormatter(logs.JsonFormatter())
+                listener = logging.handlers.QueueListener(records, output)
+                listener.start()
+            logger.addHandler(handler)
+            started = time.perf_counter()
+            for i in range(LOG_UPDATES):
+                handle_update(logger, i)
+            elapsed = time.perf_counter() - started
+            if listener:
+                listener.stop()
+            logger.removeHandler(handler)
+            print(f"{sink_label + ', ' + label:>26}: {elapsed / LOG_UPDATES * 1e6:.1f} µs per update "
+                  f"on the loop thread ({stream.lines} lines written)")
+
+
+ROUTE_ORDERS = 3000
+ROUTE_BLOCKS = 60
+
+
+def bench_route_planner():
+    """Route planning for a few thousand orders in one meal slot: incremental adds and route lengths"""
+    import math
+    import random
+    from planner import DistanceMatrix, RoutePlanner, nearest_neighbour, path_length
+
+    rng = random.Random(1)
+    cafes = ['ሸዊት', 'ፍቄ', 'አስኳል', 'መሲ', 'ኤ.ኤም', 'ሻሽ']
+    campuses = {'main': 'Main', 'tecno': 'Tecno', 'agri': 'Agri'}
+    distances = {}
+    for campus in campuses:
+        points = {str(block): (rng.uniform(0, 1500), rng.uniform(0, 1500)) for block in range(1, ROUTE_BLOCKS + 1)}
+        points.update({cafe: (rng.uniform(500, 1000), rng.uniform(500, 1000)) for cafe in cafes})
+        names = list(points)
+        distances[campus] = {a: {b: round(math.dist(points[a], points[b])) for b in names[i + 1:]}
+                             for i, a in enumerate(names)}
+    matrix = DistanceMatrix(distances)
+    orders = [{'order_number': 1000 + i, 'cafe': rng.choice(cafes), 'gender': rng.choice('MF'), 'time': 'lunch',
+               'place': f"{rng.choice(list(campuses.values()))}: Block {rng.randint(1, ROUTE_BLOCKS)}",
+               'created_at': '2026-01-05T12:00:00'} for i in range(ROUTE_ORDERS)]
+
+    planner = RoutePlanner(matrix)
+    started = time.perf_counter()
+    for order in orders:
+        planner.add(order)
+    added = time.perf_counter() - started
+    started = time.perf_counter()
+    plan = planner.plan('2026-01-05')
+    optimized = time.perf_counter() - started
+    print(f"{'add':>18}: {added / ROUTE_ORDERS * 1e6:.1f} µs per order ({ROUTE_ORDERS} orders)")
+    print(f"{'optimize':>18}: {optimized * 1000:.1f} ms for {len(plan)} routes")
+
+    totals = {'arrival order': 0.0, 'nearest neighbour': 0.0, 'insertion + 2-opt': 0.0}
+    for _, route in plan:
+        distance = route._distance
+        # Arrival order: pick up and deliver in the order the stops first appeared
+        pickups, blocks = list(route.cafe_orders), list(route.block_orders)
+        totals['arrival order'] += path_length(pickups + blocks, None, distance)
+        pickups = nearest_neighbour(pickups, pickups[0], distance)
+        totals['nearest neighbour'] += path_length(pickups + nearest_neighbour(blocks, pickups[-1], distance), None, distance)
+        totals['insertion + 2-opt'] += route.length
+    for label, total in totals.items():
+        print(f"{label:>18}: {total / 1000:.1f} km over {len(plan)} routes")
+
+
+LEDGER_ROWS = 100_000
+LEDGER_USERS = 1000
+
+
+def bench_ledger_balance():
+    """Balance reads at 100k ledger rows: full sum vs snapshot plus tail vs the in-memory cache"""
+    import random
+    import sqlite3
+    from cache import TTLCache
+
+    conn = sqlite3.connect(':memory:')
+    conn.executescript("""
+        create table ledger (id integer primary key, telegram_id integer, amount real);
+        create index ledger_user_idx on ledger (telegram_id, id);
+        create table balance_snapshots (telegram_id integer primary key, balance real, ledger_id integer);
+    """)
+    rng = random.Random(1)
+    conn.executemany("insert into ledger (telegram_id, amount) values (?, ?)",
+                     ((rng.randrange(LEDGER_USERS), rng.choice((-6.65, -13.3, 100.0))) for _ in range(LEDGER_ROWS)))
+    # Snapshot everything but the last 1%, as the hourly job would leave it
+    cut = LEDGER_ROWS - LEDGER_ROWS // 100
+    conn.execute("""insert into balance_snapshots
+                    select telegram_id, sum(amount), max(id) from ledger where id <= ? group by telegram_id""", (cut,))
+
+    full_sum = "select coalesce(sum(amount), 0) from ledger where telegram_id = ?"
+    # Unindexed on telegram_id alone, as a ledger without the composite index would be
+    full_scan = "select coalesce(sum(amount), 0) from ledger not indexed where telegram_id = ?"
+    snapshot_tail = """
+        select coalesce(s.balance, 0) + coalesce((select sum(l.amount) from ledger l
+                                                   where l.telegram_id = ? and l.id > coalesce(s.ledger_id, 0)), 0)
+          from (select 1) left join balance_snapshots s on s.telegram_id = ?"""
+    users = [rng.randrange(LEDGER_USERS) for _ in range(2000)]
+    for user in users[:20]:
+        expected = conn.execute(full_sum, (user,)).fetchone()[0]
+        assert abs(conn.execute(snapshot_tail, (user, user)).fetchone()[0] - expected) < 1e-6
+
+    cache = TTLCache(max_size=LEDGER_USERS, ttl=300)
+    for user in set(users):
+        cache.set(user, conn.execute(snapshot_tail, (user, user)).fetchone()[0])
+    for label, read in (
+        ("full scan", lambda user: conn.execute(full_scan, (user,)).fetchone()),
+        ("indexed sum", lambda user: conn.execute(full_sum, (user,)).fetchone()),
+        ("snapshot + tail", lambda user: conn.execute(snapshot_tail, (user, user)).fetchone()),
+        ("cache hit", cache.get),
+    ):
+        sample = users[:100] if label == "full scan" else users
+        started = time.perf_counter()
+        for user in sample:
+            read(user)
+        elapsed = time.perf_counter() - started
+        print(f"{label:>16}: {elapsed / len(sample) * 1e6:.1f} µs per read")
+    conn.close()
+
+
+def bench_startup():
+    """Import time and time-to-first-update of a fresh process, against the budgets"""
+    import json
+    import os
+    import statistics
+    import subprocess
+    import sys
+
+    env = dict(os.environ, ADMIN_IDS='1', BOT_TOKEN='123:startup', SUPABASE_URL='https://startup.invalid',
+               SUPABASE_KEY='startup', OUTBOX_PATH=':memory:',
+               PERSISTENCE_PATH=':memory:', PERSISTENCE_BACKEND='sqlite', WEBHOOK_URL='')
+    results = {'import': [], 'first_update': [], 'process': []}
+    for _ in range(STARTUP_RUNS):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        results['process'].append(time.perf_counter() - started)
+        for name, value in json.loads(output.strip().splitlines()[-1]).items():
+            results[name].append(value)
+
+    for name, budget in (('import', IMPORT_BUDGET), ('first_update', FIRST_UPDATE_BUDGET), ('process', None)):
+        median = statistics.median(results[name])
+        verdict = '' if budget is None else (' (within budget)' if median <= budget else f' (OVER the {budget:.2f}s budget)')
+        print(f"{name:>16}: {median * 1000:.0f} ms median of {STARTUP_RUNS}{verdict}")
+
+
+async def main():
+    print(f"Concurrent updates ({LATENCY * 1000:.0f} ms simulated latency)")
+    await bench_concurrent_updates()
+    print("Confirm latency")
+    await bench_confirm_latency()
+    print("Menu parsing")
+    bench_menu_parse()
+    print("Keyboard rendering")
+    bench_render()
+    print("Sharded workers")
+    bench_sharding()
+    print(f"Logging ({LOG_UPDATES} updates)")
+    bench_logging()
+    print("Route planning")
+    bench_route_planner()
+    print(f"Balance reads ({LEDGER_ROWS} ledger rows, {LEDGER_USERS} users)")
+    bench_ledger_balance()
+    print("Cold start")
+    bench_startup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,24 +1,57 @@
+import functools
 import logging
+import uuid
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    MessageHandler, filters, ContextTypes, ConversationHandler
+    MessageHandler, TypeHandler, filters, ContextTypes, ConversationHandler
 )
 import config
-from database import Database
-db = Database()
-from utils import extract_numbers_from_text, validate_place_input, get_channel_for_order, format_order_preview
-from datetime import datetime
-
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+from database import AsyncDatabase, DatabaseUnavailable, OrderNumberAllocator
+from cache import CachedDatabase, IdempotencyCache
+from persistence import create_persistence
+from storage import SQLiteStore
+from dispatch import ChannelDispatcher
+from digest import DigestDispatcher
+from degraded import OrderOutbox
+from ledger import BalanceSnapshots
+from planner import RoutePlanner, format_routes
+from changefeed import SupabaseChangeFeed
+from throttle import Throttle
+from menu import MenuCatalog
+from processing import PerUserUpdateProcessor
+from cafes import CafeRegistry, USER_TYPE_KEYBOARD, ORDER_NOW_KEYBOARD, CONFIRM_KEYBOARD, ordering_page_text
+import logs
+import metrics
+from metrics import timed_handler
+db = CachedDatabase(AsyncDatabase())
+order_numbers = OrderNumberAllocator(db)
+cafe_registry = CafeRegistry()
+menu = MenuCatalog(on_reload=cafe_registry.rebuild)
+confirmations = IdempotencyCache()
+route_planner = RoutePlanner()
+# Looks db up on every call, so it follows a replaced db (as in loadtest.py)
+throttle = Throttle(lambda user_id: db.is_known_unauthorized(user_id))
+from utils import (
+    MAX_QUANTITY, validate_place_input, get_channel_for_order, format_order_preview, parse_user_csv,
+    encode_history_cursor, decode_history_cursor, format_order_history, format_order_report, format_rollup_stats
 )
+from datetime import datetime, timedelta
+
+# Enable logging (written from a background thread, as JSON lines unless LOG_FORMAT=text)
+logs.setup_logging()
 logger = logging.getLogger(__name__)
 
 # Conversation states
 SELECTING_USER_TYPE, SELECTING_CAFE, CUSTOM_CAFE, ORDERING, NAME, GENDER, PHONE, TIME, FOOD, PLACE, CONFIRM_ORDER = range(11)
 
+metrics.CONVERSATIONS.state_names = {
+    SELECTING_USER_TYPE: 'SELECTING_USER_TYPE', SELECTING_CAFE: 'SELECTING_CAFE', CUSTOM_CAFE: 'CUSTOM_CAFE',
+    ORDERING: 'ORDERING', NAME: 'NAME', GENDER: 'GENDER', PHONE: 'PHONE', TIME: 'TIME', FOOD: 'FOOD',
+    PLACE: 'PLACE', CONFIRM_ORDER: 'CONFIRM_ORDER'
+}
+
 # User data keys
 USER_TYPE = 'user_type'
 CAFE = 'cafe'
@@ -27,28 +60,107 @@ ORDER_DATA = 'order_data'
 # Global variable for bot application
 bot_application = None
 
+# Posts orders to the channels in the background (started in post_init)
+channel_dispatcher = None
+
+# In multi-worker mode, set in every worker but the one that posts to the channels:
+# takes an order and hands it to that worker (see sharding.py)
+channel_poster = None
+
+# Orders confirmed while Supabase is down, placed once it is back (started in post_init)
+order_outbox = None
+
+# Folds the balance ledger into snapshots (started in post_init)
+balance_snapshots = None
+
+# Pushes Supabase row changes into the cache when CHANGEFEED_ENABLED (started in post_init)
+change_feed = None
+
+SERVICE_UNAVAILABLE = "⚠️አገልግሎቱ ለጊዜው አይሰራም። እባኮን ትንሽ ቆይተው ይሞክሩ።"
+
 def setup_bot():
     """Setup and return the bot application"""
     global bot_application
     
-    bot_application = Application.builder().token(config.BOT_TOKEN).build()
+    bot_application = build_application()
     setup_handlers(bot_application)
     
     return bot_application
 
+def build_application(request=None):
+    """Build the Application with persistence and shutdown hooks configured (request replaces the HTTP client)"""
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(start_services)
+        .post_shutdown(shutdown_services)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    persistence = create_persistence(db)
+    if persistence:
+        builder = builder.persistence(persistence)
+    return builder.build()
+
+async def start_services(application):
+    """Start the channel posting workers, queued order replay and menu reloading once the bot is initialized"""
+    global channel_dispatcher, order_outbox, balance_snapshots, change_feed
+    # The Supabase client (and its imports) is created here rather than when bot.py is imported
+    await db.get_client()
+    if config.CHANGEFEED_ENABLED:
+        change_feed = SupabaseChangeFeed(db.db)
+        change_feed.subscribe(db)
+        change_feed.start()
+    outbox_store = SQLiteStore(config.OUTBOX_PATH)
+    if channel_poster is None:
+        dispatcher_class = DigestDispatcher if config.DIGEST_MODE else ChannelDispatcher
+        channel_dispatcher = dispatcher_class(application.bot, outbox_store)
+        await channel_dispatcher.start()
+        route_planner.start(db)
+    order_outbox = OrderOutbox(outbox_store, db, functools.partial(notify_replayed_order, application.bot))
+    order_outbox.start()
+    balance_snapshots = BalanceSnapshots(db)
+    balance_snapshots.start()
+    menu.start(db)
+
+async def shutdown_services(application):
+    """Stop the background tasks and release the pooled database connection"""
+    await menu.stop()
+    await route_planner.stop()
+    if order_outbox:
+        await order_outbox.stop()
+    if balance_snapshots:
+        await balance_snapshots.stop()
+    if change_feed:
+        await change_feed.stop()
+    if channel_dispatcher:
+        await channel_dispatcher.stop()
+    await db.close()
+
 def setup_handlers(application):
     """Setup all handlers for the bot"""
+    # Rate limits run first and stop dropped updates from reaching any handler below
+    application.add_handler(TypeHandler(Update, throttle), group=-1)
+    
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("balance", balance))
     application.add_handler(CommandHandler("add_user", add_user))
+    application.add_handler(CommandHandler("cache_stats", cache_stats))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("refund", refund))
+    application.add_handler(CommandHandler("route", route))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv"), bulk_users))
     
     # Conversation handler for ordering process
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(select_user_type, pattern='^(contract_user|single_user)$')],
         states={
             SELECTING_USER_TYPE: [
-                CallbackQueryHandler(select_cafe, pattern='^(ሸዊት|ፍቄ|አስኳል|መሲ|ኤ.ኤም|ሻሽ|custom_cafe)$'),
+                CallbackQueryHandler(select_cafe, pattern=cafe_registry.matches),
                 CallbackQueryHandler(custom_cafe_input, pattern='^custom_cafe_input$')
             ],
             SELECTING_CAFE: [
@@ -84,20 +196,28 @@ def setup_handlers(application):
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="ordering",
+        persistent=application.persistence is not None
     )
     
     application.add_handler(conv_handler)
     
     # Other callback handlers
     application.add_handler(CallbackQueryHandler(handle_single_user, pattern='^single_user$'))
-    application.add_handler(CallbackQueryHandler(handle_cafe_selection, pattern='^(ሸዊት|ፍቄ|አስኳል|መሲ|ኤ.ኤም|ሻሽ|custom_cafe)$'))
+    application.add_handler(CallbackQueryHandler(handle_cafe_selection, pattern=cafe_registry.matches))
+    application.add_handler(CallbackQueryHandler(history_page, pattern='^history:'))
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message"""
     user_id = update.effective_user.id
     
-    if not db.is_user_authorized(user_id):
+    authorized = await db.is_user_authorized(user_id)
+    if authorized is None:
+        await update.message.reply_text(SERVICE_UNAVAILABLE)
+        return
+    if not authorized:
         await update.message.reply_text(
             "❎ይህን ቦት ለመጠቀም አስቀድመው ይመዝገቡ!!\n"
             "🧾ለመመዝገብ @campusdeliveryy ያናግሩ።\n"
@@ -112,16 +232,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🍕 እባኮ የአገልግሎት ምርጫዎን ከስር ይምረጡ።"
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("የ ኮንትራት ተጠቃሚ", callback_data="contract_user"),
-            InlineKeyboardButton("ሲንግል order ተጠቃሚ", callback_data="single_user")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_text, reply_markup=USER_TYPE_KEYBOARD)
 
+@timed_handler
 async def select_user_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user type selection"""
     query = update.callback_query
@@ -136,6 +249,7 @@ async def select_user_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return await show_cafe_selection(update, context)
 
+@timed_handler
 async def handle_single_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle single user order"""
     message_text = (
@@ -157,24 +271,14 @@ async def show_cafe_selection(update: Update, context: ContextTypes.DEFAULT_TYPE
         "⬇️⬇️⬇️⬇️⬇️⬇️⬇️⬇️⬇️⬇️⬇️⬇️"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("አስኳል", callback_data="አስኳል")],
-        [InlineKeyboardButton("ፍቄ", callback_data="ፍቄ")],
-        [InlineKeyboardButton("ሸዊት", callback_data="ሸዊት")],
-        [InlineKeyboardButton("መሲ", callback_data="መሲ")],
-        [InlineKeyboardButton("ኤ.ኤም", callback_data="ኤ.ኤም")],
-        [InlineKeyboardButton("ሻሽ", callback_data="ሻሽ")],
-        [InlineKeyboardButton("የካፌውን ሰም ያስገቡ", callback_data="custom_cafe_input")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if update.callback_query:
-        await update.callback_query.edit_message_text(intro_text, reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(intro_text, reply_markup=cafe_registry.keyboard)
     else:
-        await update.message.reply_text(intro_text, reply_markup=reply_markup)
+        await update.message.reply_text(intro_text, reply_markup=cafe_registry.keyboard)
     
     return SELECTING_USER_TYPE
 
+@timed_handler
 async def select_cafe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle cafe selection"""
     query = update.callback_query
@@ -185,10 +289,12 @@ async def select_cafe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return await show_ordering_page(update, context, cafe)
 
+@timed_handler
 async def handle_cafe_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle cafe selection (alias for select_cafe)"""
     return await select_cafe(update, context)
 
+@timed_handler
 async def custom_cafe_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ask for custom cafe name"""
     query = update.callback_query
@@ -197,6 +303,7 @@ async def custom_cafe_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text("👩‍🍳የመረጡትን ካፌ ስም ያስገቡ")
     return CUSTOM_CAFE
 
+@timed_handler
 async def handle_custom_cafe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle custom cafe input"""
     cafe = update.message.text
@@ -206,38 +313,32 @@ async def handle_custom_cafe(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def show_ordering_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cafe: str):
     """Show ordering page"""
-    intro_text = (
-        f"🍝የ **{cafe}** ምግብ ቤት          ሜኑ ለማየት የስረኛውን ሊንክ ይጫኑ!!⬇️⬇️⬇️\n\n"
-        "🍕ከመረጡ በኋላ ወደኋላ በመመለስ ከስር ያለውን\n"
-        "⬇️⬇️ ይዘዙ በመምረጥ የሚጠየቁትን መረጀ\n"
-        "በቅደም ተከተል ያስገቡ!!"
-    )
-    
-    keyboard = [[InlineKeyboardButton("እዘዝ/Order now", callback_data="order_now")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    intro_text = ordering_page_text(cafe)
     
     if update.message:
-        await update.message.reply_text(intro_text, reply_markup=reply_markup)
+        await update.message.reply_text(intro_text, reply_markup=ORDER_NOW_KEYBOARD)
     else:
-        await update.callback_query.edit_message_text(intro_text, reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(intro_text, reply_markup=ORDER_NOW_KEYBOARD)
     
     return ORDERING
 
+@timed_handler
 async def start_ordering(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the ordering process"""
     query = update.callback_query
     await query.answer()
     
-    # Initialize order data
+    # Initialize order data; the key makes confirming this draft idempotent
     context.user_data[ORDER_DATA] = {
         'cafe': context.user_data.get(CAFE, ''),
-        'order_number': db.get_next_order_number(),
-        'user_id': update.effective_user.id
+        'user_id': update.effective_user.id,
+        'idempotency_key': uuid.uuid4().hex
     }
     
     await query.edit_message_text("📄እባኮን ስም እስከነ አባት ያስገቡ:")
     return NAME
 
+@timed_handler
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle name input"""
     name = update.message.text
@@ -246,6 +347,7 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🧒👧ፆታ ምረጥ: ለወንድ M ለ ሴት F ይላኩ")
     return GENDER
 
+@timed_handler
 async def handle_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle gender input"""
     gender = update.message.text.upper()
@@ -259,6 +361,7 @@ async def handle_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("☎️እባኮን ስልክ ቁጥር ያስገቡ:")
     return PHONE
 
+@timed_handler
 async def handle_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle phone input"""
     phone = update.message.text
@@ -267,6 +370,7 @@ async def handle_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏰ሚፈለጉት ለምሳ ወይንስ ለ እራት ነዉ?")
     return TIME
 
+@timed_handler
 async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle time input"""
     time = update.message.text
@@ -275,18 +379,27 @@ async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🍜 እባኮን የመረጡትን የምግብ ብዛት እና አይነት ያስገቡ:")
     return FOOD
 
+@timed_handler
 async def handle_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle food input"""
     food = update.message.text
     
-    # Extract numbers and calculate total
-    success, total_items, total_price = extract_numbers_from_text(food)
+    # Price the items from the cafe's menu, or count them at the flat price
+    cafe = context.user_data[ORDER_DATA]['cafe']
+    success, total_items, total_price = menu.price(cafe, food)
     
     if not success:
-        await update.message.reply_text(
-            "❎እባኮ የምግቡን መጠን በ አሀዝ(1-9) ያካትቱ\n"
-            "✅ምሳሌ:1 አይነት እና 1አትክልት"
-        )
+        unmatched = menu.unmatched(cafe, food)
+        if unmatched:
+            await update.message.reply_text(
+                f"❎እነዚህ በ{cafe} ሜኑ ላይ አልተገኙም: {', '.join(unmatched)}\n"
+                "✅እባኮ የምግቡን ስም አስተካክለው እንደገና ያስገቡ"
+            )
+        else:
+            await update.message.reply_text(
+                f"❎እባኮ የምግቡን መጠን በ አሀዝ(1-{MAX_QUANTITY}) ያካትቱ\n"
+                "✅ምሳሌ:1 አይነት እና 1አትክልት"
+            )
         return FOOD
     
     context.user_data[ORDER_DATA]['food'] = food
@@ -301,6 +414,7 @@ async def handle_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return PLACE
 
+@timed_handler
 async def handle_place(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle place input"""
     place = update.message.text
@@ -322,28 +436,69 @@ async def show_order_preview(update: Update, context: ContextTypes.DEFAULT_TYPE)
     order_data = context.user_data[ORDER_DATA]
     preview_text = format_order_preview(order_data)
     
-    keyboard = [
-        [
-            InlineKeyboardButton("✅አረጋግጥ", callback_data="confirm_order"),
-            InlineKeyboardButton("እንደገና ያስገቡ", callback_data="restart_order")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(preview_text, reply_markup=reply_markup)
+    await update.message.reply_text(preview_text, reply_markup=CONFIRM_KEYBOARD)
     return CONFIRM_ORDER
 
+@timed_handler
 async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Confirm and process order"""
+    order_data = context.user_data.get(ORDER_DATA)
+    if order_data is None:
+        # A repeated press that arrived after the order was placed
+        return ConversationHandler.END
+    
+    # Drafts saved before idempotency keys existed get one now
+    key = order_data.setdefault('idempotency_key', uuid.uuid4().hex)
+    
+    # Double taps wait for the first press and return its state without touching the DB or Telegram;
+    # failures worth retrying (CONFIRM_ORDER) are not remembered
+    return await confirmations.run(
+        key,
+        lambda: place_confirmed_order(update, context, order_data),
+        keep=lambda state: state == ConversationHandler.END
+    )
+
+async def place_confirmed_order(update: Update, context: ContextTypes.DEFAULT_TYPE, order_data: dict):
+    """Place the order behind a confirm press - returns the next conversation state"""
     query = update.callback_query
     await query.answer()
     
     user_id = update.effective_user.id
-    order_data = context.user_data[ORDER_DATA]
+    order_data['user_telegram_id'] = user_id
+    order_data['created_at'] = datetime.now().isoformat()
+    order_data['channel'] = get_channel_for_order(order_data['gender'], order_data['place'])
+    
+    # Assign the order number only once the order is actually being placed
+    result = None
+    unavailable = False
+    try:
+        order_number = await order_numbers.next()
+        if order_number is not None:
+            order_data['order_number'] = order_number
+            logs.bind(order_number=order_number)
+            # Check balance, deduct it and save the order in a single transaction
+            result = await db.place_order(order_data)
+    except DatabaseUnavailable:
+        # No answer from Supabase, so the order may even have been placed already;
+        # replaying it with the same idempotency_key returns that order instead of debiting twice
+        unavailable = True
+    
+    if result is None:
+        if unavailable:
+            # Keep the order locally and place it once Supabase is back
+            await order_outbox.add(order_data)
+            await query.edit_message_text(
+                "⏳ትዕዛዞ ደርሶናል። ሲስተሙ እንደተመለሰ ተረጋግጦ መልዕክት ይደርሶታል።"
+            )
+            context.user_data.clear()
+            return ConversationHandler.END
+        await query.edit_message_text(
+            "❎ትዕዛዙን ማስተናገድ አልተቻለም። እባኮን በድጋሚ ይሞክሩ።",
+            reply_markup=query.message.reply_markup
+        )
+        return CONFIRM_ORDER
     
-    # Check user balance
-    user_balance = db.get_user_balance(user_id)
-    if user_balance < order_data['total_price']:
+    if not result['success']:
         await query.edit_message_text(
             "🛡አሁን ያሎት ቀሪ ሒሳብ ማዘዝ አያስችሎትም!!\n"
             "🛡እባኮን ሂሳቦን ሞልተው በድጋሚ ይዘዙ።\n"
@@ -351,22 +506,14 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Deduct balance
-    new_balance = user_balance - order_data['total_price']
-    db.update_user_balance(user_id, new_balance)
-    
-    # Save order to database
-    order_data['user_telegram_id'] = user_id
-    order_data['created_at'] = datetime.now().isoformat()
-    db.create_order(order_data)
-    
-    # Post to appropriate channel
-    channel = get_channel_for_order(order_data['gender'], order_data['place'])
-    channel_id = config.CHANNELS.get(channel)
-    
-    if channel_id:
-        order_message = format_order_message(order_data)
-        await context.bot.send_message(chat_id=channel_id, text=order_message)
+    # A duplicate means an earlier attempt with this key was committed even though its reply was lost,
+    # so that order is the one posted (the earlier attempt never reached the post)
+    order_data['order_number'] = result['order_number']
+    logs.bind(order_number=result['order_number'])
+    logger.info(f"Placed order #{result['order_number']}",
+                extra={'cafe': order_data['cafe'], 'channel': order_data['channel'],
+                       'total_price': order_data['total_price'], 'duplicate': result.get('duplicate', False)})
+    await post_order_to_channel(order_data)
     
     # Send success message to user
     await query.edit_message_text(
@@ -379,6 +526,39 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+async def post_order_to_channel(order_data: dict):
+    """Queue the post for the order's channel and add it to the courier route; delivery happens in the background"""
+    if channel_poster is not None:
+        # Another worker posts for every channel, so each slot gets one digest and one route
+        channel_poster(order_data)
+        return
+    route_planner.add(order_data)
+    channel = order_data['channel']
+    if config.DIGEST_MODE:
+        queued = await channel_dispatcher.post_order(channel, order_data)
+    else:
+        queued = await channel_dispatcher.post(channel, format_order_message(order_data))
+    if not queued:
+        metrics.CHANNEL_POST_ERRORS.inc(channel)
+        logger.error(f"Order #{order_data['order_number']} was not posted: channel {channel} has no chat id configured")
+
+async def notify_replayed_order(telegram_bot, order_data: dict, result: dict):
+    """Post an order queued during an outage and tell the user how it went"""
+    if result['success']:
+        order_data['order_number'] = result['order_number']
+        await post_order_to_channel(order_data)
+        text = f"ትዕዛዞ #{result['order_number']} በተሰካ ሁኔታ ተከናውኗል✅"
+    else:
+        text = (
+            "🛡አሁን ያሎት ቀሪ ሒሳብ ማዘዝ አያስችሎትም!!\n"
+            "🛡እባኮን ሂሳቦን ሞልተው በድጋሚ ይዘዙ።"
+        )
+    try:
+        await telegram_bot.send_message(chat_id=order_data['user_telegram_id'], text=text)
+    except TelegramError as e:
+        logger.warning(f"Could not notify user {order_data['user_telegram_id']}: {e}")
+
+@timed_handler
 async def restart_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Restart the ordering process"""
     query = update.callback_query
@@ -387,6 +567,7 @@ async def restart_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text("📄እባኮን ስም እስከነ አባት ያስገቡ:")
     return NAME
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the conversation"""
     await update.message.reply_text("ትዕዛዝ ተሰርዟል።")
@@ -397,19 +578,28 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+@timed_handler
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check user balance"""
     user_id = update.effective_user.id
     
-    if not db.is_user_authorized(user_id):
+    authorized = await db.is_user_authorized(user_id)
+    if authorized is None:
+        await update.message.reply_text(SERVICE_UNAVAILABLE)
+        return
+    if not authorized:
         await update.message.reply_text(
             "❎ይህን ቦት ለመጠቀም አስቀድመው ይመዝገቡ!!"
         )
         return
     
-    balance = db.get_user_balance(user_id)
+    balance = await db.get_user_balance(user_id)
+    if balance is None:
+        await update.message.reply_text(SERVICE_UNAVAILABLE)
+        return
     await update.message.reply_text(f"💰የአሁኑ ቀሪ ሒሳብዎ: {balance:.2f} ETB")
 
+@timed_handler
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to add user"""
     user_id = update.effective_user.id
@@ -425,7 +615,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         telegram_id = int(context.args[0])
         fund = float(context.args[1])
-        success, error_msg = db.add_user(telegram_id, f"User_{telegram_id}", fund)
+        success, error_msg = await db.add_user(telegram_id, f"User_{telegram_id}", fund)
         
         if success:
             await update.message.reply_text(f"✅ተጠቃሚ {telegram_id} በ {fund} ETB ተጨምሯል።")
@@ -439,6 +629,199 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❎ትክክለኛ ያልሆነ ቁጥር።\n\nUsage: /add_user <Telegram_ID> <Balance>\nExample: /add_user 123456789 100")
 
+@timed_handler
+async def bulk_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin CSV upload: import users, or top up balances when the caption is 'topup'"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    topup = (update.message.caption or '').strip().lower().lstrip('/') == 'topup'
+    csv_file = await update.message.document.get_file()
+    text = (await csv_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+    rows, errors = parse_user_csv(text, topup=topup)
+    
+    if topup:
+        failures = await db.bulk_adjust_balances(rows)
+    else:
+        failures = await db.bulk_upsert_users(rows)
+    
+    report = [f"✅{len(rows) - len(failures)} rows applied, ❎{len(errors) + len(failures)} failed"]
+    report += [f"line {line}: {error}" for line, error in errors]
+    report += [f"{telegram_id}: {error}" for telegram_id, error in failures]
+    if len(report) > 31:
+        report = report[:31] + [f"... and {len(report) - 31} more"]
+    await update.message.reply_text("\n".join(report)[:4000])
+
+@timed_handler
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show cache hit/miss counters"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    lines = []
+    for name, stats in db.stats().items():
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups * 100 if lookups else 0.0
+        lines.append(
+            f"{name}: {stats['size']} entries, {stats['hits']} hits, "
+            f"{stats['misses']} misses ({hit_rate:.1f}%), {stats['evictions']} evictions"
+        )
+    if change_feed:
+        lines.append(f"change feed: {'live, cached until changed' if change_feed.live else f'down, {db.ttl:.0f}s TTL'}")
+    await update.message.reply_text("\n".join(lines))
+
+async def order_history_page(user_id: int, before: tuple = None):
+    """Text and "more" keyboard for one page of a user's order history"""
+    orders = await db.get_order_history(user_id, config.HISTORY_PAGE_SIZE + 1, before)
+    if orders is None:
+        return "❎ታሪኩን ማግኘት አልተቻለም። እባኮን በድጋሚ ይሞክሩ።", None
+    
+    page = orders[:config.HISTORY_PAGE_SIZE]
+    reply_markup = None
+    if len(orders) > len(page):
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("ተጨማሪ⬇️", callback_data=encode_history_cursor(page[-1]))]
+        ])
+    return format_order_history(page), reply_markup
+
+@timed_handler
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's most recent orders"""
+    user_id = update.effective_user.id
+    
+    authorized = await db.is_user_authorized(user_id)
+    if authorized is None:
+        await update.message.reply_text(SERVICE_UNAVAILABLE)
+        return
+    if not authorized:
+        await update.message.reply_text(
+            "❎ይህን ቦት ለመጠቀም አስቀድመው ይመዝገቡ!!"
+        )
+        return
+    
+    text, reply_markup = await order_history_page(user_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+@timed_handler
+async def history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the next page of order history"""
+    query = update.callback_query
+    await query.answer()
+    
+    before = decode_history_cursor(query.data)
+    if before is None:
+        return
+    text, reply_markup = await order_history_page(update.effective_user.id, before)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@timed_handler
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show order totals per day, cafe or channel"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    days = config.REPORT_DEFAULT_DAYS
+    group_by = 'day'
+    for arg in context.args:
+        if arg.isdigit() and int(arg) > 0:
+            days = int(arg)
+        elif arg.lower() in ('day', 'cafe', 'channel'):
+            group_by = arg.lower()
+        else:
+            await update.message.reply_text("❎አጠቃቀም: /report [days] [day|cafe|channel]\nExample: /report 30 cafe")
+            return
+    
+    now = datetime.now()
+    start = (now - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    rows = await db.get_order_report(start.isoformat(), now.isoformat(), group_by)
+    if rows is None:
+        await update.message.reply_text("❎ሪፖርቱን ማግኘት አልተቻለም። እባኮን በድጋሚ ይሞክሩ።")
+        return
+    await update.message.reply_text(format_order_report(rows, group_by, days)[:4000])
+
+@timed_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show dispatch totals from the rollup, or rebuild it"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    if context.args and context.args[0].lower() == 'rebuild':
+        since = context.args[1] if len(context.args) > 1 else None
+        rows = await db.rebuild_order_rollup(since)
+        if rows is None:
+            await update.message.reply_text("❎ማደስ አልተቻለም። እባኮን በድጋሚ ይሞክሩ።")
+        else:
+            await update.message.reply_text(f"✅Rollup rebuilt from {since or 'the first order'}: {rows} rows")
+        return
+    
+    try:
+        days = int(context.args[0]) if context.args else 1
+        if days < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❎አጠቃቀም: /stats [days] or /stats rebuild [YYYY-MM-DD]")
+        return
+    
+    end_day = datetime.now().date()
+    start_day = end_day - timedelta(days=days - 1)
+    rows = await db.get_order_rollup(start_day.isoformat(), end_day.isoformat())
+    if rows is None:
+        await update.message.reply_text("❎ሪፖርቱን ማግኘት አልተቻለም። እባኮን በድጋሚ ይሞክሩ።")
+        return
+    await update.message.reply_text(format_rollup_stats(rows, start_day.isoformat(), end_day.isoformat())[:4000])
+
+@timed_handler
+async def refund(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to credit an order's price back to the user who placed it"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("❎አጠቃቀም: /refund <order_number> [note]\nExample: /refund 1024 cafe closed")
+        return
+    
+    order_number = int(context.args[0])
+    note = ' '.join(context.args[1:]) or f"refunded by {update.effective_user.id}"
+    result, error = await db.refund_order(order_number, note)
+    if result is None:
+        await update.message.reply_text(f"❎ትዕዛዝ #{order_number} ተመላሽ ማድረግ አልተቻለም: {error}")
+        return
+    await update.message.reply_text(
+        f"✅ትዕዛዝ #{order_number} ተመላሽ ተደርጓል።\n"
+        f"User {result['telegram_id']} ቀሪ ሒሳብ: {float(result['balance']):.2f} ETB"
+    )
+
+@timed_handler
+async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show today's courier routes per channel and meal slot"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        await update.message.reply_text("❎ይህ ትዕዛዝ ለአስተዳዳሪዎች ብቻ ነው።")
+        return
+    
+    slot = channel = None
+    for arg in context.args:
+        if arg.lower() in ('lunch', 'dinner', 'other'):
+            slot = arg.lower()
+        elif arg in config.CHANNELS:
+            channel = arg
+        else:
+            await update.message.reply_text(
+                "❎አጠቃቀም: /route [lunch|dinner|other] [channel]\nExample: /route lunch female_main"
+            )
+            return
+    
+    # Other workers and instances confirm orders too, so plan from the database
+    plan, complete = await route_planner.plan_all(db, slot=slot, channel=channel)
+    text = format_routes(plan)
+    if not complete:
+        text = "⚠️ዳታቤዙን ማግኘት አልተቻለም፤ ይህ ሰርቨር የተቀበላቸው ትዕዛዞች ብቻ ናቸው።\n\n" + text
+    await update.message.reply_text(text[:4000])
+
 def format_order_message(order_data: dict) -> str:
     """Format order message for channel posting"""
     return f"""📦 **አዲስ ትዕዛዝ #{order_data['order_number']}**
@@ -458,7 +841,7 @@ def format_order_message(order_data: dict) -> str:
 # For backward compatibility - if you want to run with polling
 def setup_bot():
     """Setup and return the bot application"""
-    bot_application = Application.builder().token(config.BOT_TOKEN).build()
+    bot_application = build_application()
     setup_handlers(bot_application)
     return bot_application
 
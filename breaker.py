@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors that mean the backend did not answer; an error response (bad input,
+# constraint violation) still proves it is up
+UNAVAILABLE_ERRORS = (asyncio.TimeoutError, httpx.TransportError)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend that is known to be down"""
+
+
+class CircuitBreaker:
+    """Stops calling a failing backend and lets one probe through now and then.
+
+    After failure_threshold consecutive calls time out or cannot connect, the
+    circuit opens and calls fail at once with CircuitOpenError. Once
+    reset_timeout seconds have passed, the next call is let through as a
+    probe: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or config.BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout if reset_timeout is not None else config.BREAKER_RESET_TIMEOUT
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = CLOSED
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        """Whether calls are currently let through (a probe counts)"""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self._probing)
+
+    async def call(self, factory: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """Await factory() within timeout, or raise CircuitOpenError without calling it"""
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self._probing):
+            raise CircuitOpenError(f"{self.name} is unavailable")
+        probe = state == HALF_OPEN
+        self._probing = self._probing or probe
+        try:
+            result = await asyncio.wait_for(factory(), timeout)
+        except UNAVAILABLE_ERRORS:
+            self._record_failure()
+            raise
+        except Exception:
+            self._record_success()
+            raise
+        finally:
+            if probe:
+                self._probing = False
+        self._record_success()
+        return result
+
+    def _record_success(self):
+        if self._state != CLOSED:
+            logger.info(f"{self.name} is back, closing the circuit")
+        self._state = CLOSED
+        self.failures = 0
+
+    def _record_failure(self):
+        self.failures += 1
+        if self._state == OPEN or self.failures >= self.failure_threshold:
+            if self._state != OPEN:
+                logger.warning(f"{self.name} failed {self.failures} times in a row, opening the circuit")
+            self._state = OPEN
+            self.opened_at = time.monotonic()
@@ -0,0 +1,280 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+import config
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ttl seconds after being set (never, if ttl is None)"""
+
+    def __init__(self, max_size: int, ttl: Optional[float]):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether key has an unexpired entry, without counting a hit or miss"""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value, or default if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Store value, evicting the least recently used entries when full"""
+        expires_at = math.inf if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Drop a single entry"""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Return size and hit/miss/eviction counters"""
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class IdempotencyCache:
+    """Runs a coroutine once per key and hands its result to every other call with that key.
+
+    Calls made while the first one is running wait for it; calls made later
+    get the stored result for ttl seconds. Results for which keep() is false,
+    e.g. failures worth retrying, are not stored.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.results = TTLCache(max_size or config.CACHE_MAX_SIZE, ttl if ttl is not None else config.IDEMPOTENCY_TTL)
+        self._running: Dict[Hashable, asyncio.Future] = {}
+        self.duplicates = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]],
+                  keep: Callable[[Any], bool] = lambda result: True) -> Any:
+        missing = object()
+        result = self.results.get(key, missing)
+        if result is not missing:
+            self.duplicates += 1
+            return result
+        running = self._running.get(key)
+        if running is not None:
+            self.duplicates += 1
+            return await asyncio.shield(running)
+
+        future = self._running[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Only waiting duplicates care about the error
+            future.exception()
+            raise
+        finally:
+            del self._running[key]
+        future.set_result(result)
+        if keep(result):
+            self.results.set(key, result)
+        return result
+
+class CachedDatabase:
+    """Caches authorization and balance lookups in front of AsyncDatabase.
+
+    Every write that can change a cached value goes through this wrapper and
+    invalidates the affected telegram_id. Methods that are not cached are
+    passed straight through to the wrapped database.
+
+    Changes made elsewhere (the Supabase dashboard, another worker) arrive
+    through a change feed calling on_change(). While the feed is live,
+    entries are kept until a change invalidates them; otherwise they expire
+    after ttl seconds. Writes made here are also handed to peers, if set,
+    which in multi-worker mode passes them to every other worker's on_change().
+    """
+
+    def __init__(self, db, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.db = db
+        max_size = max_size or config.CACHE_MAX_SIZE
+        self.ttl = ttl if ttl is not None else config.CACHE_TTL
+        self.authorized = TTLCache(max_size, self.ttl)
+        self.balances = TTLCache(max_size, self.ttl)
+        # Users seen as authorized recently, trusted while the database is unreachable
+        self.known_users = TTLCache(max_size, config.DEGRADED_AUTH_TTL)
+        # Users the database said are not registered
+        self.unauthorized = TTLCache(max_size, config.UNAUTHORIZED_CACHE_TTL)
+        # Sequence number of each user's last pushed change, so a read that was in
+        # flight when the change arrived does not cache what it read
+        self._changes = TTLCache(max_size, None)
+        self._sequence = 0
+        self._cleared = 0
+        self.peers: Optional[Callable[[List[tuple]], None]] = None
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def invalidate(self, user_id: int):
+        """Forget everything cached about a user"""
+        self.authorized.invalidate(user_id)
+        self.balances.invalidate(user_id)
+        self.known_users.invalidate(user_id)
+        self.unauthorized.invalidate(user_id)
+
+    def _changed_since(self, user_id: int, sequence: int) -> bool:
+        return self._cleared > sequence or self._changes.get(user_id, 0) > sequence
+
+    def on_change(self, table: str, kind: str, record: Optional[Dict], old_record: Optional[Dict]):
+        """Invalidate whatever a row change on users, orders or ledger affects"""
+        row = record or old_record or {}
+        user_id = row.get('user_telegram_id' if table == 'orders' else 'telegram_id')
+        if user_id is None:
+            return
+        self._sequence += 1
+        self._changes.set(user_id, self._sequence)
+        if table == 'users' and kind != 'UPDATE':
+            # Added or removed: authorization changes too
+            self.invalidate(user_id)
+        else:
+            self.balances.invalidate(user_id)
+
+    def _wrote(self, changes: List[tuple]):
+        """Apply (table, kind, record) changes once they were written through here, then pass them to peers.
+
+        Invalidating after the write, with a new sequence number, also keeps a
+        read that overlapped the write from caching the value it replaced.
+        """
+        for table, kind, record in changes:
+            self.on_change(table, kind, record, None)
+        if self.peers is not None and changes:
+            self.peers(changes)
+
+    def on_live(self, live: bool):
+        """Keep entries until invalidated while the change feed is live, for ttl seconds otherwise"""
+        self.authorized.ttl = self.balances.ttl = None if live else self.ttl
+        # Changes may have been missed while the feed was not delivering them
+        self._sequence += 1
+        self._cleared = self._sequence
+        self.authorized.clear()
+        self.unauthorized.clear()
+        self.balances.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return counters for each cache"""
+        return {'authorized': self.authorized.stats(), 'unauthorized': self.unauthorized.stats(),
+                'balances': self.balances.stats()}
+
+    def is_known_unauthorized(self, user_id: int) -> bool:
+        """Whether the database recently said this user is not registered"""
+        return user_id in self.unauthorized
+
+    async def is_user_authorized(self, user_id: int) -> Optional[bool]:
+        """Check authorization, caching both answers and falling back to positive ones when the check fails"""
+        if self.authorized.get(user_id):
+            return True
+        if self.unauthorized.get(user_id):
+            return False
+        sequence = self._sequence
+        authorized = await self.db.is_user_authorized(user_id)
+        if authorized:
+            if not self._changed_since(user_id, sequence):
+                self.authorized.set(user_id, True)
+            self.known_users.set(user_id, True)
+        elif authorized is False:
+            if not self._changed_since(user_id, sequence):
+                self.unauthorized.set(user_id, True)
+        elif authorized is None and self.known_users.get(user_id):
+            return True
+        return authorized
+
+    async def get_user_balance(self, user_id: int) -> Optional[float]:
+        """Get user balance, served from cache when fresh"""
+        balance = self.balances.get(user_id)
+        if balance is None:
+            sequence = self._sequence
+            balance = await self.db.get_user_balance(user_id)
+            if balance is not None and not self._changed_since(user_id, sequence):
+                self.balances.set(user_id, balance)
+        return balance
+
+    async def update_user_balance(self, user_id: int, amount: float) -> bool:
+        """Update user balance and invalidate the cached value"""
+        # Invalidated even if the call failed: it may have been applied before the error
+        updated = await self.db.update_user_balance(user_id, amount)
+        self._wrote([('users', 'UPDATE', {'telegram_id': user_id})])
+        return updated
+
+    async def add_user(self, telegram_id: int, name: str, initial_balance: float = 0.0) -> tuple[bool, str]:
+        """Add new user and invalidate anything cached about them"""
+        added, message = await self.db.add_user(telegram_id, name, initial_balance)
+        self._wrote([('users', 'INSERT', {'telegram_id': telegram_id})])
+        return added, message
+
+    async def bulk_upsert_users(self, rows: List[Dict], chunk_size: Optional[int] = None) -> List[tuple[int, str]]:
+        """Bulk insert/update users and invalidate each of them"""
+        failures = await self.db.bulk_upsert_users(rows, chunk_size)
+        self._wrote([('users', 'INSERT', {'telegram_id': row['telegram_id']}) for row in rows])
+        return failures
+
+    async def bulk_adjust_balances(self, adjustments: List[Dict], chunk_size: Optional[int] = None) -> List[tuple[int, str]]:
+        """Bulk adjust balances and invalidate each cached balance"""
+        failures = await self.db.bulk_adjust_balances(adjustments, chunk_size)
+        self._wrote([('users', 'UPDATE', {'telegram_id': row['telegram_id']}) for row in adjustments])
+        return failures
+
+    async def refund_order(self, order_number: int, note: Optional[str] = None) -> tuple[Optional[Dict], str]:
+        """Refund an order and cache the balance the database returned"""
+        sequence = self._sequence
+        refund, error = await self.db.refund_order(order_number, note)
+        if refund is not None:
+            changed = self._changed_since(refund['telegram_id'], sequence)
+            self._wrote([('ledger', 'INSERT', {'telegram_id': refund['telegram_id']})])
+            if not changed:
+                self.balances.set(refund['telegram_id'], float(refund['balance']))
+        return refund, error
+
+    async def place_order(self, order_data: Dict) -> Optional[Dict]:
+        """Place an order and cache the balance the database returned"""
+        user_id = order_data['user_telegram_id']
+        sequence = self._sequence
+        changed = False
+        try:
+            result = await self.db.place_order(order_data)
+            changed = self._changed_since(user_id, sequence)
+        finally:
+            # Invalidated even if the call failed: a timeout may have committed
+            self._wrote([('orders', 'INSERT', {'user_telegram_id': user_id})])
+        if result is not None and not changed:
+            self.balances.set(user_id, result['balance'])
+        return result
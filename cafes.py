@@ -0,0 +1,59 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Cafes offered on the selection keyboard, in display order
+DEFAULT_CAFES = ['አስኳል', 'ፍቄ', 'ሸዊት', 'መሲ', 'ኤ.ኤም', 'ሻሽ']
+
+# Keyboards that never change are built once; InlineKeyboardMarkup is immutable
+USER_TYPE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("የ ኮንትራት ተጠቃሚ", callback_data="contract_user"),
+        InlineKeyboardButton("ሲንግል order ተጠቃሚ", callback_data="single_user")
+    ]
+])
+ORDER_NOW_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("እዘዝ/Order now", callback_data="order_now")]])
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅አረጋግጥ", callback_data="confirm_order"),
+        InlineKeyboardButton("እንደገና ያስገቡ", callback_data="restart_order")
+    ]
+])
+
+
+class CafeRegistry:
+    """The cafe list, its selection keyboard and its callback pattern, built together.
+
+    rebuild() swaps all three at once, e.g. when the menu catalog reloads, so
+    the keyboard and the handlers never disagree about which cafes exist.
+    """
+
+    def __init__(self, cafes: Iterable[str] = DEFAULT_CAFES):
+        self.rebuild(cafes)
+
+    def rebuild(self, cafes: Iterable[str]):
+        """Rebuild the keyboard and pattern for the default cafes plus any new ones"""
+        cafes = list(DEFAULT_CAFES) + [cafe for cafe in cafes if cafe not in DEFAULT_CAFES]
+        keyboard = [[InlineKeyboardButton(cafe, callback_data=cafe)] for cafe in cafes]
+        keyboard.append([InlineKeyboardButton("የካፌውን ሰም ያስገቡ", callback_data="custom_cafe_input")])
+
+        self.pattern = re.compile('^(' + '|'.join(re.escape(cafe) for cafe in cafes + ['custom_cafe']) + ')$')
+        self.keyboard = InlineKeyboardMarkup(keyboard)
+        self.cafes: List[str] = cafes
+
+    def matches(self, callback_data) -> bool:
+        """Callback pattern for CallbackQueryHandler; follows rebuilds"""
+        return isinstance(callback_data, str) and self.pattern.match(callback_data) is not None
+
+
+@lru_cache(maxsize=256)
+def ordering_page_text(cafe: str) -> str:
+    """Text of the menu/order-now page for a cafe"""
+    return (
+        f"🍝የ **{cafe}** ምግብ ቤት          ሜኑ ለማየት የስረኛውን ሊንክ ይጫኑ!!⬇️⬇️⬇️\n\n"
+        "🍕ከመረጡ በኋላ ወደኋላ በመመለስ ከስር ያለውን\n"
+        "⬇️⬇️ ይዘዙ በመምረጥ የሚጠየቁትን መረጀ\n"
+        "በቅደም ተከተል ያስገቡ!!"
+    )
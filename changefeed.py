@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('users', 'orders', 'ledger')
+
+
+class LocalChangeFeed:
+    """Delivers row changes to subscribers; publish() is called directly, e.g. from tests.
+
+    A subscriber has on_change(table, kind, record, old_record), where kind is
+    INSERT, UPDATE or DELETE, and on_live(live), told whenever the feed starts
+    or stops delivering every change.
+    """
+
+    def __init__(self):
+        self.subscribers: List = []
+        self.live = False
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        subscriber.on_live(self.live)
+
+    def publish(self, table: str, kind: str, record: Optional[Dict] = None, old_record: Optional[Dict] = None):
+        for subscriber in self.subscribers:
+            try:
+                subscriber.on_change(table, kind, record, old_record)
+            except Exception as e:
+                logger.error(f"Error handling {kind} on {table}: {e}")
+
+    def _set_live(self, live: bool):
+        if live == self.live:
+            return
+        self.live = live
+        logger.info(f"Change feed {'is live' if live else 'stopped; caches fall back to their TTL'}")
+        for subscriber in self.subscribers:
+            subscriber.on_live(live)
+
+    def start(self):
+        self._set_live(True)
+
+    async def stop(self):
+        self._set_live(False)
+
+
+class SupabaseChangeFeed(LocalChangeFeed):
+    """Row changes on users, orders and ledger from Supabase Realtime (see migration 010).
+
+    The channel is checked every CHANGEFEED_CHECK_INTERVAL seconds and the
+    feed only counts as live while it is joined, so a dropped connection
+    sends the caches back to their TTL until it has rejoined.
+    """
+
+    def __init__(self, db, interval: Optional[float] = None):
+        super().__init__()
+        self.db = db
+        self.interval = interval or config.CHANGEFEED_CHECK_INTERVAL
+        self._channel = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _on_change(self, payload):
+        data = payload['data']
+        self.publish(data['table'], data['type'], data.get('record'), data.get('old_record'))
+
+    async def _join(self):
+        client = await self.db.get_client()
+        channel = client.channel('bot-cache-invalidation')
+        for table in TABLES:
+            channel.on_postgres_changes('*', schema='public', table=table, callback=self._on_change)
+        await channel.subscribe()
+        self._channel = channel
+
+    async def _watch_loop(self):
+        while True:
+            try:
+                if self._channel is None:
+                    await self._join()
+                self._set_live(self._channel.is_joined)
+            except Exception as e:
+                logger.error(f"Error joining the change feed: {e}")
+                self._set_live(False)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch_loop(), name="change-feed")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._channel is not None:
+            client = await self.db.get_client()
+            try:
+                await asyncio.wait_for(client.remove_channel(self._channel), config.DB_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Error leaving the change feed: {e}")
+            self._channel = None
+        self._set_live(False)
@@ -6,9 +6,52 @@ load_dotenv()
 # Bot Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Webhook Configuration (webhook mode is enabled when WEBHOOK_URL is set)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Required in webhook mode: Telegram sends it with every update and others are refused
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Seconds to wait for an update to be queued before answering 503 so Telegram retries it
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', '2'))
+
+# Worker processes; updates are sharded across them by user id when above 1
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+
+# Concurrent Update Processing (each user's updates still run one at a time, in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '1024'))
+
 # Supabase Configuration
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+DB_TIMEOUT = float(os.getenv('DB_TIMEOUT', '10'))
+DB_MAX_CONCURRENCY = int(os.getenv('DB_MAX_CONCURRENCY', '20'))
+
+# Circuit Breaker: stop calling Supabase after this many timeouts/connection errors in a row,
+# then let one probe through every BREAKER_RESET_TIMEOUT seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+# While Supabase is down: how long a user seen as authorized stays trusted, and how often queued orders are retried
+DEGRADED_AUTH_TTL = float(os.getenv('DEGRADED_AUTH_TTL', '86400'))
+ORDER_REPLAY_INTERVAL = float(os.getenv('ORDER_REPLAY_INTERVAL', '15'))
+
+# Cache Configuration (authorization and balance lookups)
+CACHE_TTL = float(os.getenv('CACHE_TTL', '60'))
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', '10000'))
+# How long a user found not to be registered is answered from cache (adding them clears it)
+UNAUTHORIZED_CACHE_TTL = float(os.getenv('UNAUTHORIZED_CACHE_TTL', '300'))
+# Invalidate from Supabase Realtime (needs migration 010) and cache until a change arrives while it is connected
+CHANGEFEED_ENABLED = os.getenv('CHANGEFEED_ENABLED', '').lower() in ('1', 'true', 'yes')
+CHANGEFEED_CHECK_INTERVAL = float(os.getenv('CHANGEFEED_CHECK_INTERVAL', '5'))
+# How long a confirmed order's result answers repeated confirm presses
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '3600'))
+
+# Conversation Persistence ('sqlite', 'supabase' or empty to keep state in memory only)
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'sqlite')
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3')
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+# Seconds after which a user still in the middle of an order no longer counts in bot_conversations
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', '3600'))
 
 # Channel Configuration
 CHANNELS = {
@@ -19,8 +62,51 @@ CHANNELS = {
     'agri': os.getenv('CHANNEL_AGRI')
 }
 
+# Channel Posting (Telegram allows about 20 posts/minute per channel and 30 messages/second overall)
+CHANNEL_POSTS_PER_MINUTE = float(os.getenv('CHANNEL_POSTS_PER_MINUTE', '20'))
+GLOBAL_POSTS_PER_SECOND = float(os.getenv('GLOBAL_POSTS_PER_SECOND', '25'))
+DISPATCH_MAX_BACKOFF = float(os.getenv('DISPATCH_MAX_BACKOFF', '60'))
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.sqlite3')
+
+# Digest Mode: post each channel's orders per meal slot as one message that is edited as orders arrive
+DIGEST_MODE = os.getenv('DIGEST_MODE', '').lower() in ('1', 'true', 'yes')
+DIGEST_WINDOW = float(os.getenv('DIGEST_WINDOW', '120'))
+DIGEST_MAX_ORDERS = int(os.getenv('DIGEST_MAX_ORDERS', '25'))
+
+# Logging: 'json' for one JSON object per line, 'text' for the plain format; DEBUG records are sampled
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0.01'))
+
+# Rate Limits (updates per second and burst size; a rate of 0 disables that limit)
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', '1'))
+THROTTLE_USER_BURST = float(os.getenv('THROTTLE_USER_BURST', '20'))
+THROTTLE_UNAUTHORIZED_RATE = float(os.getenv('THROTTLE_UNAUTHORIZED_RATE', '0.05'))
+THROTTLE_UNAUTHORIZED_BURST = float(os.getenv('THROTTLE_UNAUTHORIZED_BURST', '3'))
+THROTTLE_GLOBAL_RATE = float(os.getenv('THROTTLE_GLOBAL_RATE', '500'))
+THROTTLE_GLOBAL_BURST = float(os.getenv('THROTTLE_GLOBAL_BURST', '1000'))
+
 # Admin Configuration
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
 
-# Price Configuration
-PRICE_PER_ITEM = 6.65
\ No newline at end of file
+# Rows per request for bulk CSV imports and top-ups
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '500'))
+
+# Route Planning: a JSON file of {campus: {stop: {stop: metres}}} (stops are cafe names and
+# block numbers); pairs it does not list are estimated from the spacing between block numbers
+ROUTE_DISTANCES_PATH = os.getenv('ROUTE_DISTANCES_PATH', 'distances.json')
+BLOCK_SPACING = float(os.getenv('BLOCK_SPACING', '80'))
+ROUTE_DEFAULT_DISTANCE = float(os.getenv('ROUTE_DEFAULT_DISTANCE', '400'))
+
+# Balance Ledger: seconds between folding the ledger into per-user snapshots
+LEDGER_SNAPSHOT_INTERVAL = float(os.getenv('LEDGER_SNAPSHOT_INTERVAL', '3600'))
+
+# Price Configuration (used for cafes without a menu in menu_items)
+PRICE_PER_ITEM = 6.65
+MENU_RELOAD_INTERVAL = float(os.getenv('MENU_RELOAD_INTERVAL', '60'))
+
+# Order History and Reports
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '5'))
+REPORT_DEFAULT_DAYS = int(os.getenv('REPORT_DEFAULT_DAYS', '7'))
+# Bearer token for the /stats JSON route; the route is disabled while empty
+STATS_TOKEN = os.getenv('STATS_TOKEN', '')
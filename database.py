@@ -1,10 +1,22 @@
-from supabase import create_client, Client
+import asyncio
+import logging
 import config
-from typing import Optional, Dict, List
+from metrics import timed_db, DB_ERRORS, DB_REFUSED
+from breaker import CircuitBreaker, CircuitOpenError, UNAVAILABLE_ERRORS
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
+
+# supabase pulls in postgrest, realtime, storage and auth; import it only once a client is created
+if TYPE_CHECKING:
+    from supabase import Client, AsyncClient
+
+logger = logging.getLogger(__name__)
 
 class Database:
-    def __init__(self):
-        self.client: Client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+    def __init__(self, client: Optional["Client"] = None):
+        if client is None:
+            from supabase import create_client
+            client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+        self.client: "Client" = client
     
     def is_user_authorized(self, user_id: int) -> bool:
         """Check if user is authorized (either in database or is admin)"""
@@ -17,27 +29,25 @@ class Database:
             response = self.client.table('users').select('*').eq('telegram_id', user_id).execute()
             return len(response.data) > 0
         except Exception as e:
-            print(f"Error checking user authorization: {e}")
+            logger.error(f"Error checking user authorization: {e}")
             return False
     
     def get_user_balance(self, user_id: int) -> float:
-        """Get user balance"""
+        """Get user balance (latest snapshot plus the ledger after it)"""
         try:
-            response = self.client.table('users').select('balance').eq('telegram_id', user_id).execute()
-            if response.data:
-                return response.data[0]['balance']
-            return 0.0
+            response = self.client.rpc('user_balance', {'p_user': user_id}).execute()
+            return float(response.data or 0.0)
         except Exception as e:
-            print(f"Error getting user balance: {e}")
+            logger.error(f"Error getting user balance: {e}")
             return 0.0
     
     def update_user_balance(self, user_id: int, amount: float) -> bool:
-        """Update user balance"""
+        """Set user balance by recording the difference in the ledger"""
         try:
-            response = self.client.table('users').update({'balance': amount}).eq('telegram_id', user_id).execute()
+            self.client.rpc('set_balance', {'p_user': user_id, 'p_balance': amount}).execute()
             return True
         except Exception as e:
-            print(f"Error updating user balance: {e}")
+            logger.error(f"Error updating user balance: {e}")
             return False
     
     def add_user(self, telegram_id: int, name: str, initial_balance: float = 0.0) -> tuple[bool, str]:
@@ -48,20 +58,20 @@ class Database:
                 'name': name,
                 'balance': initial_balance
             }
-            response = self.client.table('users').insert(data).execute()
+            self.client.table('users').insert(data).execute()
             return True, ""
         except Exception as e:
             error_msg = str(e)
-            print(f"Error adding user: {error_msg}")
+            logger.error(f"Error adding user: {error_msg}")
             return False, error_msg
     
     def create_order(self, order_data: Dict) -> bool:
         """Create new order"""
         try:
-            response = self.client.table('orders').insert(order_data).execute()
+            self.client.table('orders').insert(order_data).execute()
             return True
         except Exception as e:
-            print(f"Error creating order: {e}")
+            logger.error(f"Error creating order: {e}")
             return False
     
     def get_next_order_number(self) -> int:
@@ -72,5 +82,368 @@ class Database:
                 return response.data[0]['order_number'] + 1
             return 1000
         except Exception as e:
-            print(f"Error getting next order number: {e}")
+            logger.error(f"Error getting next order number: {e}")
             return 1000
+
+
+class DatabaseUnavailable(Exception):
+    """Supabase gave no answer: the call timed out, could not connect or the circuit is open.
+
+    Unlike an error response, this says nothing about whether a write was
+    committed, so a write that fails this way has to be retried idempotently.
+    """
+
+
+class AsyncDatabase:
+    """Non-blocking variant of Database built on the async Supabase client.
+
+    All handlers share one client, and with it one pooled httpx connection to
+    PostgREST. The client is created by get_client(), which the bot calls from
+    its post_init hook, so importing this module stays cheap.
+    """
+
+    def __init__(self, client: Optional["AsyncClient"] = None):
+        self._client: Optional["AsyncClient"] = client
+        self._client_lock = asyncio.Lock()
+        # Requests allowed in flight at once; callers queue here when the pool is busy
+        self._slots = asyncio.Semaphore(config.DB_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker('supabase')
+
+    async def get_client(self) -> "AsyncClient":
+        """Return the shared client, creating it on first use"""
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    from supabase import acreate_client, AsyncClientOptions
+                    options = AsyncClientOptions(postgrest_client_timeout=config.DB_TIMEOUT)
+                    self._client = await acreate_client(config.SUPABASE_URL, config.SUPABASE_KEY, options)
+        return self._client
+
+    async def _execute(self, query):
+        """Run a PostgREST query once a connection slot is free, failing fast while Supabase is down"""
+        async with self._slots:
+            return await self.breaker.call(query.execute, config.DB_TIMEOUT)
+
+    def _report_error(self, method: str, action: str, error):
+        """Log a failed call and count it in the metrics"""
+        if isinstance(error, CircuitOpenError):
+            # Refused without calling Supabase; the failures that opened the circuit were logged already
+            DB_REFUSED.inc(method)
+            logger.debug(f"Error {action}: {error}", extra={'method': method})
+            return
+        DB_ERRORS.inc(method)
+        logger.error(f"Error {action}: {error}", extra={'method': method})
+
+    async def close(self):
+        """Close the pooled connection"""
+        if self._client is not None:
+            await self._client.postgrest.aclose()
+            self._client = None
+
+    @timed_db
+    async def is_user_authorized(self, user_id: int) -> Optional[bool]:
+        """Check if user is authorized (either in database or is admin) - None if the check failed"""
+        if user_id in config.ADMIN_IDS:
+            return True
+
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.table('users').select('telegram_id').eq('telegram_id', user_id).limit(1))
+            return len(response.data) > 0
+        except Exception as e:
+            self._report_error('is_user_authorized', "checking user authorization", e)
+            return None
+
+    @timed_db
+    async def get_user_balance(self, user_id: int) -> Optional[float]:
+        """Get user balance (latest snapshot plus the ledger after it) - None if it could not be read"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('user_balance', {'p_user': user_id}))
+            return float(response.data or 0.0)
+        except Exception as e:
+            self._report_error('get_user_balance', "getting user balance", e)
+            return None
+
+    @timed_db
+    async def update_user_balance(self, user_id: int, amount: float) -> bool:
+        """Set user balance by recording the difference in the ledger"""
+        try:
+            client = await self.get_client()
+            await self._execute(client.rpc('set_balance', {'p_user': user_id, 'p_balance': amount}))
+            return True
+        except Exception as e:
+            self._report_error('update_user_balance', "updating user balance", e)
+            return False
+
+    @timed_db
+    async def add_user(self, telegram_id: int, name: str, initial_balance: float = 0.0) -> tuple[bool, str]:
+        """Add new user - returns (success, error_message)"""
+        try:
+            data = {
+                'telegram_id': telegram_id,
+                'name': name,
+                'balance': initial_balance
+            }
+            client = await self.get_client()
+            await self._execute(client.table('users').insert(data))
+            return True, ""
+        except Exception as e:
+            error_msg = str(e)
+            self._report_error('add_user', "adding user", error_msg)
+            return False, error_msg
+
+    async def _bulk_rpc(self, method: str, action: str, function: str, chunk: List[Dict]) -> Tuple[list, List[tuple[int, str]]]:
+        """Call a bulk RPC on a chunk of rows - returns (data of each call that went through, failed rows).
+
+        One bad row makes the database reject the whole chunk, so a rejected
+        chunk is retried row by row and only the bad rows fail. If the
+        database could not be reached, every row of the chunk fails.
+        """
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc(function, {'p_rows': chunk}))
+            return [response.data], []
+        except Exception as e:
+            self._report_error(method, action, e)
+            if len(chunk) == 1 or isinstance(e, UNAVAILABLE_ERRORS + (CircuitOpenError,)):
+                return [], [(row['telegram_id'], str(e)) for row in chunk]
+        results, failures = [], []
+        for row in chunk:
+            data, failed = await self._bulk_rpc(method, action, function, [row])
+            results.extend(data)
+            failures.extend(failed)
+        return results, failures
+
+    @timed_db
+    async def bulk_upsert_users(self, rows: List[Dict], chunk_size: int = None) -> List[tuple[int, str]]:
+        """Insert or update users and set their balances in chunks - returns (telegram_id, error) for failed rows"""
+        chunk_size = chunk_size or config.BULK_CHUNK_SIZE
+        failures = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            _, failed = await self._bulk_rpc('bulk_upsert_users', "upserting users", 'upsert_users', chunk)
+            failures.extend(failed)
+        return failures
+
+    @timed_db
+    async def bulk_adjust_balances(self, adjustments: List[Dict], chunk_size: int = None) -> List[tuple[int, str]]:
+        """Add amounts to user balances in chunks - returns (telegram_id, error) for failed rows"""
+        chunk_size = chunk_size or config.BULK_CHUNK_SIZE
+        failures = []
+        for start in range(0, len(adjustments), chunk_size):
+            chunk = adjustments[start:start + chunk_size]
+            results, failed = await self._bulk_rpc('bulk_adjust_balances', "adjusting balances", 'adjust_balances', chunk)
+            failures.extend(failed)
+            # adjust_balances returns the ids it updated; the rest are not registered
+            updated = {telegram_id for data in results for telegram_id in data or []}
+            updated.update(telegram_id for telegram_id, _ in failed)
+            failures.extend((row['telegram_id'], "user not found")
+                            for row in chunk if row['telegram_id'] not in updated)
+        return failures
+
+    @timed_db
+    async def create_order(self, order_data: Dict) -> bool:
+        """Create new order"""
+        try:
+            client = await self.get_client()
+            await self._execute(client.table('orders').insert(order_data))
+            return True
+        except Exception as e:
+            self._report_error('create_order', "creating order", e)
+            return False
+
+    @timed_db
+    async def place_order(self, order_data: Dict) -> Optional[Dict]:
+        """Check balance, debit it and insert the order in one round-trip.
+
+        Returns {'success', 'balance', 'order_number'}, where success is False
+        when the balance is insufficient, or None if the database rejected the
+        call. Raises DatabaseUnavailable if it gave no answer, in which case
+        the order may or may not have been placed.
+        """
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('place_order', {'p_order': order_data}))
+            return response.data
+        except UNAVAILABLE_ERRORS + (CircuitOpenError,) as e:
+            self._report_error('place_order', "placing order", e)
+            raise DatabaseUnavailable(str(e)) from e
+        except Exception as e:
+            self._report_error('place_order', "placing order", e)
+            return None
+
+    @timed_db
+    async def refund_order(self, order_number: int, note: Optional[str] = None) -> tuple[Optional[Dict], str]:
+        """Credit an order's price back - returns ({'telegram_id', 'balance'} or None, error_message)"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('refund_order', {'p_order_number': order_number, 'p_note': note}))
+            if not response.data:
+                return None, "order not found or already refunded"
+            return response.data, ""
+        except Exception as e:
+            self._report_error('refund_order', "refunding order", e)
+            return None, str(e)
+
+    @timed_db
+    async def snapshot_balances(self) -> Optional[int]:
+        """Fold the ledger into per-user balance snapshots - returns how many users were updated"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('snapshot_balances'))
+            return response.data
+        except Exception as e:
+            self._report_error('snapshot_balances', "snapshotting balances", e)
+            return None
+
+    @timed_db
+    async def reconcile_ledger(self, repair: bool = False) -> Optional[List[Dict]]:
+        """Check the ledger against snapshots and orders - returns the discrepancies found"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('reconcile_ledger', {'p_repair': repair}))
+            return response.data
+        except Exception as e:
+            self._report_error('reconcile_ledger', "reconciling ledger", e)
+            return None
+
+    @timed_db
+    async def get_order_history(self, user_id: int, limit: int, before: Optional[tuple] = None) -> Optional[List[Dict]]:
+        """Get a user's orders, newest first, older than the (created_at, order_number) cursor"""
+        try:
+            params = {'p_user': user_id, 'p_limit': limit}
+            if before:
+                params['p_before_created_at'], params['p_before_order_number'] = before
+            client = await self.get_client()
+            response = await self._execute(client.rpc('order_history', params))
+            return response.data
+        except Exception as e:
+            self._report_error('get_order_history', "getting order history", e)
+            return None
+
+    @timed_db
+    async def get_order_report(self, start: str, end: str, group_by: str = 'day') -> Optional[List[Dict]]:
+        """Get order, item and revenue totals per day, cafe or channel between start and end"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(
+                client.rpc('order_report', {'p_from': start, 'p_to': end, 'p_group': group_by})
+            )
+            return response.data
+        except Exception as e:
+            self._report_error('get_order_report', "getting order report", e)
+            return None
+
+    @timed_db
+    async def get_orders_since(self, start: str, limit: int = 10000) -> Optional[List[Dict]]:
+        """Get the orders placed since start, oldest first, with the fields route planning needs"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(
+                client.table('orders')
+                .select('order_number, cafe, gender, time, place, channel, created_at')
+                .gte('created_at', start)
+                .order('order_number')
+                .limit(limit)
+            )
+            return response.data
+        except Exception as e:
+            self._report_error('get_orders_since', "getting orders", e)
+            return None
+
+    @timed_db
+    async def get_order_rollup(self, start_day: str, end_day: str) -> Optional[List[Dict]]:
+        """Get the precomputed totals per day, channel, cafe and meal slot between two dates (inclusive)"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(
+                client.table('order_rollup')
+                .select('day, channel, cafe, meal_slot, orders, items, revenue')
+                .gte('day', start_day)
+                .lte('day', end_day)
+                .order('day')
+            )
+            return response.data
+        except Exception as e:
+            self._report_error('get_order_rollup', "getting order rollup", e)
+            return None
+
+    @timed_db
+    async def rebuild_order_rollup(self, since: Optional[str] = None) -> Optional[int]:
+        """Recompute the rollup from the orders table - returns the number of rollup rows written"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('rebuild_order_rollup', {'p_since': since}))
+            return response.data
+        except Exception as e:
+            self._report_error('rebuild_order_rollup', "rebuilding order rollup", e)
+            return None
+
+    @timed_db
+    async def get_menu_items(self) -> Optional[List[Dict]]:
+        """Get every available menu item"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.table('menu_items').select('cafe, name, aliases, price').eq('available', True))
+            return response.data
+        except Exception as e:
+            self._report_error('get_menu_items', "getting menu items", e)
+            return None
+
+    @timed_db
+    async def get_menu_version(self) -> Optional[str]:
+        """Get a token that changes whenever menu_items changes"""
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('menu_version'))
+            return response.data
+        except Exception as e:
+            self._report_error('get_menu_version', "getting menu version", e)
+            return None
+
+    @timed_db
+    async def reserve_order_numbers(self) -> Optional[Tuple[int, int]]:
+        """Reserve a block of order numbers on the server - returns its first number and size.
+
+        Raises DatabaseUnavailable if Supabase gave no answer.
+        """
+        try:
+            client = await self.get_client()
+            response = await self._execute(client.rpc('reserve_order_numbers'))
+            block = response.data[0] if isinstance(response.data, list) else response.data
+            return int(block['start']), int(block['size'])
+        except UNAVAILABLE_ERRORS + (CircuitOpenError,) as e:
+            self._report_error('reserve_order_numbers', "reserving order numbers", e)
+            raise DatabaseUnavailable(str(e)) from e
+        except Exception as e:
+            self._report_error('reserve_order_numbers', "reserving order numbers", e)
+            return None
+
+
+class OrderNumberAllocator:
+    """Hands out order numbers from blocks reserved with one round-trip each.
+
+    The server says how big each block is (the INCREMENT BY of
+    order_number_seq), which is what keeps blocks handed to different
+    instances from overlapping.
+    """
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def next(self) -> Optional[int]:
+        """Return the next unused order number, or None if none could be reserved"""
+        async with self._lock:
+            if self._next >= self._end:
+                block = await self.db.reserve_order_numbers()
+                if block is None:
+                    return None
+                start, size = block
+                self._next, self._end = start, start + size
+            number = self._next
+            self._next += 1
+            return number
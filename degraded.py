@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import config
+from database import DatabaseUnavailable
+
+logger = logging.getLogger(__name__)
+
+PENDING_ORDERS = 'pending_orders'
+
+
+class OrderOutbox:
+    """Confirmed orders that could not reach the database, kept on disk until they can.
+
+    While Supabase is down, add() stores the order in the local store. A
+    background task places the queued orders in arrival order once the
+    circuit breaker lets calls through again, and hands each result to
+    on_placed. place_order is idempotent per draft, so replaying an order
+    that did reach the database before the outage is harmless.
+    """
+
+    def __init__(self, store, db, on_placed: Callable[[Dict, Dict], Awaitable[None]],
+                 interval: Optional[float] = None):
+        self.store = store
+        self.db = db
+        self.on_placed = on_placed
+        self.interval = interval or config.ORDER_REPLAY_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, order_data: Dict):
+        """Queue an order for placing once the database is back"""
+        await self.store.save([(PENDING_ORDERS, f"{time.time_ns():020d}", order_data)])
+
+    async def replay(self) -> int:
+        """Place queued orders until one fails - returns how many were placed"""
+        async with self._lock:
+            pending = await self.store.load(PENDING_ORDERS)
+            placed = 0
+            for key in sorted(pending):
+                if not self.db.breaker.available:
+                    break
+                order_data = pending[key]
+                try:
+                    result = await self.db.place_order(order_data)
+                except DatabaseUnavailable:
+                    break
+                if result is None:
+                    break
+                try:
+                    await self.on_placed(order_data, result)
+                except Exception as e:
+                    logger.error(f"Error handling replayed order: {e}")
+                await self.store.save([(PENDING_ORDERS, key, None)])
+                placed += 1
+            if placed:
+                logger.info(f"Placed {placed} of {len(pending)} queued orders")
+            return placed
+
+    async def _replay_loop(self):
+        while True:
+            try:
+                await self.replay()
+            except Exception as e:
+                logger.error(f"Error replaying queued orders: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Place anything left from before a restart, then keep retrying in the background"""
+        self._task = asyncio.create_task(self._replay_loop(), name="order-replay")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import config
+from dispatch import ChannelDispatcher
+from utils import meal_slot, parse_block
+
+logger = logging.getLogger(__name__)
+
+DIGEST = 'digest:'
+# Telegram rejects messages over 4096 characters
+MAX_DIGEST_TEXT = 4000
+SLOT_TITLES = {'lunch': 'ምሳ', 'dinner': 'እራት', 'other': ''}
+ENTRY_FIELDS = ('order_number', 'cafe', 'name', 'phone', 'food', 'place', 'total_items', 'total_price')
+
+
+class Digest:
+    """Orders for one channel, day and meal slot, shown together in one channel message"""
+
+    def __init__(self, digest_id: str, day: str, slot: str):
+        self.id = digest_id
+        self.day = day
+        self.slot = slot
+        self.entries: List[Tuple[str, Dict]] = []
+        self.message_id: Optional[int] = None
+        # Entries already shown in the channel message
+        self.sent = 0
+        self.closed = False
+        self.opened = time.monotonic()
+
+    def meta(self) -> Dict:
+        return {'day': self.day, 'slot': self.slot, 'message_id': self.message_id,
+                'sent': self.sent, 'closed': self.closed}
+
+
+def format_digest(channel: str, digest: Digest, entries: List[Dict]) -> str:
+    """Consolidated channel message for a digest, grouped by cafe and then by block"""
+    groups: Dict[str, Dict[str, List[Dict]]] = {}
+    for entry in entries:
+        groups.setdefault(entry['cafe'], {}).setdefault(parse_block(entry['place']), []).append(entry)
+
+    total = sum(float(entry['total_price']) for entry in entries)
+    lines = [f"📦 {SLOT_TITLES.get(digest.slot, '')} ትዕዛዞች • {channel} • {digest.day}".replace('  ', ' '),
+             f"🔢 {len(entries)} ትዕዛዞች • 💰 {total:.2f} ETB"]
+    for cafe in sorted(groups):
+        lines.append(f"\n👩‍🍳 {cafe}")
+        for block in sorted(groups[cafe], key=lambda block: (not block.isdigit(), block.zfill(6))):
+            lines.append(f"🏢 Block {block}")
+            for entry in groups[cafe][block]:
+                lines.append(
+                    f"  #{entry['order_number']} {entry['name']} ☎️{entry['phone']}\n"
+                    f"     🍜{entry['food']} ({entry['total_items']}) • {entry['place']} • "
+                    f"{float(entry['total_price']):.2f} ETB"
+                )
+    return "\n".join(lines)
+
+
+class DigestDispatcher(ChannelDispatcher):
+    """Posts orders to each channel as consolidated digests instead of one message each.
+
+    The first order for a channel, day and meal slot opens a digest. It is
+    posted once DIGEST_WINDOW seconds have passed or DIGEST_MAX_ORDERS orders
+    are in it. Later orders are added by editing that message, until it is
+    full and the next order opens a new digest. Edits are rate limited like
+    posts, so orders arriving while one is pending go out in the next edit.
+    Digests and their orders are kept in the store until they are full and
+    delivered, so a restart picks up where it left off.
+    """
+
+    def __init__(self, bot, store, channels: Optional[Dict[str, str]] = None,
+                 window: Optional[float] = None, max_orders: Optional[int] = None):
+        super().__init__(bot, store, channels)
+        self.window = config.DIGEST_WINDOW if window is None else window
+        self.max_orders = max_orders or config.DIGEST_MAX_ORDERS
+        self.digests: Dict[str, List[Digest]] = {name: [] for name in self.channels}
+        self.changed = {name: asyncio.Event() for name in self.channels}
+
+    async def start(self):
+        """Restore open digests, then start the digest and plain post workers"""
+        for name in self.channels:
+            await self._restore(name)
+            self._workers.append(asyncio.create_task(self._digest_worker(name), name=f"digest:{name}"))
+        await super().start()
+
+    async def _restore(self, channel: str):
+        stored = await self.store.load(DIGEST + channel)
+        digests = {}
+        for key in sorted(key for key in stored if key.startswith('m:')):
+            meta = stored[key]
+            digest = Digest(key[2:], meta['day'], meta['slot'])
+            digest.message_id, digest.sent, digest.closed = meta['message_id'], meta['sent'], meta['closed']
+            digests[digest.id] = digest
+        for key in sorted(key for key in stored if key.startswith('e:')):
+            digest = digests.get(stored[key]['digest'])
+            if digest:
+                digest.entries.append((key, stored[key]['entry']))
+        self.digests[channel] = list(digests.values())
+        if digests:
+            logger.info(f"Restored {len(digests)} digests for {channel}")
+            self.changed[channel].set()
+
+    async def post_order(self, channel: str, order_data: Dict) -> bool:
+        """Add an order to the channel's open digest - returns False if the channel is not configured"""
+        if channel not in self.digests:
+            return False
+        day = str(order_data.get('created_at') or date.today().isoformat())[:10]
+        slot = meal_slot(order_data.get('time') or '')
+        entry = {field: order_data.get(field) for field in ENTRY_FIELDS}
+        namespace = DIGEST + channel
+
+        changes = []
+        digest = None
+        for candidate in self.digests[channel]:
+            if candidate.closed:
+                continue
+            if candidate.day != day:
+                # Yesterday's digests never get new orders
+                candidate.closed = True
+                changes.append((namespace, 'm:' + candidate.id, candidate.meta()))
+            elif candidate.slot == slot:
+                digest = candidate
+        if digest is not None:
+            text = format_digest(channel, digest, [e for _, e in digest.entries] + [entry])
+            if len(text) > MAX_DIGEST_TEXT:
+                digest.closed = True
+                changes.append((namespace, 'm:' + digest.id, digest.meta()))
+                digest = None
+        if digest is None:
+            digest = Digest(f"{time.time_ns():020d}", day, slot)
+            self.digests[channel].append(digest)
+
+        key = f"e:{time.time_ns():020d}"
+        digest.entries.append((key, entry))
+        if len(digest.entries) >= self.max_orders:
+            digest.closed = True
+        changes.append((namespace, key, {'digest': digest.id, 'entry': entry}))
+        changes.append((namespace, 'm:' + digest.id, digest.meta()))
+        self.changed[channel].set()
+        try:
+            await self.store.save(changes)
+        except Exception as e:
+            # The order is in the digest and will be posted; it just won't survive a restart
+            logger.error(f"Error saving the {channel} digest: {e}")
+        return True
+
+    async def _next_due(self, channel: str) -> Digest:
+        """Wait for a digest with orders that still need to be shown, and return it"""
+        while True:
+            self.changed[channel].clear()
+            now = time.monotonic()
+            timeout = None
+            for digest in list(self.digests[channel]):
+                if digest.sent >= len(digest.entries):
+                    if digest.closed:
+                        await self._retire(channel, digest)
+                    continue
+                if digest.message_id is not None or digest.closed:
+                    return digest
+                wait = digest.opened + self.window - now
+                if wait <= 0:
+                    return digest
+                timeout = wait if timeout is None else min(timeout, wait)
+            try:
+                await asyncio.wait_for(self.changed[channel].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _digest_worker(self, channel: str):
+        chat_id = self.channels[channel]
+        while True:
+            digest = await self._next_due(channel)
+            count = len(digest.entries)
+            text = format_digest(channel, digest, [entry for _, entry in digest.entries[:count]])
+            if digest.message_id is None:
+                message = await self._send(channel, self.bot.send_message, chat_id=chat_id, text=text)
+                if message is None:
+                    # Dropped: the orders have not been shown, so keep the digest and post it again later
+                    logger.warning(f"Digest for {channel} was not posted, retrying in {config.DISPATCH_MAX_BACKOFF}s")
+                    await asyncio.sleep(config.DISPATCH_MAX_BACKOFF)
+                    continue
+                digest.message_id = message.message_id
+            else:
+                await self._send(channel, self.bot.edit_message_text,
+                                 chat_id=chat_id, message_id=digest.message_id, text=text)
+            digest.sent = count
+            if digest.closed and digest.sent >= len(digest.entries):
+                await self._retire(channel, digest)
+            else:
+                await self.store.save([(DIGEST + channel, 'm:' + digest.id, digest.meta())])
+
+    async def _retire(self, channel: str, digest: Digest):
+        """Forget a full, delivered digest"""
+        self.digests[channel].remove(digest)
+        namespace = DIGEST + channel
+        await self.store.save(
+            [(namespace, key, None) for key, _ in digest.entries] + [(namespace, 'm:' + digest.id, None)]
+        )
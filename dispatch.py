@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+
+import config
+from metrics import CHANNEL_POST_LATENCY, CHANNEL_POST_ERRORS
+
+logger = logging.getLogger(__name__)
+
+OUTBOX = 'outbox:'
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per `period` seconds, with bursts up to `rate`"""
+
+    def __init__(self, rate: float, period: float):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+
+class ChannelDispatcher:
+    """Posts messages to the order channels from one background worker per channel.
+
+    post() stores the message in a durable outbox and returns right away, so
+    handlers never wait on Telegram. Each worker sends its channel's messages
+    in order within the per-chat and global rate limits, retries transient
+    failures with exponential backoff and removes a message from the outbox
+    only once it was delivered. Messages still in the outbox are re-queued
+    on the next start.
+    """
+
+    def __init__(self, bot, store, channels: Optional[Dict[str, str]] = None):
+        self.bot = bot
+        self.store = store
+        channels = channels or config.CHANNELS
+        self.channels = {name: chat_id for name, chat_id in channels.items() if chat_id}
+        missing = sorted(set(channels) - set(self.channels))
+        if missing:
+            logger.warning(f"No chat id configured for {', '.join(missing)}; orders for these channels will not be posted")
+        self.queues: Dict[str, asyncio.Queue] = {name: asyncio.Queue() for name in self.channels}
+        self.channel_limiters = {
+            name: RateLimiter(config.CHANNEL_POSTS_PER_MINUTE, 60) for name in self.channels
+        }
+        self.global_limiter = RateLimiter(config.GLOBAL_POSTS_PER_SECOND, 1)
+        self._workers = []
+
+    async def start(self):
+        """Re-queue undelivered messages and start the workers"""
+        for name, queue in self.queues.items():
+            pending = await self.store.load(OUTBOX + name)
+            for key in sorted(pending):
+                queue.put_nowait((key, pending[key]['text']))
+            if pending:
+                logger.info(f"Re-queued {len(pending)} undelivered posts for {name}")
+            self._workers.append(asyncio.create_task(self._worker(name), name=f"dispatch:{name}"))
+
+    async def stop(self):
+        """Stop the workers; undelivered messages stay in the outbox"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def post(self, channel: str, text: str) -> bool:
+        """Queue a message for a channel - returns False if the channel is not configured"""
+        if channel not in self.queues:
+            return False
+        key = f"{time.time_ns():020d}"
+        try:
+            await self.store.save([(OUTBOX + channel, key, {'text': text})])
+        except Exception as e:
+            # The order is already paid for: post it anyway, it just won't survive a restart
+            logger.error(f"Error saving a post to {channel} in the outbox: {e}")
+        self.queues[channel].put_nowait((key, text))
+        return True
+
+    async def _worker(self, channel: str):
+        queue = self.queues[channel]
+        while True:
+            key, text = await queue.get()
+            await self._deliver(channel, text)
+            try:
+                await self.store.save([(OUTBOX + channel, key, None)])
+            except Exception as e:
+                # Delivered, but still in the outbox: it will be posted again after a restart
+                logger.error(f"Error removing a delivered post to {channel} from the outbox: {e}")
+            queue.task_done()
+
+    async def _deliver(self, channel: str, text: str):
+        await self._send(channel, self.bot.send_message, chat_id=self.channels[channel], text=text)
+
+    async def _send(self, channel: str, method, **kwargs):
+        """Call a Bot method for a channel within the rate limits - returns its result, or None if dropped"""
+        attempt = 0
+        while True:
+            await self.channel_limiters[channel].acquire()
+            await self.global_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                result = await method(**kwargs)
+                CHANNEL_POST_LATENCY.observe(time.perf_counter() - started, channel)
+                return result
+            except RetryAfter as e:
+                CHANNEL_POST_ERRORS.inc(channel)
+                logger.warning(f"Flood limit on {channel}, retrying in {e.retry_after}s")
+                await asyncio.sleep(float(e.retry_after))
+            except (TimedOut, NetworkError) as e:
+                CHANNEL_POST_ERRORS.inc(channel)
+                delay = min(config.DISPATCH_MAX_BACKOFF, 2 ** attempt)
+                attempt += 1
+                logger.warning(f"Posting to {channel} failed ({e}), retry {attempt} in {delay}s")
+                await asyncio.sleep(delay)
+            except TelegramError as e:
+                CHANNEL_POST_ERRORS.inc(channel)
+                # Bad request, missing rights, unknown chat: retrying will not help
+                logger.error(f"Dropping post to {channel}: {e}")
+                return None
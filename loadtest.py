@@ -0,0 +1,280 @@
+# === LOAD TEST (run with: python loadtest.py --users 2000 --db-latency 0.02) ===
+# Drives the full ordering conversation through the real handlers, against a
+# fake Telegram Bot API and an in-memory database with injected latency.
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import config
+import bot
+from breaker import CircuitBreaker
+from cache import CachedDatabase
+from database import OrderNumberAllocator
+from storage import SQLiteStore
+from metrics import THROTTLED_UPDATES
+from throttle import RateLimiter
+
+FLOOD_MESSAGES = 50
+# INCREMENT BY of the in-memory order_number_seq
+ORDER_NUMBER_BLOCK = 20
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'CampusDeliveryBot', 'username': 'campus_delivery_bot'}
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls locally, after an optional simulated round-trip"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            chat_id = params.get('chat_id', 0)
+            result = {
+                'message_id': params.get('message_id', self._message_id),
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class MemoryDatabase:
+    """In-memory stand-in for AsyncDatabase, with injected latency per round-trip"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.users: Dict[int, dict] = {}
+        self.orders: List[dict] = []
+        self.sequence = 1000
+        self.round_trips = 0
+        self.breaker = CircuitBreaker('memory')
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def close(self):
+        pass
+
+    async def is_user_authorized(self, user_id: int) -> bool:
+        if user_id in config.ADMIN_IDS:
+            return True
+        await self._round_trip()
+        return user_id in self.users
+
+    async def get_user_balance(self, user_id: int) -> float:
+        await self._round_trip()
+        return self.users.get(user_id, {}).get('balance', 0.0)
+
+    async def update_user_balance(self, user_id: int, amount: float) -> bool:
+        await self._round_trip()
+        if user_id in self.users:
+            self.users[user_id]['balance'] = amount
+        return True
+
+    async def add_user(self, telegram_id: int, name: str, initial_balance: float = 0.0) -> tuple[bool, str]:
+        await self._round_trip()
+        if telegram_id in self.users:
+            return False, "duplicate key value violates unique constraint"
+        self.users[telegram_id] = {'telegram_id': telegram_id, 'name': name, 'balance': initial_balance}
+        return True, ""
+
+    async def create_order(self, order_data: Dict) -> bool:
+        await self._round_trip()
+        self.orders.append(dict(order_data))
+        return True
+
+    async def place_order(self, order_data: Dict) -> Optional[Dict]:
+        await self._round_trip()
+        key = order_data.get('idempotency_key')
+        for order in self.orders:
+            if key and order.get('idempotency_key') == key:
+                balance = self.users[order['user_telegram_id']]['balance']
+                return {'success': True, 'balance': balance, 'order_number': order['order_number'], 'duplicate': True}
+        user = self.users.get(order_data['user_telegram_id'])
+        if user is None or user['balance'] < order_data['total_price']:
+            return {'success': False, 'balance': user['balance'] if user else 0.0, 'order_number': None}
+        user['balance'] -= order_data['total_price']
+        self.orders.append(dict(order_data))
+        return {'success': True, 'balance': user['balance'], 'order_number': order_data['order_number']}
+
+    async def reserve_order_numbers(self) -> Optional[Tuple[int, int]]:
+        await self._round_trip()
+        start = self.sequence
+        self.sequence += ORDER_NUMBER_BLOCK
+        return start, ORDER_NUMBER_BLOCK
+
+
+class Customer:
+    """Builds the updates one user sends while placing an order.
+
+    Without an application the updates are returned as raw Bot API dicts,
+    e.g. to send them to another process.
+    """
+
+    def __init__(self, user_id: int, application: Optional[Application] = None):
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+        self.chat = {'id': user_id, 'type': 'private'}
+        self.bot = application.bot if application else None
+        self.update_id = user_id * 100
+
+    def _update(self, data: dict):
+        return data if self.bot is None else Update.de_json(data, self.bot)
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, text: str) -> Update:
+        data = {'message_id': self._next_id(), 'date': int(time.time()), 'chat': self.chat,
+                'from': self.user, 'text': text}
+        if text.startswith('/'):
+            data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self._update({'update_id': self.update_id, 'message': data})
+
+    def press(self, callback_data: str) -> Update:
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': self.chat, 'from': BOT_USER, 'text': '...'}
+        query = {'id': str(self._next_id()), 'from': self.user, 'chat_instance': str(self.user['id']),
+                 'message': message, 'data': callback_data}
+        return self._update({'update_id': self.update_id, 'callback_query': query})
+
+    def conversation(self) -> List[Update]:
+        """start → cafe → order_now → name … place (everything before confirm)"""
+        return [
+            self.message('/start'),
+            self.press('contract_user'),
+            self.press('ሸዊት'),
+            self.press('order_now'),
+            self.message('Abebe Kebede'),
+            self.message('M'),
+            self.message('0911000000'),
+            self.message('ምሳ'),
+            self.message('2 ሽሮ እና 1 ፓስታ'),
+            self.message('Main: Block 12'),
+        ]
+
+
+async def create_application(db_latency: float, api_latency: float, users: int) -> Application:
+    """Build an Application wired to the fake Bot API and a fresh in-memory database"""
+    memory_db = MemoryDatabase(db_latency)
+    for i in range(users):
+        memory_db.users[user_id_for(i)] = {'telegram_id': user_id_for(i), 'name': f'User{i}', 'balance': 1000.0}
+    bot.db = CachedDatabase(memory_db)
+    bot.order_numbers = OrderNumberAllocator(bot.db)
+
+    # Measure what the bot can handle, not the configured global ceiling; per-user limits stay on
+    bot.throttle.everyone = RateLimiter(0, 0)
+
+    fake_api = FakeBotAPI(api_latency)
+    application = Application.builder().token('123:loadtest').request(fake_api).get_updates_request(fake_api).build()
+    bot.setup_handlers(application)
+    await application.initialize()
+    dispatcher_class = bot.DigestDispatcher if config.DIGEST_MODE else bot.ChannelDispatcher
+    # Every channel gets a chat id, so the fake Bot API receives the posts
+    channels = {name: -1000 - index for index, name in enumerate(config.CHANNELS)}
+    bot.channel_dispatcher = dispatcher_class(application.bot, SQLiteStore(':memory:'), channels)
+    await bot.channel_dispatcher.start()
+    return application
+
+
+def user_id_for(i: int) -> int:
+    return 10_000_000 + i
+
+
+async def drive(application: Application, updates: List[Update], latencies: List[float]):
+    for update in updates:
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+
+async def measure_memory(args) -> float:
+    """Bytes allocated per conversation left waiting at the confirm step"""
+    users = min(args.users, 500)
+    application = await create_application(0.0, 0.0, users)
+    customers = [Customer(user_id_for(i), application) for i in range(users)]
+    flows = [customer.conversation() for customer in customers]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    await asyncio.gather(*(drive(application, flow, []) for flow in flows))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    await bot.channel_dispatcher.stop()
+    await application.shutdown()
+    return (after - before) / users
+
+
+async def run(args):
+    config.CHANNELS = {name: str(-1000 - i) for i, name in enumerate(config.CHANNELS)}
+    application = await create_application(args.db_latency, args.api_latency, args.users)
+    customers = [Customer(user_id_for(i), application) for i in range(args.users)]
+    flows = [customer.conversation() + [customer.press('confirm_order')] for customer in customers]
+    # Unregistered users hammering /start
+    flooders = [Customer(user_id_for(args.users + i), application) for i in range(args.flooders)]
+    flows += [[flooder.message('/start') for _ in range(FLOOD_MESSAGES)] for flooder in flooders]
+
+    latencies: List[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(application, flow, latencies) for flow in flows))
+    elapsed = time.perf_counter() - started
+
+    memory_db = bot.db.db
+    await bot.channel_dispatcher.stop()
+    await application.shutdown()
+
+    cuts = statistics.quantiles(latencies, n=100)
+    print(f"Users: {args.users}, DB latency: {args.db_latency * 1000:.0f} ms, "
+          f"Bot API latency: {args.api_latency * 1000:.0f} ms")
+    print(f"Updates: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} updates/s)")
+    print(f"Handler latency p50/p95/p99: {cuts[49] * 1000:.1f} / {cuts[94] * 1000:.1f} / {cuts[98] * 1000:.1f} ms")
+    print(f"Orders placed: {len(memory_db.orders)}, DB round-trips: {memory_db.round_trips}")
+    if args.flooders:
+        dropped = ', '.join(f"{reason}={count:.0f}" for (reason,), count in THROTTLED_UPDATES.values.items())
+        print(f"Flooders: {args.flooders} x {FLOOD_MESSAGES} /start, throttled: {dropped or 'none'}")
+    print(f"Memory per active conversation: {await measure_memory(args) / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the ordering conversation")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--db-latency', type=float, default=0.02, help="seconds per database round-trip")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument('--flooders', type=int, default=0, help=f"unregistered users sending {FLOOD_MESSAGES} /start each")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
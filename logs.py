@@ -0,0 +1,122 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+
+import config
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields of the update being handled (user_id, state, handler, order_number, ...);
+# each update runs in its own task, so each sees only its own fields
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else on a record came from extra= or bind()
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def bind(**fields) -> contextvars.Token:
+    """Add fields to every record logged from the current task"""
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token: contextvars.Token):
+    _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the bound fields onto the record, in the thread and task that logged it"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in _context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of DEBUG records; higher levels always pass"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and every extra field"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread with only the cheap work done on the caller's thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, while they still hold their current values, but
+        # leave the JSON encoding and the write to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(stream=None) -> logging.handlers.QueueListener:
+    """Route every log record through a queue to a writer thread, formatted per LOG_FORMAT"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if config.LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = ContextQueueHandler(records)
+    handler.addFilter(SamplingFilter(config.LOG_DEBUG_SAMPLE_RATE))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(config.LOG_LEVEL)
+    # Per-request httpx lines would drown out everything else
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Write out whatever is still queued and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import re
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import config
+from utils import QUANTITY, extract_numbers_from_text
+
+logger = logging.getLogger(__name__)
+
+QUANTITY_AFTER = re.compile(r'\s*[x×]?\s*' + QUANTITY.pattern)
+# A quantity left over by parse(), with the word written after it
+UNMATCHED = re.compile(r'\d+\s*\S*')
+
+
+class MenuItem(NamedTuple):
+    name: str
+    price: float
+
+
+class LineItem(NamedTuple):
+    name: str
+    quantity: int
+    unit_price: float
+
+
+class AliasMatcher:
+    """Aho-Corasick automaton over item names and aliases.
+
+    find() walks the text once and returns the leftmost-longest,
+    non-overlapping alias matches as (start, end, item).
+    """
+
+    def __init__(self, aliases: Iterable[Tuple[str, MenuItem]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # For each node, the longest alias ending there: (length, item)
+        self.output: List[Optional[Tuple[int, MenuItem]]] = [None]
+
+        for alias, item in aliases:
+            alias = alias.strip().lower()
+            if not alias:
+                continue
+            node = 0
+            for char in alias:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node] = (len(alias), item)
+
+        # Breadth-first pass to fill in failure links
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.output[child] is None:
+                    self.output[child] = self._longest_output(self.fail[child])
+
+    def _longest_output(self, node: int) -> Optional[Tuple[int, MenuItem]]:
+        while node and self.output[node] is None:
+            node = self.fail[node]
+        return self.output[node] if node else None
+
+    def find(self, text: str) -> List[Tuple[int, int, MenuItem]]:
+        text = text.lower()
+        candidates = []
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            match = self.output[node]
+            if match:
+                length, item = match
+                start = position + 1 - length
+                # An alias has to start a word, but may carry a suffix
+                if start == 0 or not text[start - 1].isalpha():
+                    candidates.append((start, position + 1, item))
+
+        # Keep the leftmost-longest matches that do not overlap
+        candidates.sort(key=lambda match: (match[0], -match[1]))
+        matches = []
+        end = 0
+        for match in candidates:
+            if match[0] >= end:
+                matches.append(match)
+                end = match[1]
+        return matches
+
+
+class MenuCatalog:
+    """Per-cafe menus held in memory, reloaded when the menu_items table changes"""
+
+    def __init__(self, on_reload: Optional[Callable[[List[str]], None]] = None):
+        self.on_reload = on_reload
+        self.matchers: Dict[str, AliasMatcher] = {}
+        self.version = None
+        self._reload_task: Optional[asyncio.Task] = None
+
+    def build(self, rows: Iterable[Dict]):
+        """Rebuild the matchers from menu_items rows"""
+        aliases: Dict[str, List[Tuple[str, MenuItem]]] = {}
+        for row in rows:
+            item = MenuItem(row['name'], float(row['price']))
+            names = [row['name']] + list(row.get('aliases') or [])
+            aliases.setdefault(row['cafe'], []).extend((name, item) for name in names)
+        self.matchers = {cafe: AliasMatcher(entries) for cafe, entries in aliases.items()}
+        if self.on_reload:
+            self.on_reload(list(self.matchers))
+
+    def _parse(self, cafe: str, text: str) -> Tuple[List[LineItem], List[str]]:
+        """Line items of the order, plus every quantity that belongs to no item on the menu"""
+        matcher = self.matchers.get(cafe)
+        if matcher is None:
+            return [], []
+
+        line_items = []
+        used = set()
+        previous_end = 0
+        matches = matcher.find(text)
+        for index, (start, end, item) in enumerate(matches):
+            # The quantity is written before the item ("2 ሽሮ") or right after it ("ሽሮ 2")
+            before = list(QUANTITY.finditer(text, previous_end, start))
+            next_start = matches[index + 1][0] if index + 1 < len(matches) else len(text)
+            after = QUANTITY_AFTER.match(text, end, next_start)
+            previous_end = end
+            if before:
+                quantity = int(before[-1].group(1))
+                used.add(before[-1].start(1))
+            elif after:
+                quantity = int(after.group(1))
+                used.add(after.start(1))
+                previous_end = after.end()
+            else:
+                quantity = 1
+            line_items.append(LineItem(item.name, quantity, item.price))
+
+        unmatched = [UNMATCHED.match(text, match.start(1)).group().strip()
+                     for match in QUANTITY.finditer(text) if match.start(1) not in used]
+        return line_items, unmatched
+
+    def parse(self, cafe: str, text: str) -> List[LineItem]:
+        """Split a free-text order into priced line items, in one pass over the text"""
+        return self._parse(cafe, text)[0]
+
+    def unmatched(self, cafe: str, text: str) -> List[str]:
+        """Parts of the order, like "1 ጥብስ", whose quantity goes with no item on the cafe's menu"""
+        return self._parse(cafe, text)[1]
+
+    def price(self, cafe: str, text: str) -> Tuple[bool, int, float]:
+        """Same contract as extract_numbers_from_text, priced from the menu when the cafe has one.
+
+        An order with a quantity that matches nothing on the menu fails as a
+        whole rather than being charged for only the items that were found.
+        """
+        if cafe not in self.matchers:
+            return extract_numbers_from_text(text)
+        line_items, unmatched = self._parse(cafe, text)
+        if not line_items or unmatched:
+            return False, 0, 0.0
+        total_items = sum(line.quantity for line in line_items)
+        total_price = sum(line.quantity * line.unit_price for line in line_items)
+        return True, total_items, total_price
+
+    async def reload(self, db):
+        """Load the menu if it changed since the last load"""
+        version = await db.get_menu_version()
+        if version is None or version == self.version:
+            return
+        rows = await db.get_menu_items()
+        if rows is None:
+            return
+        self.build(rows)
+        self.version = version
+        logger.info(f"Loaded menu for {len(self.matchers)} cafes ({len(rows)} items)")
+
+    async def _reload_loop(self, db):
+        while True:
+            try:
+                await self.reload(db)
+            except Exception as e:
+                logger.error(f"Error reloading menu: {e}")
+            await asyncio.sleep(config.MENU_RELOAD_INTERVAL)
+
+    def start(self, db):
+        """Load the menu now and keep polling for changes in the background"""
+        self._reload_task = asyncio.create_task(self._reload_loop(db), name="menu-reload")
+
+    async def stop(self):
+        if self._reload_task:
+            self._reload_task.cancel()
+            await asyncio.gather(self._reload_task, return_exceptions=True)
+            self._reload_task = None
@@ -0,0 +1,230 @@
+import bisect
+import contextvars
+import functools
+import logging
+import time
+from collections import Counter as _Tally
+from typing import Callable, Dict, List, Tuple
+
+import config
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cache hit to a Supabase timeout
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Set while a timed handler runs, so a handler that calls another one is timed once
+_in_handler: contextvars.ContextVar[bool] = contextvars.ContextVar('in_handler', default=False)
+
+
+def _format_labels(label_names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self.values)
+
+    def render(self, snapshots: List[Dict] = ()) -> List[str]:
+        """Render this process's values added to those of other processes' snapshots"""
+        values = self.snapshot()
+        for snapshot in snapshots:
+            for labels, value in snapshot.items():
+                values[labels] = values.get(labels, 0) + value
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Latency histogram keyed by label values; bucket counts are kept non-cumulative"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], List[float]]:
+        # Copied in one step: /metrics runs in the Flask thread while the event loop adds series
+        return {labels: list(series) for labels, series in list(self.series.items())}
+
+    def render(self, snapshots: List[Dict] = ()) -> List[str]:
+        """Render this process's series added to those of other processes' snapshots"""
+        combined = self.snapshot()
+        for snapshot in snapshots:
+            for labels, series in snapshot.items():
+                total = combined.setdefault(labels, [0] * len(series))
+                for index, value in enumerate(series):
+                    total[index] += value
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in combined.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class ConversationStates:
+    """Tracks which ordering state each user is in, for an occupancy gauge.
+
+    Users who leave a conversation without finishing it never reach END, so
+    entries untouched for max_age seconds are dropped as well.
+    """
+
+    name = 'bot_conversations'
+
+    def __init__(self, max_age: float = 0):
+        self.max_age = max_age
+        self.by_user: Dict[int, int] = {}
+        # Last state change per user, oldest first
+        self.touched: Dict[int, float] = {}
+        self.state_names: Dict[int, str] = {}
+
+    def record(self, user_id: int, state, now: float = None):
+        if state is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.touched.pop(user_id, None)
+        if state < 0:
+            # ConversationHandler.END
+            self.by_user.pop(user_id, None)
+        else:
+            self.by_user[user_id] = state
+            self.touched[user_id] = now
+        self._expire(now)
+
+    def _expire(self, now: float):
+        if not self.max_age:
+            return
+        while self.touched:
+            user_id = next(iter(self.touched))
+            if now - self.touched[user_id] < self.max_age:
+                break
+            del self.touched[user_id]
+            self.by_user.pop(user_id, None)
+
+    def snapshot(self, now: float = None) -> Dict[str, int]:
+        """Users per state name"""
+        # Read-only: called from the Flask thread while the bot loop records
+        now = time.monotonic() if now is None else now
+        states = [self.by_user.get(user_id) for user_id, touched in list(self.touched.items())
+                  if not self.max_age or now - touched < self.max_age]
+        return {str(self.state_names.get(state, state)): count
+                for state, count in _Tally(state for state in states if state is not None).items()}
+
+    def render(self, snapshots: List[Dict] = ()) -> List[str]:
+        counts = _Tally(self.snapshot())
+        for snapshot in snapshots:
+            counts.update(snapshot)
+        lines = [f"# HELP {self.name} Users currently in each ordering conversation state",
+                 f"# TYPE {self.name} gauge"]
+        for state, count in sorted(counts.items()):
+            lines.append(f'{self.name}{{state="{state}"}} {count}')
+        return lines
+
+
+HANDLER_LATENCY = Histogram('bot_handler_latency_seconds', "Time spent in each update handler", ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Handler calls that raised", ('handler',))
+DB_LATENCY = Histogram('bot_db_latency_seconds', "Time spent in each Database method", ('method',))
+DB_ERRORS = Counter('bot_db_errors_total', "Database calls that failed", ('method',))
+DB_REFUSED = Counter('bot_db_refused_total', "Database calls refused at once while the circuit was open", ('method',))
+CHANNEL_POST_LATENCY = Histogram('bot_channel_post_latency_seconds', "Time to deliver a channel post", ('channel',))
+CHANNEL_POST_ERRORS = Counter('bot_channel_post_errors_total', "Failed channel post attempts", ('channel',))
+THROTTLED_UPDATES = Counter('bot_throttled_updates_total', "Updates dropped by the rate limits", ('reason',))
+CONVERSATIONS = ConversationStates(config.CONVERSATION_TIMEOUT)
+
+REGISTRY = [HANDLER_LATENCY, HANDLER_ERRORS, DB_LATENCY, DB_ERRORS, DB_REFUSED,
+            CHANNEL_POST_LATENCY, CHANNEL_POST_ERRORS, THROTTLED_UPDATES, CONVERSATIONS]
+
+
+def timed_handler(func: Callable) -> Callable:
+    """Time an update handler, count its errors and track the state it returns"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        if _in_handler.get():
+            return await func(update, context, *args, **kwargs)
+        user_id = update.effective_user.id if update.effective_user else None
+        state = CONVERSATIONS.by_user.get(user_id)
+        token = logs.bind(user_id=user_id, handler=name, state=CONVERSATIONS.state_names.get(state, state))
+        handling = _in_handler.set(True)
+        started = time.perf_counter()
+        try:
+            state = await func(update, context, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, name)
+            logger.debug("Handled update", extra={'duration_ms': round(elapsed * 1000, 2)})
+            _in_handler.reset(handling)
+            logs.unbind(token)
+        if isinstance(state, int) and update.effective_user:
+            CONVERSATIONS.record(update.effective_user.id, state)
+        return state
+
+    return wrapper
+
+
+def timed_db(func: Callable) -> Callable:
+    """Time a Database method"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_LATENCY.observe(elapsed, name)
+            logger.debug("Database call", extra={'method': name, 'duration_ms': round(elapsed * 1000, 2)})
+
+    return wrapper
+
+
+def snapshot() -> Dict[str, Dict]:
+    """This process's metrics as plain data, for the front process to add up (see sharding.py)"""
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+def render(snapshots: List[Dict[str, Dict]] = ()) -> str:
+    """Return every metric in the Prometheus text exposition format, summed with other processes' snapshots"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render([snapshot.get(metric.name, {}) for snapshot in snapshots]))
+    return '\n'.join(lines) + '\n'
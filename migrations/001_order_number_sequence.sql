@@ -0,0 +1,53 @@
+-- Order numbers come from a sequence instead of scanning the latest order.
+-- Each call to reserve_order_numbers() reserves a whole block of numbers for
+-- the calling bot instance and says how big the block is, so the block size
+-- is the sequence's INCREMENT BY; change it with
+--   alter sequence order_number_seq increment by <n>;
+-- Safe to run again.
+
+create sequence if not exists order_number_seq increment by 20 minvalue 1000 start with 1000;
+
+-- Never moves the sequence back over blocks that running instances still hold
+select setval(
+    'order_number_seq',
+    greatest(
+        (select coalesce(max(order_number), 999) + 1 from orders),
+        (select coalesce(last_value + increment_by, 1000) from pg_sequences
+         where schemaname = current_schema() and sequencename = 'order_number_seq')
+    ),
+    false
+);
+
+-- Orders that share a number with an earlier one get fresh numbers, so the
+-- unique constraint below can be added
+update orders
+set order_number = nextval('order_number_seq')
+where ctid in (
+    select ctid
+    from (
+        select ctid, row_number() over (partition by order_number order by created_at, ctid) as copy
+        from orders
+        where order_number is not null
+    ) numbered
+    where copy > 1
+);
+
+do $$
+begin
+    if not exists (select 1 from pg_constraint where conname = 'orders_order_number_key') then
+        alter table orders add constraint orders_order_number_key unique (order_number);
+    end if;
+end;
+$$;
+
+-- Returns the first number of the block and the block size
+drop function if exists reserve_order_numbers();
+create function reserve_order_numbers()
+returns table (start bigint, size bigint)
+language sql
+volatile
+as $$
+    select nextval('order_number_seq'), increment_by
+    from pg_sequences
+    where schemaname = current_schema() and sequencename = 'order_number_seq';
+$$;
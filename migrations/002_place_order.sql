@@ -0,0 +1,38 @@
+-- Debit the balance and insert the order in one transaction.
+-- The conditional UPDATE takes the row lock on the user, so two concurrent
+-- confirms from the same account can no longer both pass the balance check.
+
+create or replace function place_order(p_order jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders := jsonb_populate_record(null::orders, p_order);
+    v_balance numeric;
+begin
+    update users
+       set balance = balance - v_order.total_price
+     where telegram_id = v_order.user_telegram_id
+       and balance >= v_order.total_price
+    returning balance into v_balance;
+
+    if not found then
+        select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+        return jsonb_build_object('success', false, 'balance', coalesce(v_balance, 0), 'order_number', null);
+    end if;
+
+    v_order.order_number := coalesce(v_order.order_number, nextval('order_number_seq'));
+
+    insert into orders (
+        order_number, user_id, user_telegram_id, cafe, name, gender, phone,
+        time, food, place, total_items, total_price, created_at
+    ) values (
+        v_order.order_number, v_order.user_id, v_order.user_telegram_id, v_order.cafe,
+        v_order.name, v_order.gender, v_order.phone, v_order.time, v_order.food,
+        v_order.place, v_order.total_items, v_order.total_price,
+        coalesce(v_order.created_at, now())
+    );
+
+    return jsonb_build_object('success', true, 'balance', v_balance, 'order_number', v_order.order_number);
+end;
+$$;
@@ -0,0 +1,8 @@
+-- Shared conversation state for PERSISTENCE_BACKEND=supabase
+
+create table if not exists bot_state (
+    namespace text not null,
+    key text not null,
+    data jsonb not null,
+    primary key (namespace, key)
+);
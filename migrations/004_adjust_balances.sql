@@ -0,0 +1,13 @@
+-- Bulk top-up: add an amount to many balances in one statement.
+-- Returns the telegram_ids that were found and updated.
+
+create or replace function adjust_balances(p_rows jsonb)
+returns setof bigint
+language sql
+as $$
+    update users u
+       set balance = u.balance + r.amount
+      from jsonb_to_recordset(p_rows) as r(telegram_id bigint, amount numeric)
+     where u.telegram_id = r.telegram_id
+    returning u.telegram_id;
+$$;
@@ -0,0 +1,38 @@
+-- Per-cafe menu used to price the free-text food field.
+-- aliases holds alternative spellings (Amharic, Latin, abbreviations).
+
+create table if not exists menu_items (
+    id bigint generated always as identity primary key,
+    cafe text not null,
+    name text not null,
+    aliases text[] not null default '{}',
+    price numeric(10, 2) not null check (price >= 0),
+    available boolean not null default true,
+    updated_at timestamptz not null default now(),
+    unique (cafe, name)
+);
+
+create index if not exists menu_items_cafe_idx on menu_items (cafe) where available;
+
+-- Cheap change detector polled by the bot: changes on any edit, insert or delete
+create or replace function menu_version()
+returns text
+language sql
+stable
+as $$
+    select coalesce(max(updated_at)::text, '') || ':' || count(*) from menu_items;
+$$;
+
+create or replace function touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists menu_items_touch on menu_items;
+create trigger menu_items_touch before update on menu_items
+    for each row execute function touch_updated_at();
@@ -0,0 +1,91 @@
+-- Order history for users and totals for admins, served from indexes.
+-- Orders now record the channel they were posted to so reports can group by it.
+
+alter table orders add column if not exists channel text;
+
+-- /history: one user's orders, newest first, paged by (created_at, order_number)
+create index if not exists orders_user_history_idx
+    on orders (user_telegram_id, created_at desc, order_number desc);
+
+-- /report: range scans over a period, optionally narrowed to one cafe or channel
+create index if not exists orders_created_at_idx on orders (created_at);
+create index if not exists orders_cafe_created_at_idx on orders (cafe, created_at);
+create index if not exists orders_channel_created_at_idx on orders (channel, created_at);
+
+-- Keyset page of a user's orders strictly older than the cursor (null = first page)
+create or replace function order_history(
+    p_user bigint,
+    p_limit int,
+    p_before_created_at timestamptz default null,
+    p_before_order_number bigint default null
+)
+returns table (order_number bigint, created_at timestamptz, cafe text, food text,
+               total_items int, total_price numeric)
+language sql
+stable
+as $$
+    select o.order_number, o.created_at, o.cafe, o.food, o.total_items, o.total_price
+      from orders o
+     where o.user_telegram_id = p_user
+       and (p_before_created_at is null
+            or (o.created_at, o.order_number) < (p_before_created_at, p_before_order_number))
+     order by o.created_at desc, o.order_number desc
+     limit p_limit;
+$$;
+
+-- Totals per day, cafe or channel over [p_from, p_to), aggregated in the database
+create or replace function order_report(p_from timestamptz, p_to timestamptz, p_group text default 'day')
+returns table (key text, orders bigint, items bigint, revenue numeric)
+language sql
+stable
+as $$
+    select case p_group
+               when 'cafe' then o.cafe
+               when 'channel' then coalesce(o.channel, 'unknown')
+               else to_char(o.created_at, 'YYYY-MM-DD')
+           end as key,
+           count(*) as orders,
+           coalesce(sum(o.total_items), 0) as items,
+           coalesce(sum(o.total_price), 0) as revenue
+      from orders o
+     where o.created_at >= p_from
+       and o.created_at < p_to
+     group by 1
+     order by 1;
+$$;
+
+-- place_order from 002, now also storing the channel
+create or replace function place_order(p_order jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders := jsonb_populate_record(null::orders, p_order);
+    v_balance numeric;
+begin
+    update users
+       set balance = balance - v_order.total_price
+     where telegram_id = v_order.user_telegram_id
+       and balance >= v_order.total_price
+    returning balance into v_balance;
+
+    if not found then
+        select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+        return jsonb_build_object('success', false, 'balance', coalesce(v_balance, 0), 'order_number', null);
+    end if;
+
+    v_order.order_number := coalesce(v_order.order_number, nextval('order_number_seq'));
+
+    insert into orders (
+        order_number, user_id, user_telegram_id, cafe, name, gender, phone,
+        time, food, place, total_items, total_price, created_at, channel
+    ) values (
+        v_order.order_number, v_order.user_id, v_order.user_telegram_id, v_order.cafe,
+        v_order.name, v_order.gender, v_order.phone, v_order.time, v_order.food,
+        v_order.place, v_order.total_items, v_order.total_price,
+        coalesce(v_order.created_at, now()), v_order.channel
+    );
+
+    return jsonb_build_object('success', true, 'balance', v_balance, 'order_number', v_order.order_number);
+end;
+$$;
@@ -0,0 +1,134 @@
+-- Orders, items and revenue per day, channel, cafe and meal slot.
+-- place_order keeps it current in the same transaction that inserts the order,
+-- so the dashboard reads a few hundred rows instead of scanning orders.
+
+create table if not exists order_rollup (
+    day date not null,
+    channel text not null,
+    cafe text not null,
+    meal_slot text not null,
+    orders int not null default 0,
+    items bigint not null default 0,
+    revenue numeric(12, 2) not null default 0,
+    primary key (day, channel, cafe, meal_slot)
+);
+
+-- Mirrors get_channel_for_order() in utils.py, for orders saved before 006
+create or replace function order_channel(p_gender text, p_place text)
+returns text
+language sql
+immutable
+as $$
+    select case
+        when lower(p_place) like '%agri%' then 'agri'
+        when lower(p_place) like '%main%' and upper(p_gender) = 'F' then 'female_main'
+        when lower(p_place) like '%main%' then 'male_main'
+        when lower(p_place) like '%tecno%' and upper(p_gender) = 'F' then 'female_tecno'
+        when lower(p_place) like '%tecno%' then 'male_tecno'
+        else 'male_main'
+    end;
+$$;
+
+-- The answer to "ለምሳ ወይንስ ለ እራት" is free text; map it to a slot
+create or replace function meal_slot(p_time text)
+returns text
+language sql
+immutable
+as $$
+    select case
+        when p_time ~* '(ምሳ|lunch)' then 'lunch'
+        when p_time ~* '(ራት|dinner)' then 'dinner'
+        else 'other'
+    end;
+$$;
+
+create or replace function add_to_rollup(p_order orders)
+returns void
+language sql
+as $$
+    insert into order_rollup as r (day, channel, cafe, meal_slot, orders, items, revenue)
+    values (
+        p_order.created_at::date,
+        coalesce(p_order.channel, order_channel(p_order.gender, p_order.place)),
+        coalesce(p_order.cafe, ''),
+        meal_slot(p_order.time),
+        1,
+        coalesce(p_order.total_items, 0),
+        coalesce(p_order.total_price, 0)
+    )
+    on conflict (day, channel, cafe, meal_slot) do update
+       set orders = r.orders + 1,
+           items = r.items + excluded.items,
+           revenue = r.revenue + excluded.revenue;
+$$;
+
+-- Backfill: recompute the rollup from orders, for every day or from p_since on.
+-- The table lock makes concurrent place_order calls wait until the rebuild commits.
+create or replace function rebuild_order_rollup(p_since date default null)
+returns int
+language plpgsql
+as $$
+declare
+    v_rows int;
+begin
+    lock table order_rollup in share row exclusive mode;
+
+    delete from order_rollup where p_since is null or day >= p_since;
+
+    insert into order_rollup (day, channel, cafe, meal_slot, orders, items, revenue)
+    select o.created_at::date,
+           coalesce(o.channel, order_channel(o.gender, o.place)),
+           coalesce(o.cafe, ''),
+           meal_slot(o.time),
+           count(*),
+           coalesce(sum(o.total_items), 0),
+           coalesce(sum(o.total_price), 0)
+      from orders o
+     where p_since is null or o.created_at >= p_since
+     group by 1, 2, 3, 4;
+
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
+
+-- place_order from 006, now also adding the order to the rollup
+create or replace function place_order(p_order jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders := jsonb_populate_record(null::orders, p_order);
+    v_balance numeric;
+begin
+    update users
+       set balance = balance - v_order.total_price
+     where telegram_id = v_order.user_telegram_id
+       and balance >= v_order.total_price
+    returning balance into v_balance;
+
+    if not found then
+        select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+        return jsonb_build_object('success', false, 'balance', coalesce(v_balance, 0), 'order_number', null);
+    end if;
+
+    v_order.order_number := coalesce(v_order.order_number, nextval('order_number_seq'));
+    v_order.created_at := coalesce(v_order.created_at, now());
+
+    insert into orders (
+        order_number, user_id, user_telegram_id, cafe, name, gender, phone,
+        time, food, place, total_items, total_price, created_at, channel
+    ) values (
+        v_order.order_number, v_order.user_id, v_order.user_telegram_id, v_order.cafe,
+        v_order.name, v_order.gender, v_order.phone, v_order.time, v_order.food,
+        v_order.place, v_order.total_items, v_order.total_price,
+        v_order.created_at, v_order.channel
+    );
+
+    perform add_to_rollup(v_order);
+
+    return jsonb_build_object('success', true, 'balance', v_balance, 'order_number', v_order.order_number);
+end;
+$$;
+
+select rebuild_order_rollup();
@@ -0,0 +1,89 @@
+-- One order per draft: the bot sends a key generated when the draft was started,
+-- and place_order returns the existing order instead of debiting twice.
+
+alter table orders add column if not exists idempotency_key text;
+
+-- Only the first order of a key keeps it, so the constraint can be added (and
+-- this migration run again)
+update orders
+set idempotency_key = null
+where ctid in (
+    select ctid
+    from (
+        select ctid, row_number() over (partition by idempotency_key order by created_at, ctid) as copy
+        from orders
+        where idempotency_key is not null
+    ) numbered
+    where copy > 1
+);
+
+do $$
+begin
+    if not exists (select 1 from pg_constraint where conname = 'orders_idempotency_key_key') then
+        alter table orders add constraint orders_idempotency_key_key unique (idempotency_key);
+    end if;
+end;
+$$;
+
+-- place_order from 007, now idempotent per idempotency_key
+create or replace function place_order(p_order jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders := jsonb_populate_record(null::orders, p_order);
+    v_balance numeric;
+    v_existing bigint;
+    v_constraint text;
+begin
+    if v_order.idempotency_key is not null then
+        select order_number into v_existing from orders where idempotency_key = v_order.idempotency_key;
+        if found then
+            select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+            return jsonb_build_object('success', true, 'balance', coalesce(v_balance, 0),
+                                      'order_number', v_existing, 'duplicate', true);
+        end if;
+    end if;
+
+    begin
+        update users
+           set balance = balance - v_order.total_price
+         where telegram_id = v_order.user_telegram_id
+           and balance >= v_order.total_price
+        returning balance into v_balance;
+
+        if not found then
+            select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+            return jsonb_build_object('success', false, 'balance', coalesce(v_balance, 0), 'order_number', null);
+        end if;
+
+        v_order.order_number := coalesce(v_order.order_number, nextval('order_number_seq'));
+        v_order.created_at := coalesce(v_order.created_at, now());
+
+        insert into orders (
+            order_number, user_id, user_telegram_id, cafe, name, gender, phone,
+            time, food, place, total_items, total_price, created_at, channel, idempotency_key
+        ) values (
+            v_order.order_number, v_order.user_id, v_order.user_telegram_id, v_order.cafe,
+            v_order.name, v_order.gender, v_order.phone, v_order.time, v_order.food,
+            v_order.place, v_order.total_items, v_order.total_price,
+            v_order.created_at, v_order.channel, v_order.idempotency_key
+        );
+
+        perform add_to_rollup(v_order);
+    exception when unique_violation then
+        -- A concurrent call with the same key committed first; leaving this block
+        -- rolled back our debit, so return the order that call created
+        get stacked diagnostics v_constraint = constraint_name;
+        if v_constraint <> 'orders_idempotency_key_key' then
+            raise;
+        end if;
+        select order_number into v_existing from orders where idempotency_key = v_order.idempotency_key;
+        select balance into v_balance from users where telegram_id = v_order.user_telegram_id;
+        return jsonb_build_object('success', true, 'balance', coalesce(v_balance, 0),
+                                  'order_number', v_existing, 'duplicate', true);
+    end;
+
+    return jsonb_build_object('success', true, 'balance', v_balance, 'order_number', v_order.order_number);
+end;
+$$;
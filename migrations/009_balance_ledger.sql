@@ -0,0 +1,307 @@
+-- Balances as an append-only ledger of debits, credits, refunds and adjustments.
+--
+-- A user's balance is their snapshot plus the ledger rows after it, found through
+-- the (telegram_id, id) index, so reading it stays cheap however long the ledger
+-- grows. Writes are inserts. Only a debit takes a lock, and only on the user
+-- being debited (an advisory lock keyed by telegram_id), so that two confirms
+-- from one account can not both pass the balance check.
+--
+-- users.balance is no longer written on every order. snapshot_balances() copies
+-- the snapshot into it for dashboards; the user_balances view is always current.
+
+create table if not exists ledger (
+    id bigint generated always as identity primary key,
+    telegram_id bigint not null,
+    kind text not null check (kind in ('debit', 'credit', 'refund', 'adjustment')),
+    amount numeric(12, 2) not null,
+    order_number bigint,
+    note text,
+    -- Insert time rather than transaction start, so it follows id closely
+    created_at timestamptz not null default clock_timestamp()
+);
+
+create index if not exists ledger_user_idx on ledger (telegram_id, id);
+create index if not exists ledger_created_at_idx on ledger (created_at);
+create index if not exists ledger_order_idx on ledger (order_number) where order_number is not null;
+-- An order can be refunded once
+create unique index if not exists ledger_refund_once_idx on ledger (order_number) where kind = 'refund';
+
+create or replace function ledger_append_only()
+returns trigger
+language plpgsql
+as $$
+begin
+    raise exception 'ledger is append-only; add a refund or adjustment instead';
+end;
+$$;
+
+drop trigger if exists ledger_append_only on ledger;
+create trigger ledger_append_only
+    before update or delete on ledger
+    for each row execute function ledger_append_only();
+
+create table if not exists balance_snapshots (
+    telegram_id bigint primary key,
+    balance numeric(12, 2) not null,
+    -- Last ledger row included in balance
+    ledger_id bigint not null,
+    taken_at timestamptz not null default now()
+);
+
+create or replace function user_balance(p_user bigint)
+returns numeric
+language sql
+stable
+as $$
+    select coalesce(s.balance, 0) + coalesce((
+               select sum(l.amount) from ledger l
+                where l.telegram_id = p_user and l.id > coalesce(s.ledger_id, 0)
+           ), 0)
+      from (select 1) as one
+      left join balance_snapshots s on s.telegram_id = p_user;
+$$;
+
+create or replace view user_balances as
+select u.telegram_id, u.name, user_balance(u.telegram_id) as balance
+  from users u;
+
+-- Opening balances: whatever users.balance says at migration time
+insert into ledger (telegram_id, kind, amount, note)
+select telegram_id, 'credit', balance, 'opening balance'
+  from users
+ where balance <> 0
+   and not exists (select 1 from ledger);
+
+-- A user inserted with a balance (add_user, CSV import, dashboard) gets it as a credit
+create or replace function users_opening_credit()
+returns trigger
+language plpgsql
+as $$
+begin
+    if coalesce(new.balance, 0) <> 0 then
+        insert into ledger (telegram_id, kind, amount, note)
+        values (new.telegram_id, 'credit', new.balance, 'opening balance');
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists users_opening_credit on users;
+create trigger users_opening_credit
+    after insert on users
+    for each row execute function users_opening_credit();
+
+-- Set a balance to an absolute amount by recording the difference
+create or replace function set_balance(p_user bigint, p_balance numeric, p_note text default null)
+returns numeric
+language plpgsql
+as $$
+declare
+    v_balance numeric;
+begin
+    perform pg_advisory_xact_lock(p_user);
+    v_balance := user_balance(p_user);
+    if p_balance <> v_balance then
+        insert into ledger (telegram_id, kind, amount, note)
+        values (p_user, 'adjustment', p_balance - v_balance, coalesce(p_note, 'balance set'));
+    end if;
+    return p_balance;
+end;
+$$;
+
+-- CSV import: add new users (their balance is credited by the trigger) and set existing users' balances
+create or replace function upsert_users(p_rows jsonb)
+returns setof bigint
+language plpgsql
+as $$
+declare
+    v_row record;
+begin
+    for v_row in select * from jsonb_to_recordset(p_rows) as r(telegram_id bigint, name text, balance numeric) loop
+        insert into users (telegram_id, name, balance)
+        values (v_row.telegram_id, v_row.name, v_row.balance)
+        on conflict (telegram_id) do update set name = excluded.name;
+        perform set_balance(v_row.telegram_id, v_row.balance, 'csv import');
+        return next v_row.telegram_id;
+    end loop;
+end;
+$$;
+
+-- adjust_balances from 004: top-ups are now credit rows
+create or replace function adjust_balances(p_rows jsonb)
+returns setof bigint
+language sql
+as $$
+    insert into ledger (telegram_id, kind, amount, note)
+    select r.telegram_id, 'credit', r.amount, 'top-up'
+      from jsonb_to_recordset(p_rows) as r(telegram_id bigint, amount numeric)
+     where exists (select 1 from users u where u.telegram_id = r.telegram_id)
+    returning telegram_id;
+$$;
+
+-- Give an order's price back; returns {telegram_id, balance}, or null if the order
+-- does not exist or was already refunded
+create or replace function refund_order(p_order_number bigint, p_note text default null)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders;
+begin
+    select * into v_order from orders where order_number = p_order_number;
+    if not found then
+        return null;
+    end if;
+    insert into ledger (telegram_id, kind, amount, order_number, note)
+    values (v_order.user_telegram_id, 'refund', v_order.total_price, p_order_number, p_note)
+    on conflict (order_number) where kind = 'refund' do nothing;
+    if not found then
+        return null;
+    end if;
+    return jsonb_build_object('telegram_id', v_order.user_telegram_id,
+                              'balance', user_balance(v_order.user_telegram_id));
+end;
+$$;
+
+-- Fold ledger rows older than p_margin into the snapshots. Rows still being
+-- written when the snapshot is taken could get a lower id than rows it includes;
+-- the margin leaves them for the next run and reconcile_ledger() catches the rest.
+create or replace function snapshot_balances(p_margin interval default interval '1 minute')
+returns int
+language plpgsql
+as $$
+declare
+    v_cut bigint;
+    v_rows int;
+begin
+    select max(id) into v_cut from ledger where created_at < clock_timestamp() - p_margin;
+    if v_cut is null then
+        return 0;
+    end if;
+
+    with tail as (
+        select l.telegram_id, sum(l.amount) as amount, max(l.id) as last_id
+          from ledger l
+          left join balance_snapshots s on s.telegram_id = l.telegram_id
+         where l.id > coalesce(s.ledger_id, 0)
+           and l.id <= v_cut
+         group by l.telegram_id
+    ), snapped as (
+        insert into balance_snapshots as s (telegram_id, balance, ledger_id, taken_at)
+        select t.telegram_id, coalesce(old.balance, 0) + t.amount, t.last_id, now()
+          from tail t
+          left join balance_snapshots old on old.telegram_id = t.telegram_id
+        on conflict (telegram_id) do update
+           set balance = excluded.balance, ledger_id = excluded.ledger_id, taken_at = excluded.taken_at
+        returning s.telegram_id, s.balance
+    )
+    update users u set balance = snapped.balance
+      from snapped
+     where u.telegram_id = snapped.telegram_id;
+
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
+
+-- Check the ledger against the snapshots and the orders. With p_repair, snapshots
+-- that disagree with the ledger rows they cover are recomputed from scratch.
+create or replace function reconcile_ledger(p_repair boolean default false)
+returns table (telegram_id bigint, order_number bigint, issue text, expected numeric, actual numeric)
+language plpgsql
+as $$
+declare
+    v_started timestamptz := (select min(l.created_at) from ledger l);
+begin
+    return query
+    select s.telegram_id, null::bigint, 'snapshot differs from ledger',
+           coalesce(sum(l.amount), 0), s.balance::numeric
+      from balance_snapshots s
+      left join ledger l on l.telegram_id = s.telegram_id and l.id <= s.ledger_id
+     group by s.telegram_id, s.balance
+    having coalesce(sum(l.amount), 0) <> s.balance;
+
+    return query
+    select o.user_telegram_id, o.order_number, 'order without debit', -o.total_price::numeric, null::numeric
+      from orders o
+     where o.created_at >= v_started
+       and not exists (select 1 from ledger l where l.order_number = o.order_number and l.kind = 'debit');
+
+    return query
+    select l.telegram_id, l.order_number, 'debit does not match order', -o.total_price::numeric, l.amount::numeric
+      from ledger l
+      join orders o on o.order_number = l.order_number
+     where l.kind = 'debit' and l.amount <> -o.total_price;
+
+    if p_repair then
+        update balance_snapshots s
+           set balance = (select coalesce(sum(l.amount), 0) from ledger l
+                           where l.telegram_id = s.telegram_id and l.id <= s.ledger_id),
+               taken_at = now();
+    end if;
+end;
+$$;
+
+-- place_order from 008: the debit is a ledger row
+create or replace function place_order(p_order jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders := jsonb_populate_record(null::orders, p_order);
+    v_balance numeric;
+    v_existing bigint;
+    v_constraint text;
+begin
+    if v_order.idempotency_key is not null then
+        select order_number into v_existing from orders where idempotency_key = v_order.idempotency_key;
+        if found then
+            return jsonb_build_object('success', true, 'balance', user_balance(v_order.user_telegram_id),
+                                      'order_number', v_existing, 'duplicate', true);
+        end if;
+    end if;
+
+    begin
+        perform pg_advisory_xact_lock(v_order.user_telegram_id);
+        v_balance := user_balance(v_order.user_telegram_id);
+
+        if v_balance < v_order.total_price
+           or not exists (select 1 from users where telegram_id = v_order.user_telegram_id) then
+            return jsonb_build_object('success', false, 'balance', v_balance, 'order_number', null);
+        end if;
+
+        v_order.order_number := coalesce(v_order.order_number, nextval('order_number_seq'));
+        v_order.created_at := coalesce(v_order.created_at, now());
+
+        insert into orders (
+            order_number, user_id, user_telegram_id, cafe, name, gender, phone,
+            time, food, place, total_items, total_price, created_at, channel, idempotency_key
+        ) values (
+            v_order.order_number, v_order.user_id, v_order.user_telegram_id, v_order.cafe,
+            v_order.name, v_order.gender, v_order.phone, v_order.time, v_order.food,
+            v_order.place, v_order.total_items, v_order.total_price,
+            v_order.created_at, v_order.channel, v_order.idempotency_key
+        );
+
+        insert into ledger (telegram_id, kind, amount, order_number)
+        values (v_order.user_telegram_id, 'debit', -v_order.total_price, v_order.order_number);
+
+        perform add_to_rollup(v_order);
+    exception when unique_violation then
+        -- A concurrent call with the same key committed first; leaving this block
+        -- rolled back our order and debit, so return the order that call created
+        get stacked diagnostics v_constraint = constraint_name;
+        if v_constraint <> 'orders_idempotency_key_key' then
+            raise;
+        end if;
+        select order_number into v_existing from orders where idempotency_key = v_order.idempotency_key;
+        return jsonb_build_object('success', true, 'balance', user_balance(v_order.user_telegram_id),
+                                  'order_number', v_existing, 'duplicate', true);
+    end;
+
+    return jsonb_build_object('success', true, 'balance', v_balance - v_order.total_price,
+                              'order_number', v_order.order_number);
+end;
+$$;
+
+select snapshot_balances(interval '0');
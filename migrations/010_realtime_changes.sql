@@ -0,0 +1,18 @@
+-- Stream changes to users, orders and ledger over Supabase Realtime, so the bot can
+-- keep authorization and balances cached until a change arrives (CHANGEFEED_ENABLED).
+
+-- Deletes then carry the whole old row, including telegram_id, not just the primary key
+alter table users replica identity full;
+
+do $$
+declare
+    v_table text;
+begin
+    foreach v_table in array array['users', 'orders', 'ledger'] loop
+        if not exists (select 1 from pg_publication_tables
+                        where pubname = 'supabase_realtime' and schemaname = 'public' and tablename = v_table) then
+            execute format('alter publication supabase_realtime add table public.%I', v_table);
+        end if;
+    end loop;
+end;
+$$;
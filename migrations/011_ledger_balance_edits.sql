@@ -0,0 +1,137 @@
+-- Follow-up to 009: users.balance stays editable from the dashboard, and
+-- refunded orders leave the dispatch rollup.
+
+-- An edit to users.balance (dashboard, SQL console) becomes an adjustment in the
+-- ledger, so the balance the bot reads is the one that was typed in.
+-- snapshot_balances() copies snapshots into users.balance and is let through.
+create or replace function users_balance_edit()
+returns trigger
+language plpgsql
+as $$
+begin
+    if coalesce(current_setting('bot.snapshot_sync', true), '') = 'on' then
+        return new;
+    end if;
+    if new.balance is distinct from old.balance then
+        perform set_balance(new.telegram_id, coalesce(new.balance, 0), 'edited users.balance');
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists users_balance_edit on users;
+create trigger users_balance_edit
+    before update of balance on users
+    for each row execute function users_balance_edit();
+
+-- snapshot_balances from 009, marking its own users.balance writes for the trigger above
+create or replace function snapshot_balances(p_margin interval default interval '1 minute')
+returns int
+language plpgsql
+as $$
+declare
+    v_cut bigint;
+    v_rows int;
+begin
+    select max(id) into v_cut from ledger where created_at < clock_timestamp() - p_margin;
+    if v_cut is null then
+        return 0;
+    end if;
+
+    perform set_config('bot.snapshot_sync', 'on', true);
+
+    with tail as (
+        select l.telegram_id, sum(l.amount) as amount, max(l.id) as last_id
+          from ledger l
+          left join balance_snapshots s on s.telegram_id = l.telegram_id
+         where l.id > coalesce(s.ledger_id, 0)
+           and l.id <= v_cut
+         group by l.telegram_id
+    ), snapped as (
+        insert into balance_snapshots as s (telegram_id, balance, ledger_id, taken_at)
+        select t.telegram_id, coalesce(old.balance, 0) + t.amount, t.last_id, now()
+          from tail t
+          left join balance_snapshots old on old.telegram_id = t.telegram_id
+        on conflict (telegram_id) do update
+           set balance = excluded.balance, ledger_id = excluded.ledger_id, taken_at = excluded.taken_at
+        returning s.telegram_id, s.balance
+    )
+    update users u set balance = snapped.balance
+      from snapped
+     where u.telegram_id = snapped.telegram_id;
+
+    get diagnostics v_rows = row_count;
+    perform set_config('bot.snapshot_sync', 'off', true);
+    return v_rows;
+end;
+$$;
+
+create or replace function remove_from_rollup(p_order orders)
+returns void
+language sql
+as $$
+    update order_rollup
+       set orders = orders - 1,
+           items = items - coalesce(p_order.total_items, 0),
+           revenue = revenue - coalesce(p_order.total_price, 0)
+     where day = p_order.created_at::date
+       and channel = coalesce(p_order.channel, order_channel(p_order.gender, p_order.place))
+       and cafe = coalesce(p_order.cafe, '')
+       and meal_slot = meal_slot(p_order.time);
+$$;
+
+-- refund_order from 009, now also taking the order out of the rollup
+create or replace function refund_order(p_order_number bigint, p_note text default null)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders;
+begin
+    select * into v_order from orders where order_number = p_order_number;
+    if not found then
+        return null;
+    end if;
+    insert into ledger (telegram_id, kind, amount, order_number, note)
+    values (v_order.user_telegram_id, 'refund', v_order.total_price, p_order_number, p_note)
+    on conflict (order_number) where kind = 'refund' do nothing;
+    if not found then
+        return null;
+    end if;
+    perform remove_from_rollup(v_order);
+    return jsonb_build_object('telegram_id', v_order.user_telegram_id,
+                              'balance', user_balance(v_order.user_telegram_id));
+end;
+$$;
+
+-- rebuild_order_rollup from 007, leaving refunded orders out
+create or replace function rebuild_order_rollup(p_since date default null)
+returns int
+language plpgsql
+as $$
+declare
+    v_rows int;
+begin
+    lock table order_rollup in share row exclusive mode;
+
+    delete from order_rollup where p_since is null or day >= p_since;
+
+    insert into order_rollup (day, channel, cafe, meal_slot, orders, items, revenue)
+    select o.created_at::date,
+           coalesce(o.channel, order_channel(o.gender, o.place)),
+           coalesce(o.cafe, ''),
+           meal_slot(o.time),
+           count(*),
+           coalesce(sum(o.total_items), 0),
+           coalesce(sum(o.total_price), 0)
+      from orders o
+     where (p_since is null or o.created_at >= p_since)
+       and not exists (select 1 from ledger l where l.order_number = o.order_number and l.kind = 'refund')
+     group by 1, 2, 3, 4;
+
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
+
+select rebuild_order_rollup();
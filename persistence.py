@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import config
+from storage import SQLiteStore, SupabaseStore
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user_data'
+CONVERSATION = 'conversation:'
+
+
+class BotPersistence(BasePersistence):
+    """Persists conversation states and user_data to a pluggable store.
+
+    The Application hands over changed entries every update_interval seconds
+    rather than on every update. All update_* calls of one such run are
+    staged and written to the store as a single batch.
+
+    A shared store (Supabase) lets a restarted or replacement instance resume
+    every in-flight order. Instances only load state on startup, so live
+    conversations must keep being routed to the instance that holds them.
+    """
+
+    def __init__(self, store, update_interval: float = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval or config.PERSISTENCE_INTERVAL
+        )
+        self.store = store
+        self._pending: Dict[tuple, Optional[object]] = {}
+        self._commit_task: Optional[asyncio.Task] = None
+
+    def _stage(self, namespace: str, key: str, value):
+        self._pending[(namespace, key)] = value
+        if self._commit_task is None:
+            # Every update_* call of one persistence run is already scheduled on
+            # the loop, so a callback scheduled now runs after all of them.
+            asyncio.get_running_loop().call_soon(self._start_commit)
+
+    def _start_commit(self):
+        if self._commit_task is None:
+            self._commit_task = asyncio.create_task(self._commit())
+
+    async def _commit(self):
+        try:
+            while self._pending:
+                changes, self._pending = self._pending, {}
+                try:
+                    await self.store.save([(namespace, key, value) for (namespace, key), value in changes.items()])
+                except Exception as e:
+                    logger.error(f"Error saving bot state: {e}")
+                    # Keep the changes for the next run unless newer ones replaced them
+                    for item, value in changes.items():
+                        self._pending.setdefault(item, value)
+                    break
+        finally:
+            self._commit_task = None
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        stored = await self.store.load(USER_DATA)
+        return {int(user_id): data for user_id, data in stored.items()}
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        stored = await self.store.load(CONVERSATION + name)
+        return {tuple(json.loads(key)): state for key, state in stored.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._stage(CONVERSATION + name, json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(USER_DATA, str(user_id), data if data else None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(USER_DATA, str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write out anything still staged (called on shutdown)"""
+        if self._commit_task is not None:
+            await self._commit_task
+        if self._pending:
+            await self._commit()
+        self.store.close()
+
+    # chat_data, bot_data and callback_data are not stored
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+def create_persistence(db) -> Optional[BotPersistence]:
+    """Build the persistence backend selected by PERSISTENCE_BACKEND, if any"""
+    if config.PERSISTENCE_BACKEND == 'sqlite':
+        return BotPersistence(SQLiteStore(config.PERSISTENCE_PATH))
+    if config.PERSISTENCE_BACKEND == 'supabase':
+        return BotPersistence(SupabaseStore(db))
+    return None
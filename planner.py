@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+from utils import get_channel_for_order, meal_slot, parse_block
+
+logger = logging.getLogger(__name__)
+
+CAMPUSES = ('agri', 'tecno', 'main')
+
+
+def parse_place(place: str) -> Tuple[str, str]:
+    """Split a place like "Main: Block 12" into ('main', '12'); unknown campuses count as main"""
+    place_lower = place.lower()
+    campus = next((name for name in CAMPUSES if name in place_lower), 'main')
+    return campus, parse_block(place)
+
+
+class DistanceMatrix:
+    """Walking distances in metres between the cafes and blocks of each campus.
+
+    Loaded from a JSON file of {campus: {stop: {stop: metres}}}, where a stop is
+    a cafe name or a block number; each pair needs to be listed in one
+    direction only. Pairs that are not listed are estimated: BLOCK_SPACING
+    metres per block number between two blocks, ROUTE_DEFAULT_DISTANCE otherwise.
+    """
+
+    def __init__(self, distances: Optional[Dict] = None):
+        self.distances: Dict[Tuple[str, str, str], float] = {}
+        for campus, rows in (distances or {}).items():
+            for a, row in rows.items():
+                for b, metres in row.items():
+                    self.distances[(campus, a, b)] = self.distances[(campus, b, a)] = float(metres)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'DistanceMatrix':
+        path = path or config.ROUTE_DISTANCES_PATH
+        if not os.path.exists(path):
+            return cls()
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def __call__(self, campus: str, a: Optional[str], b: Optional[str]) -> float:
+        # None is where the courier starts, which is wherever the first stop is
+        if a is None or b is None or a == b:
+            return 0.0
+        metres = self.distances.get((campus, a, b))
+        if metres is not None:
+            return metres
+        if a.isdigit() and b.isdigit():
+            return abs(int(a) - int(b)) * config.BLOCK_SPACING
+        return config.ROUTE_DEFAULT_DISTANCE
+
+
+Distance = Callable[[Optional[str], Optional[str]], float]
+
+
+def path_length(stops: List[str], start: Optional[str], distance: Distance) -> float:
+    """Length of visiting stops in order, beginning at start"""
+    total, previous = 0.0, start
+    for stop in stops:
+        total += distance(previous, stop)
+        previous = stop
+    return total
+
+
+def nearest_neighbour(stops: List[str], start: Optional[str], distance: Distance) -> List[str]:
+    """Order stops by always walking to the closest one not yet visited"""
+    remaining, path, current = list(stops), [], start
+    while remaining:
+        closest = min(remaining, key=lambda stop: distance(current, stop))
+        remaining.remove(closest)
+        path.append(closest)
+        current = closest
+    return path
+
+
+def cheapest_insertion(path: List[str], stop: str, start: Optional[str], distance: Distance):
+    """Insert stop into path where it lengthens the path least"""
+    best, best_index = None, len(path)
+    previous = start
+    for index in range(len(path) + 1):
+        following = path[index] if index < len(path) else None
+        added = distance(previous, stop) + (distance(stop, following) - distance(previous, following)
+                                            if following is not None else 0.0)
+        if best is None or added < best:
+            best, best_index = added, index
+        previous = following
+    path.insert(best_index, stop)
+
+
+def two_opt(path: List[str], start: Optional[str], distance: Distance) -> List[str]:
+    """Reverse stretches of an open path (fixed start, free end) while that shortens it"""
+    path = list(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(path) - 1):
+            before = path[i - 1] if i else start
+            for j in range(i + 1, len(path)):
+                after = path[j + 1] if j + 1 < len(path) else None
+                delta = distance(before, path[j]) - distance(before, path[i])
+                if after is not None:
+                    delta += distance(path[i], after) - distance(path[j], after)
+                if delta < -1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    improved = True
+    return path
+
+
+class Route:
+    """One channel's courier run for one meal slot: every pickup, then every drop-off.
+
+    New stops are placed by cheapest insertion as orders arrive, so the route
+    is always usable; optimize() polishes it with 2-opt when it is read.
+    """
+
+    def __init__(self, campus: str, distances: DistanceMatrix):
+        self.campus = campus
+        self.pickups: List[str] = []
+        self.dropoffs: List[str] = []
+        self.cafe_orders: Dict[str, List[int]] = {}
+        self.block_orders: Dict[str, List[int]] = {}
+        self._distance: Distance = lambda a, b: distances(campus, a, b)
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return sum(len(numbers) for numbers in self.block_orders.values())
+
+    def add(self, cafe: str, block: str, order_number: int):
+        if cafe not in self.cafe_orders:
+            self.cafe_orders[cafe] = []
+            cheapest_insertion(self.pickups, cafe, None, self._distance)
+            self._dirty = True
+        if block not in self.block_orders:
+            self.block_orders[block] = []
+            cheapest_insertion(self.dropoffs, block, self.pickups[-1], self._distance)
+            self._dirty = True
+        self.cafe_orders[cafe].append(order_number)
+        self.block_orders[block].append(order_number)
+
+    def optimize(self):
+        if self._dirty:
+            self.pickups = two_opt(self.pickups, None, self._distance)
+            self.dropoffs = two_opt(self.dropoffs, self.pickups[-1], self._distance)
+            self._dirty = False
+
+    @property
+    def length(self) -> float:
+        return path_length(self.pickups + self.dropoffs, None, self._distance)
+
+
+class RoutePlanner:
+    """Confirmed orders grouped by day, meal slot and channel, each group kept as a Route"""
+
+    def __init__(self, distances: Optional[DistanceMatrix] = None):
+        self.distances = distances or DistanceMatrix.load()
+        self.routes: Dict[Tuple[str, str, str], Route] = {}
+        self._seen: set = set()
+        self._day: Optional[str] = None
+        self._load_task: Optional[asyncio.Task] = None
+
+    def add(self, order_data: Dict):
+        """Add a confirmed order to its route; an order already added is ignored"""
+        order_number = order_data.get('order_number')
+        day = str(order_data.get('created_at') or date.today().isoformat())[:10]
+        if order_number is None or (day, order_number) in self._seen:
+            return
+        if self._day is None or day > self._day:
+            # A new day: yesterday's routes are done
+            self.routes = {key: route for key, route in self.routes.items() if key[0] >= day}
+            self._seen = {seen for seen in self._seen if seen[0] >= day}
+            self._day = day
+        self._seen.add((day, order_number))
+
+        campus, block = parse_place(order_data['place'])
+        channel = order_data.get('channel') or get_channel_for_order(order_data['gender'], order_data['place'])
+        key = (day, meal_slot(order_data['time']), channel)
+        route = self.routes.get(key)
+        if route is None:
+            route = self.routes[key] = Route(campus, self.distances)
+        route.add(order_data['cafe'], block, order_number)
+
+    def plan(self, day: Optional[str] = None, slot: Optional[str] = None,
+             channel: Optional[str] = None) -> List[Tuple[Tuple[str, str, str], Route]]:
+        """Optimized routes of a day (today by default), optionally for one slot or channel"""
+        day = day or date.today().isoformat()
+        plan = []
+        for key, route in sorted(self.routes.items()):
+            if key[0] == day and slot in (None, key[1]) and channel in (None, key[2]):
+                route.optimize()
+                plan.append((key, route))
+        return plan
+
+    async def load(self, db, day: Optional[str] = None) -> Optional[int]:
+        """Add the orders already placed today, e.g. after a restart - returns how many were read"""
+        day = day or date.today().isoformat()
+        rows = await db.get_orders_since(datetime.fromisoformat(day).isoformat())
+        if rows is None:
+            return None
+        for row in rows:
+            self.add(row)
+        logger.info(f"Loaded {len(rows)} orders of {day} into the route planner")
+        return len(rows)
+
+    async def plan_all(self, db, day: Optional[str] = None, slot: Optional[str] = None,
+                       channel: Optional[str] = None) -> Tuple[List[Tuple[Tuple[str, str, str], Route]], bool]:
+        """Routes planned from the database, which has the orders every worker and instance confirmed.
+
+        Returns the plan and whether it came from the database; if the
+        orders can't be read, the plan is of the orders this process saw.
+        """
+        planner = RoutePlanner(self.distances)
+        if await planner.load(db, day) is None:
+            return self.plan(day, slot, channel), False
+        return planner.plan(day, slot, channel), True
+
+    def start(self, db):
+        self._load_task = asyncio.create_task(self.load(db), name="route-planner-load")
+
+    async def stop(self):
+        if self._load_task:
+            self._load_task.cancel()
+            await asyncio.gather(self._load_task, return_exceptions=True)
+            self._load_task = None
+
+
+def format_routes(plan: List[Tuple[Tuple[str, str, str], Route]]) -> str:
+    """Format courier routes for the /route command"""
+    if not plan:
+        return "📭ለዚህ ጊዜ ምንም ትዕዛዝ የለም።"
+    lines = []
+    for (day, slot, channel), route in plan:
+        lines.append(f"🛵 {channel} · {slot} · {len(route)} orders · {route.length / 1000:.1f} km")
+        step = 1
+        for cafe in route.pickups:
+            lines.append(f"{step}. 👩‍🍳{cafe}: pick up {len(route.cafe_orders[cafe])}")
+            step += 1
+        for block in route.dropoffs:
+            numbers = route.block_orders[block]
+            shown = ', '.join(f"#{number}" for number in numbers[:8])
+            more = f" +{len(numbers) - 8}" if len(numbers) > 8 else ""
+            lines.append(f"{step}. 🏠Block {block}: {shown}{more}")
+            step += 1
+        lines.append("")
+    return '\n'.join(lines).strip()
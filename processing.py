@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+import config
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently, and each user's in order.
+
+    Every update first takes the lock of its user, so one conversation never
+    runs two handlers at once and its updates run in arrival order. Only
+    then does it take one of max_running slots, so a user with a backlog
+    waits on their own lock without holding slots other users need. The
+    base class semaphore caps updates in flight, waiting ones included, at
+    max_pending.
+    """
+
+    def __init__(self, max_running: Optional[int] = None, max_pending: Optional[int] = None):
+        super().__init__(max_pending or config.MAX_PENDING_UPDATES)
+        self.max_running = max_running or config.MAX_CONCURRENT_UPDATES
+        self._running = asyncio.BoundedSemaphore(self.max_running)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._user_locks: Dict[Hashable, list] = {}
+
+    @staticmethod
+    def _key(update: object) -> Optional[Hashable]:
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return ('chat', chat.id) if chat is not None else None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
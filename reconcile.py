@@ -0,0 +1,31 @@
+# === BALANCE LEDGER RECONCILIATION (run with: python reconcile.py [--repair]) ===
+# Folds the ledger into fresh snapshots, then lists snapshots that disagree with
+# the ledger rows they cover, orders without a debit and debits that do not match
+# their order. With --repair, drifted snapshots are recomputed from the ledger.
+import asyncio
+import sys
+
+from database import AsyncDatabase
+
+
+async def main(repair=False):
+    db = AsyncDatabase()
+    try:
+        users = await db.snapshot_balances()
+        issues = await db.reconcile_ledger(repair)
+    finally:
+        await db.close()
+    if users is None or issues is None:
+        sys.exit("Reconciliation failed")
+    print(f"Snapshotted balances of {users} users")
+    for issue in issues:
+        order = f" order #{issue['order_number']}" if issue['order_number'] else ""
+        print(f"{issue['telegram_id']}{order}: {issue['issue']} "
+              f"(expected {issue['expected']}, found {issue['actual']})")
+    print(f"{len(issues)} issues{', snapshots repaired' if repair and issues else ''}")
+    if issues and not repair:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main('--repair' in sys.argv[1:]))
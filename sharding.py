@@ -0,0 +1,238 @@
+# === MULTI-WORKER MODE (run with: BOT_WORKERS=4 python sharding.py) ===
+# Updates are sharded by user id across worker processes, each running its own
+# Application. A user always lands on the same worker, which handles that
+# user's updates in arrival order, so each conversation lives in one process.
+# Channel posts, digests and courier routes belong to worker 0 alone; the
+# other workers hand it their confirmed orders.
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import config
+import logs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+UPDATE_KINDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member'
+)
+
+
+def user_id_of(data: dict) -> Optional[int]:
+    """Return the id of the user who sent a raw Bot API update, if any"""
+    for kind in UPDATE_KINDS:
+        payload = data.get(kind)
+        if payload and 'from' in payload:
+            return payload['from']['id']
+    return None
+
+
+def shard_for(data: dict, shards: int) -> int:
+    user_id = user_id_of(data)
+    return user_id % shards if user_id is not None else 0
+
+
+# The worker that posts every order to the channels and keeps the digests and
+# courier routes; the others hand it their orders
+CHANNEL_SHARD = 0
+
+
+def configure_shard(shard: int, shards: int):
+    """Give a worker its own local files"""
+    for name in ('PERSISTENCE_PATH', 'OUTBOX_PATH'):
+        base, ext = os.path.splitext(getattr(config, name))
+        setattr(config, name, f"{base}.shard{shard}{ext}")
+
+
+class ChannelPoster:
+    """Set as bot.channel_poster in the workers that don't post: sends each order to CHANNEL_SHARD"""
+
+    def __init__(self, queues: List):
+        self.updates = queues[CHANNEL_SHARD]
+
+    def __call__(self, order_data: Dict):
+        self.updates.put(('post', order_data))
+
+
+class ShardPeers:
+    """Sends the rows a worker wrote to every other worker, whose caches would not see them otherwise.
+
+    Set as CachedDatabase.peers; each change is (table, kind, record) as the
+    change feed would deliver it, and the other workers pass it to on_change().
+    """
+
+    def __init__(self, shard: int, queues: List):
+        self.queues = [updates for index, updates in enumerate(queues) if index != shard]
+
+    def __call__(self, changes: List[tuple]):
+        for updates in self.queues:
+            updates.put(('changes', changes))
+
+
+def worker_main(shard: int, shards: int, queues: List, results, reports, factory: Optional[Callable] = None):
+    """Process entry point: run one Application fed from this worker's queue"""
+    asyncio.run(_run_worker(shard, shards, queues, results, reports, factory))
+
+
+async def _control(message: tuple, shard: int, reports, bot):
+    """Handle a message from the front process or another worker rather than an update"""
+    kind = message[0]
+    if kind == 'changes':
+        for table, change, record in message[1]:
+            bot.db.on_change(table, change, record, None)
+    elif kind == 'post':
+        await bot.post_order_to_channel(message[1])
+    elif kind == 'metrics':
+        reports.put((message[1], shard, metrics.snapshot()))
+
+
+async def _run_worker(shard, shards, queues, results, reports, factory):
+    configure_shard(shard, shards)
+    from telegram import Update
+    import bot
+
+    if shard != CHANNEL_SHARD:
+        bot.channel_poster = ChannelPoster(queues)
+    if factory is None:
+        from bot import setup_bot
+        application = setup_bot()
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+    else:
+        application = await factory()
+    # Set after the factory, which may have replaced bot.db
+    bot.db.peers = ShardPeers(shard, queues)
+    await application.start()
+    results.put(('ready', shard, None))
+
+    updates = queues[shard]
+    loop = asyncio.get_running_loop()
+    processed = 0
+    running = True
+    while running:
+        # Block in a thread for the first update, then drain whatever else is waiting
+        batch = [await loop.run_in_executor(None, updates.get)]
+        try:
+            while True:
+                batch.append(updates.get_nowait())
+        except queue_module.Empty:
+            pass
+
+        for data in batch:
+            if data is None:
+                running = False
+                break
+            if isinstance(data, tuple):
+                await _control(data, shard, reports, bot)
+                continue
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            processed += 1
+
+    # stop() lets the Application finish every queued update first
+    await application.stop()
+    await application.shutdown()
+    if factory is None and application.post_shutdown:
+        await application.post_shutdown(application)
+    results.put(('done', shard, (processed, time.time())))
+
+
+class ShardedBot:
+    """Runs the bot in N worker processes and routes each update to its user's worker"""
+
+    def __init__(self, shards: Optional[int] = None, factory: Optional[Callable] = None):
+        self.shards = shards or config.BOT_WORKERS
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(self.shards)]
+        self.results = context.Queue()
+        # Metrics snapshots, requested by collect_metrics()
+        self.reports = context.Queue()
+        self._reports_lock = threading.Lock()
+        self._request = 0
+        self.processes = [
+            context.Process(
+                target=worker_main,
+                args=(shard, self.shards, self.queues, self.results, self.reports, factory),
+                name=f"bot-worker-{shard}",
+                daemon=True
+            )
+            for shard in range(self.shards)
+        ]
+
+    def start(self, timeout: float = 120):
+        """Start the workers and wait until each one is ready for updates"""
+        for process in self.processes:
+            process.start()
+        for _ in self.processes:
+            self.results.get(timeout=timeout)
+        logger.info(f"Started {self.shards} bot workers")
+
+    def route(self, data: dict):
+        """Send a raw Bot API update to the worker that owns its user"""
+        self.queues[shard_for(data, self.shards)].put(data)
+
+    def collect_metrics(self, timeout: float = 5) -> List[Dict]:
+        """Ask every worker for a snapshot of its metrics; workers that don't answer in time are left out"""
+        with self._reports_lock:
+            self._request += 1
+            for updates in self.queues:
+                updates.put(('metrics', self._request))
+            snapshots = {}
+            deadline = time.monotonic() + timeout
+            while len(snapshots) < self.shards:
+                try:
+                    request, shard, snapshot = self.reports.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue_module.Empty:
+                    logger.warning(f"Metrics from {self.shards - len(snapshots)} workers did not arrive in time")
+                    break
+                # A late answer to an earlier request is dropped
+                if request == self._request:
+                    snapshots[shard] = snapshot
+            return list(snapshots.values())
+
+    def stop(self, timeout: float = 120) -> List[tuple]:
+        """Let the workers finish their queues, then return (processed, finished_at) per worker"""
+        finished = {}
+        # The channel worker stops last, so it still posts the orders the others hand it while finishing
+        others = [shard for shard in range(self.shards) if shard != CHANNEL_SHARD]
+        for stage in (others, [CHANNEL_SHARD]):
+            for shard in stage:
+                self.queues[shard].put(None)
+            for _ in stage:
+                _, shard, result = self.results.get(timeout=timeout)
+                finished[shard] = result
+        for process in self.processes:
+            process.join(timeout)
+        return [finished[shard] for shard in sorted(finished)]
+
+
+async def poll(sharded_bot: ShardedBot):
+    """Long-poll Telegram in this process and hand every update to the workers"""
+    from telegram import Bot
+
+    async with Bot(config.BOT_TOKEN) as telegram_bot:
+        await telegram_bot.delete_webhook()
+        offset = None
+        while True:
+            for update in await telegram_bot.get_updates(offset=offset, timeout=30,
+                                                         allowed_updates=['message', 'callback_query']):
+                sharded_bot.route(update.to_dict())
+                offset = update.update_id + 1
+
+
+if __name__ == "__main__":
+    logs.setup_logging()
+    print(f"🚀 Starting Campus Delivery Bot with {config.BOT_WORKERS} workers...")
+    sharded = ShardedBot()
+    sharded.start()
+    try:
+        asyncio.run(poll(sharded))
+    except KeyboardInterrupt:
+        sharded.stop()
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# A change is (namespace, key, value); a value of None deletes the key
+Change = Tuple[str, str, Optional[Any]]
+
+
+class SQLiteStore:
+    """Namespaced key-value store in a local SQLite file running in WAL mode.
+
+    SQLite calls run in a worker thread so they never block the event loop;
+    the lock keeps them from overlapping on the shared connection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+        self._lock = asyncio.Lock()
+
+    async def load(self, namespace: str) -> Dict[str, Any]:
+        """Return every key stored under namespace"""
+        async with self._lock:
+            rows = await asyncio.to_thread(
+                lambda: self._conn.execute(
+                    "SELECT key, data FROM bot_state WHERE namespace = ?", (namespace,)
+                ).fetchall()
+            )
+        return {key: json.loads(data) for key, data in rows}
+
+    async def save(self, changes: Iterable[Change]):
+        """Apply a batch of changes in one transaction"""
+        upserts = []
+        deletes = []
+        for namespace, key, value in changes:
+            if value is None:
+                deletes.append((namespace, key))
+            else:
+                upserts.append((namespace, key, json.dumps(value, default=str)))
+
+        def write():
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO bot_state (namespace, key, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (namespace, key) DO UPDATE SET data = excluded.data",
+                    upserts
+                )
+                self._conn.executemany(
+                    "DELETE FROM bot_state WHERE namespace = ? AND key = ?", deletes
+                )
+
+        async with self._lock:
+            await asyncio.to_thread(write)
+
+    def close(self):
+        self._conn.close()
+
+
+class SupabaseStore:
+    """Same interface as SQLiteStore, backed by the bot_state table in Supabase"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, namespace: str) -> Dict[str, Any]:
+        """Return every key stored under namespace"""
+        client = await self.db.get_client()
+        response = await client.table('bot_state').select('key, data').eq('namespace', namespace).execute()
+        return {row['key']: row['data'] for row in response.data}
+
+    async def save(self, changes: Iterable[Change]):
+        """Apply a batch of changes with one upsert and one delete per namespace"""
+        upserts = []
+        deletes: Dict[str, list] = {}
+        for namespace, key, value in changes:
+            if value is None:
+                deletes.setdefault(namespace, []).append(key)
+            else:
+                upserts.append({'namespace': namespace, 'key': key, 'data': json.loads(json.dumps(value, default=str))})
+
+        client = await self.db.get_client()
+        if upserts:
+            await client.table('bot_state').upsert(upserts, on_conflict='namespace,key').execute()
+        for namespace, keys in deletes.items():
+            await client.table('bot_state').delete().eq('namespace', namespace).in_('key', keys).execute()
+
+    def close(self):
+        pass
@@ -1,5 +1,48 @@
+import asyncio
+import io
+import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop
+
+import app as webapp
+import bot
+import config
+import logs
+import metrics
 from bot import setup_bot
+from breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from cache import CachedDatabase, IdempotencyCache
+from changefeed import LocalChangeFeed
+from database import AsyncDatabase, DatabaseUnavailable, OrderNumberAllocator
+from degraded import OrderOutbox
+from digest import DigestDispatcher
+from dispatch import ChannelDispatcher, OUTBOX
+from loadtest import MemoryDatabase
+from menu import AliasMatcher, MenuCatalog, MenuItem, LineItem
+from persistence import BotPersistence, USER_DATA
+from planner import DistanceMatrix, RoutePlanner, parse_place
+from processing import PerUserUpdateProcessor
+from sharding import ChannelPoster, ShardPeers, _control
+from storage import SQLiteStore
+from throttle import RateLimiter, Throttle
+from utils import (decode_history_cursor, encode_history_cursor, extract_numbers_from_text,
+                   parse_user_csv, summarize_rollup)
+
 
 print("Testing bot setup...")
 try:
@@ -9,4 +52,1280 @@ try:
 except Exception as e:
     print(f"❌ Bot setup failed: {e}")
     import traceback
-    traceback.print_exc()
\ No newline at end of file
+    traceback.print_exc()
+
+
+# === ORDER NUMBERS ===
+class FakeSequenceDatabase:
+    """Mimics reserve_order_numbers(): nextval on a sequence with INCREMENT BY block"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.value = 1000
+        self.calls = 0
+
+    async def reserve_order_numbers(self):
+        await asyncio.sleep(random.random() / 1000)
+        self.calls += 1
+        start = self.value
+        self.value += self.block_size
+        return start, self.block_size
+
+
+def test_order_numbers_unique_under_load():
+    """Numbers handed out by several instances at once never repeat"""
+    server = FakeSequenceDatabase(block_size=20)
+    instances = [OrderNumberAllocator(server) for _ in range(3)]
+
+    async def confirm(i):
+        await asyncio.sleep(random.random() / 1000)
+        return await instances[i % len(instances)].next()
+
+    async def run():
+        return await asyncio.gather(*(confirm(i) for i in range(2000)))
+
+    numbers = asyncio.run(run())
+    assert len(set(numbers)) == len(numbers)
+    assert server.calls < len(numbers) / 10
+
+
+# === CONCURRENT UPDATES ===
+def fake_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=None)
+
+
+def test_slow_user_does_not_block_others():
+    """A user stuck in a slow handler never delays another user's update"""
+    processor = PerUserUpdateProcessor(max_running=8, max_pending=64)
+    release = None
+    finished = []
+
+    async def slow():
+        await release.wait()
+        finished.append('slow')
+
+    async def fast(name):
+        finished.append(name)
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        slow_task = asyncio.create_task(processor.process_update(fake_update(1), slow()))
+        # User 1 queues more behind the slow handler; user 2 must not wait for any of it
+        queued_task = asyncio.create_task(processor.process_update(fake_update(1), fast('queued')))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(fake_update(2), fast('other')), timeout=1)
+        assert finished == ['other']
+        release.set()
+        await asyncio.gather(slow_task, queued_task)
+
+    asyncio.run(run())
+    assert finished == ['other', 'slow', 'queued']
+    assert not processor._user_locks
+
+
+def test_updates_of_one_user_stay_in_order():
+    """Each user's handlers run one at a time, in arrival order"""
+    processor = PerUserUpdateProcessor(max_running=4, max_pending=1000)
+    seen = {}
+    running = set()
+
+    async def handler(user_id, index):
+        assert user_id not in running
+        running.add(user_id)
+        await asyncio.sleep(random.random() / 1000)
+        seen.setdefault(user_id, []).append(index)
+        running.discard(user_id)
+
+    async def run():
+        await asyncio.gather(*(
+            processor.process_update(fake_update(index % 10), handler(index % 10, index))
+            for index in range(500)
+        ))
+
+    asyncio.run(run())
+    for user_id, indexes in seen.items():
+        assert indexes == sorted(indexes)
+    assert sum(map(len, seen.values())) == 500
+
+
+# === ORDER HISTORY ===
+def test_history_cursor_round_trip():
+    """The "more" button carries the keyset of the last order shown and fits in callback data"""
+    order = {'created_at': '2024-05-01T12:34:56.123456+00:00', 'order_number': 1234567}
+    data = encode_history_cursor(order)
+    assert len(data.encode()) <= 64
+    assert decode_history_cursor(data) == (order['created_at'], order['order_number'])
+    assert decode_history_cursor("history:garbage") is None
+
+
+class RecordingMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+
+
+class HistoryDatabase:
+    """Order history and report queries over an in-memory list of orders"""
+
+    def __init__(self, count):
+        self.orders = [
+            {'order_number': 1000 + n, 'created_at': f'2024-05-{n + 1:02d}T12:00:00+00:00',
+             'cafe': 'ፍቄ', 'food': '1 ሽሮ', 'total_price': '6.65', 'total_items': 1}
+            for n in range(count)
+        ]
+        self.reports = []
+
+    async def is_user_authorized(self, user_id):
+        return True
+
+    async def get_order_history(self, user_id, limit, before=None):
+        newest = sorted(self.orders, key=lambda o: (o['created_at'], o['order_number']), reverse=True)
+        if before is not None:
+            newest = [o for o in newest if (o['created_at'], o['order_number']) < tuple(before)]
+        return newest[:limit]
+
+    async def get_order_report(self, start, end, group_by='day'):
+        self.reports.append((start, end, group_by))
+        return []
+
+
+class HistoryQuery:
+    def __init__(self, data):
+        self.data = data
+        self.answers = 0
+        self.edits = []
+
+    async def answer(self):
+        self.answers += 1
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+
+
+def history_pages(monkeypatch, count):
+    """Walk /history and its "more" button - returns the pages as (text, button data)"""
+    monkeypatch.setattr(bot, 'db', HistoryDatabase(count))
+    monkeypatch.setattr(bot.config, 'HISTORY_PAGE_SIZE', 3)
+    user = SimpleNamespace(id=7)
+    message = RecordingMessage()
+    asyncio.run(bot.history(SimpleNamespace(effective_user=user, message=message), None))
+    pages = []
+    text, markup = message.replies[-1]
+    while True:
+        data = markup.inline_keyboard[0][0].callback_data if markup else None
+        pages.append((text, data))
+        if data is None:
+            return pages
+        query = HistoryQuery(data)
+        asyncio.run(bot.history_page(SimpleNamespace(effective_user=user, callback_query=query), None))
+        assert query.answers == 1
+        text, markup = query.edits[-1]
+
+
+def test_history_pages_through_every_order_once(monkeypatch):
+    pages = history_pages(monkeypatch, 7)
+    assert [page.count('\n#') for page, _ in pages] == [3, 3, 1]
+    shown = [line.split(' ')[0] for page, _ in pages for line in page.split('\n') if line.startswith('#')]
+    assert shown == [f"#{n}" for n in range(1006, 999, -1)]
+    # A full last page has no "more" button
+    assert [data is None for _, data in history_pages(monkeypatch, 6)] == [False, True]
+
+
+def test_history_of_a_user_without_orders(monkeypatch):
+    assert history_pages(monkeypatch, 0) == [("📭ምንም ትዕዛዝ የሎትም።", None)]
+
+
+def test_a_bad_history_cursor_is_answered_and_ignored(monkeypatch):
+    monkeypatch.setattr(bot, 'db', HistoryDatabase(7))
+    query = HistoryQuery("history:garbage")
+    asyncio.run(bot.history_page(SimpleNamespace(effective_user=SimpleNamespace(id=7), callback_query=query), None))
+    assert query.answers == 1 and query.edits == []
+
+
+def run_report(monkeypatch, *args):
+    """Run /report as an admin - returns (replies, report queries)"""
+    database = HistoryDatabase(0)
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot.config, 'ADMIN_IDS', [1])
+    message = RecordingMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=message)
+    asyncio.run(bot.report(update, SimpleNamespace(args=list(args))))
+    return [text for text, _ in message.replies], database.reports
+
+
+def report_days(start, end):
+    return (datetime.fromisoformat(end).date() - datetime.fromisoformat(start).date()).days + 1
+
+
+def test_report_defaults_to_report_default_days_by_day(monkeypatch):
+    monkeypatch.setattr(bot.config, 'REPORT_DEFAULT_DAYS', 10)
+    _, [(start, end, group_by)] = run_report(monkeypatch)
+    assert report_days(start, end) == 10 and group_by == 'day'
+    assert datetime.fromisoformat(start).time() == datetime.min.time()
+
+
+def test_report_takes_days_and_grouping_in_any_order(monkeypatch):
+    _, [(start, end, group_by)] = run_report(monkeypatch, 'CAFE', '30')
+    assert report_days(start, end) == 30 and group_by == 'cafe'
+
+
+def test_report_rejects_bad_arguments(monkeypatch):
+    for args in (['0'], ['-3'], ['7.5'], ['week'], ['30', 'user']):
+        replies, queries = run_report(monkeypatch, *args)
+        assert queries == [] and replies[0].startswith("❎አጠቃቀም")
+
+
+# === ORDER ROLLUP ===
+def test_summarize_rollup():
+    """Rollup rows add up per channel and meal slot, and overall"""
+    rows = [
+        {'day': '2024-05-01', 'channel': 'agri', 'cafe': 'ፍቄ', 'meal_slot': 'lunch', 'orders': 2, 'items': 3, 'revenue': '30.00'},
+        {'day': '2024-05-02', 'channel': 'agri', 'cafe': 'መሲ', 'meal_slot': 'lunch', 'orders': 1, 'items': 1, 'revenue': '10.50'},
+        {'day': '2024-05-02', 'channel': 'male_main', 'cafe': 'ፍቄ', 'meal_slot': 'dinner', 'orders': 4, 'items': 4, 'revenue': '40.00'},
+    ]
+    by_slot = summarize_rollup(rows, ('channel', 'meal_slot'))
+    assert [(t['channel'], t['meal_slot'], t['orders'], t['items']) for t in by_slot] == [
+        ('agri', 'lunch', 3, 4), ('male_main', 'dinner', 4, 4)
+    ]
+    assert summarize_rollup(rows, ()) == [{'orders': 7, 'items': 8, 'revenue': 80.5}]
+    assert summarize_rollup([], ()) == []
+
+
+# === CHANNEL DIGESTS ===
+class FakeChannelBot:
+    """Records channel posts and edits instead of calling Telegram"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text):
+        self.calls.append(('send', text))
+        return SimpleNamespace(message_id=len(self.calls))
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        self.calls.append(('edit', message_id, text))
+
+
+def digest_order(number, place="Tecno block 3"):
+    return {'order_number': number, 'cafe': 'ፍቄ', 'name': f"User {number}", 'phone': '0911', 'food': '2 ሽሮ',
+            'place': place, 'time': 'ለምሳ', 'total_items': 2, 'total_price': 13.3,
+            'created_at': '2024-05-01T12:00:00'}
+
+
+def test_digest_batches_orders_into_few_messages(tmp_path):
+    """Orders in a window become one post, later ones edit it, and a full digest starts a new one"""
+    bot = FakeChannelBot()
+    store = SQLiteStore(str(tmp_path / "outbox.sqlite3"))
+    dispatcher = DigestDispatcher(bot, store, channels={'male_tecno': -100}, window=0.05, max_orders=4)
+
+    async def run():
+        await dispatcher.start()
+        for number in range(1, 4):
+            await dispatcher.post_order('male_tecno', digest_order(number, f"Tecno block {number % 2}"))
+        await asyncio.sleep(0.2)
+        assert bot.calls and bot.calls[0][0] == 'send' and len(bot.calls) == 1
+        await dispatcher.post_order('male_tecno', digest_order(4))
+        await dispatcher.post_order('male_tecno', digest_order(5))
+        await asyncio.sleep(0.2)
+        await dispatcher.stop()
+
+    asyncio.run(run())
+    kinds = [call[0] for call in bot.calls]
+    assert kinds == ['send', 'edit', 'send']
+    assert '#3' in bot.calls[0][1] and 'Block 0' in bot.calls[0][1] and 'Block 1' in bot.calls[0][1]
+    assert '#4' in bot.calls[1][2]
+    assert '#5' in bot.calls[2][1] and '#4' not in bot.calls[2][1]
+
+    # Only the open second digest is left in the outbox, and a restart resumes editing it
+    restarted = DigestDispatcher(FakeChannelBot(), store, channels={'male_tecno': -100}, window=0.05, max_orders=4)
+
+    async def resume():
+        await restarted.start()
+        await restarted.post_order('male_tecno', digest_order(6))
+        await asyncio.sleep(0.2)
+        await restarted.stop()
+
+    asyncio.run(resume())
+    assert [call[0] for call in restarted.bot.calls] == ['edit']
+    assert '#5' in restarted.bot.calls[0][2] and '#6' in restarted.bot.calls[0][2]
+    store.close()
+
+class DroppingChannelBot(FakeChannelBot):
+    """Telegram rejects the first post outright"""
+
+    async def send_message(self, chat_id, text):
+        if not self.calls:
+            self.calls.append(('dropped', text))
+            raise TelegramError("Bad Request: chat not found")
+        return await super().send_message(chat_id, text)
+
+
+def test_dropped_digest_post_is_retried_not_retired(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DISPATCH_MAX_BACKOFF', 0.05)
+    channel_bot = DroppingChannelBot()
+    store = SQLiteStore(str(tmp_path / "outbox.sqlite3"))
+    dispatcher = DigestDispatcher(channel_bot, store, channels={'male_tecno': -100}, window=0, max_orders=1)
+
+    async def run():
+        await dispatcher.start()
+        await dispatcher.post_order('male_tecno', digest_order(1))
+        await asyncio.sleep(0.2)
+        await dispatcher.stop()
+
+    asyncio.run(run())
+    assert [call[0] for call in channel_bot.calls] == ['dropped', 'send']
+    assert '#1' in channel_bot.calls[1][1]
+    assert dispatcher.digests['male_tecno'] == []
+    store.close()
+
+
+# === IDEMPOTENT CONFIRM ===
+class CountingQuery:
+    """Callback query that counts the Telegram calls made through it"""
+
+    def __init__(self):
+        self.answers = 0
+        self.edits = []
+        self.message = SimpleNamespace(reply_markup=None)
+
+    async def answer(self):
+        self.answers += 1
+        await asyncio.sleep(0.01)
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+        await asyncio.sleep(0.01)
+
+
+class CountingDispatcher:
+    def __init__(self):
+        self.posts = []
+
+    async def post(self, channel, text):
+        self.posts.append((channel, text))
+        return True
+
+
+def test_double_tapped_confirm_places_one_order(monkeypatch):
+    """Many simultaneous presses of the same confirm button debit, insert and post once"""
+    memory_db = MemoryDatabase(latency=0.02)
+    memory_db.users[42] = {'telegram_id': 42, 'name': 'User_42', 'balance': 100.0}
+    dispatcher = CountingDispatcher()
+    monkeypatch.setattr(bot, 'db', memory_db)
+    monkeypatch.setattr(bot, 'order_numbers', OrderNumberAllocator(memory_db))
+    monkeypatch.setattr(bot, 'channel_dispatcher', dispatcher)
+    monkeypatch.setattr(bot, 'confirmations', IdempotencyCache())
+    monkeypatch.setattr(bot.config, 'DIGEST_MODE', False)
+
+    query = CountingQuery()
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=42))
+    order_data = {'cafe': 'ፍቄ', 'user_id': 42, 'idempotency_key': 'draft-1', 'name': 'Abebe', 'gender': 'M',
+                  'phone': '0911', 'time': 'ለምሳ', 'food': '2 ሽሮ', 'place': 'Main block 3',
+                  'total_items': 2, 'total_price': 13.3}
+    context = SimpleNamespace(user_data={bot.ORDER_DATA: order_data})
+
+    async def run():
+        return await asyncio.gather(*(bot.confirm_order(update, context) for _ in range(50)))
+
+    states = asyncio.run(run())
+    assert set(states) == {bot.ConversationHandler.END}
+    assert len(memory_db.orders) == 1
+    assert memory_db.users[42]['balance'] == 100.0 - 13.3
+    assert len(dispatcher.posts) == 1
+    assert query.answers == 1 and len(query.edits) == 1
+    assert bot.confirmations.duplicates == 49
+
+    # The same draft reaching the database again (e.g. after a lost reply) is not debited twice
+    result = asyncio.run(memory_db.place_order(dict(order_data, user_telegram_id=42, order_number=5000)))
+    assert result['duplicate'] and len(memory_db.orders) == 1
+
+
+# === CIRCUIT BREAKER AND DEGRADED MODE ===
+def test_circuit_breaker_fails_fast_and_probes():
+    """Consecutive connection failures open the circuit; one probe after the timeout closes it"""
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    calls = []
+
+    async def down():
+        calls.append('down')
+        raise httpx.ConnectError("connection refused")
+
+    async def slow():
+        calls.append('slow')
+        await asyncio.sleep(1)
+
+    async def up():
+        calls.append('up')
+        await asyncio.sleep(0.01)
+        return 'ok'
+
+    async def run():
+        for factory in (down, slow):
+            try:
+                await breaker.call(factory, timeout=0.01)
+            except (httpx.ConnectError, asyncio.TimeoutError):
+                pass
+        assert breaker.state == OPEN
+        try:
+            await breaker.call(up)
+        except CircuitOpenError:
+            pass
+        assert calls == ['down', 'slow']
+
+        await asyncio.sleep(0.06)
+        assert breaker.state == HALF_OPEN
+        # Only one probe goes through; the rest still fail fast
+        results = await asyncio.gather(*(breaker.call(up) for _ in range(5)), return_exceptions=True)
+        assert results.count('ok') == 1
+        assert all(isinstance(result, CircuitOpenError) for result in results if result != 'ok')
+        assert breaker.state == CLOSED
+
+    asyncio.run(run())
+
+
+class OutageDatabase:
+    """Database stand-in whose calls get no answer while down is set"""
+
+    def __init__(self):
+        self.down = False
+        self.breaker = CircuitBreaker('outage', failure_threshold=1, reset_timeout=0)
+        self.placed = []
+
+    async def is_user_authorized(self, user_id):
+        return None if self.down else user_id == 7
+
+    async def place_order(self, order_data):
+        if self.down:
+            raise DatabaseUnavailable("down")
+        self.placed.append(order_data['idempotency_key'])
+        return {'success': True, 'balance': 50.0, 'order_number': 1000 + len(self.placed)}
+
+
+def test_degraded_mode_serves_known_users_and_replays_orders(tmp_path):
+    """During an outage known users stay authorized and queued orders are placed, in order, once it ends"""
+    backend = OutageDatabase()
+    db = CachedDatabase(backend, ttl=0)
+    store = SQLiteStore(str(tmp_path / "outbox.sqlite3"))
+    replayed = []
+
+    async def on_placed(order_data, result):
+        replayed.append((order_data['idempotency_key'], result['order_number']))
+
+    outbox = OrderOutbox(store, db, on_placed)
+
+    async def run():
+        assert await db.is_user_authorized(7) is True
+        backend.down = True
+        assert await db.is_user_authorized(7) is True
+        assert await db.is_user_authorized(8) is None
+
+        for key in ('a', 'b', 'c'):
+            await outbox.add({'idempotency_key': key, 'user_telegram_id': 7})
+        assert await outbox.replay() == 0
+
+        backend.down = False
+        assert await outbox.replay() == 3
+        assert await outbox.replay() == 0
+
+    asyncio.run(run())
+    assert replayed == [('a', 1001), ('b', 1002), ('c', 1003)]
+    store.close()
+
+
+class SilentClient:
+    """Supabase client whose RPCs never answer in time"""
+
+    def rpc(self, name, params=None):
+        async def execute():
+            raise asyncio.TimeoutError()
+        return SimpleNamespace(execute=execute)
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.orders = []
+
+    async def add(self, order_data):
+        self.orders.append(dict(order_data))
+
+
+def test_a_timed_out_order_is_queued_before_the_circuit_opens(monkeypatch):
+    """The first timeout may have committed the order, so it is replayed (idempotently), not dropped"""
+    database = AsyncDatabase(SilentClient())
+    outbox = RecordingOutbox()
+    monkeypatch.setattr(bot, 'db', CachedDatabase(database))
+    monkeypatch.setattr(bot, 'order_numbers', OrderNumberAllocator(FakeSequenceDatabase(block_size=20)))
+    monkeypatch.setattr(bot, 'order_outbox', outbox)
+
+    query = CountingQuery()
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=42))
+    order_data = {'cafe': 'ፍቄ', 'idempotency_key': 'draft-2', 'gender': 'F', 'place': 'Agri block 1',
+                  'total_price': 13.3}
+    context = SimpleNamespace(user_data={bot.ORDER_DATA: order_data})
+
+    state = asyncio.run(bot.place_confirmed_order(update, context, order_data))
+    assert state == bot.ConversationHandler.END
+    assert database.breaker.state == CLOSED
+    assert [(order['idempotency_key'], order['order_number']) for order in outbox.orders] == [('draft-2', 1000)]
+    assert query.edits[-1].startswith("⏳")
+
+
+def test_open_circuit_fast_fails_are_counted_apart_from_errors():
+    database = AsyncDatabase(SilentClient())
+    database.breaker._state, database.breaker.opened_at = OPEN, time.monotonic()
+    errors = metrics.DB_ERRORS.values.get(('place_order',), 0)
+    with pytest.raises(DatabaseUnavailable):
+        asyncio.run(database.place_order({'idempotency_key': 'draft-3'}))
+    assert metrics.DB_REFUSED.values[('place_order',)] >= 1
+    assert metrics.DB_ERRORS.values.get(('place_order',), 0) == errors
+
+
+class PlaceOrderClient:
+    """Supabase client answering the place_order RPC the way migration 008 does"""
+
+    def __init__(self, balance):
+        self.balance = balance
+        self.orders = {}
+
+    def rpc(self, name, params=None):
+        order = params['p_order']
+
+        async def execute():
+            assert name == 'place_order'
+            key = order['idempotency_key']
+            if key in self.orders:
+                return SimpleNamespace(data={'success': True, 'balance': self.balance,
+                                             'order_number': self.orders[key], 'duplicate': True})
+            if self.balance < order['total_price']:
+                return SimpleNamespace(data={'success': False, 'balance': self.balance, 'order_number': None})
+            self.balance -= order['total_price']
+            self.orders[key] = order['order_number']
+            return SimpleNamespace(data={'success': True, 'balance': self.balance, 'order_number': order['order_number']})
+        return SimpleNamespace(execute=execute)
+
+
+def confirm_with(monkeypatch, client, key):
+    """Run place_confirmed_order for one draft against client - returns (state, query, posts)"""
+    dispatcher = CountingDispatcher()
+    monkeypatch.setattr(bot, 'db', CachedDatabase(AsyncDatabase(client)))
+    monkeypatch.setattr(bot, 'order_numbers', OrderNumberAllocator(FakeSequenceDatabase(block_size=20)))
+    monkeypatch.setattr(bot, 'channel_dispatcher', dispatcher)
+    monkeypatch.setattr(bot, 'channel_poster', None)
+    monkeypatch.setattr(bot.config, 'DIGEST_MODE', False)
+
+    query = CountingQuery()
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=42))
+    order_data = {'cafe': 'ፍቄ', 'idempotency_key': key, 'name': 'Abebe', 'gender': 'M', 'phone': '0911',
+                  'time': 'ለምሳ', 'food': '2 ሽሮ', 'place': 'Main block 3', 'total_items': 2, 'total_price': 13.3}
+    context = SimpleNamespace(user_data={bot.ORDER_DATA: order_data})
+    state = asyncio.run(bot.place_confirmed_order(update, context, order_data))
+    return state, query, dispatcher.posts
+
+
+def test_place_order_returns_the_rpc_result_contract():
+    client = PlaceOrderClient(balance=20.0)
+    database = AsyncDatabase(client)
+    order = {'idempotency_key': 'k1', 'order_number': 1000, 'total_price': 13.3}
+
+    placed = asyncio.run(database.place_order(order))
+    assert placed == {'success': True, 'balance': pytest.approx(6.7), 'order_number': 1000}
+    duplicate = asyncio.run(database.place_order(dict(order, order_number=1001)))
+    assert duplicate['success'] and duplicate['duplicate'] and duplicate['order_number'] == 1000
+    short = asyncio.run(database.place_order({'idempotency_key': 'k2', 'order_number': 1002, 'total_price': 13.3}))
+    assert short == {'success': False, 'balance': pytest.approx(6.7), 'order_number': None}
+    assert client.balance == pytest.approx(6.7)
+
+
+def test_confirm_posts_placed_orders_only(monkeypatch):
+    state, query, posts = confirm_with(monkeypatch, PlaceOrderClient(balance=100.0), 'k1')
+    assert state == bot.ConversationHandler.END
+    assert query.edits[-1].startswith("ትዕዛዞ በተሰካ ሁኔታ") and len(posts) == 1 and '1000' in posts[0][1]
+
+    state, query, posts = confirm_with(monkeypatch, PlaceOrderClient(balance=5.0), 'k1')
+    assert state == bot.ConversationHandler.END
+    assert query.edits[-1].startswith("🛡") and posts == []
+
+
+def test_confirm_of_an_already_placed_draft_posts_the_existing_order(monkeypatch):
+    """A reply lost after the commit: the retry gets duplicate, and the original order number is posted"""
+    client = PlaceOrderClient(balance=100.0)
+    client.orders['k1'] = 1234
+    state, query, posts = confirm_with(monkeypatch, client, 'k1')
+    assert state == bot.ConversationHandler.END
+    assert client.balance == 100.0
+    assert len(posts) == 1 and '1234' in posts[0][1] and '1000' not in posts[0][1]
+
+
+# === COLD START ===
+def test_importing_bot_does_not_load_supabase():
+    """The Supabase stack is imported when post_init creates the client, not when bot.py is imported"""
+    script = "import sys, bot, app; assert 'supabase' not in sys.modules, 'supabase imported'"
+    env = dict(os.environ, WEBHOOK_URL='')
+    subprocess.run([sys.executable, '-c', script], env=env, check=True)
+
+
+# === BALANCE LEDGER ===
+class LedgerClient:
+    """Supabase client stand-in that answers the ledger RPCs and records the calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.results = {'user_balance': 86.7, 'refund_order': {'telegram_id': 7, 'balance': 100.0}}
+
+    def rpc(self, name, params=None):
+        self.calls.append((name, params))
+        return SimpleNamespace(execute=self._execute(name))
+
+    def _execute(self, name):
+        async def execute():
+            return SimpleNamespace(data=self.results.get(name))
+        return execute
+
+
+def test_balance_reads_hit_the_ledger_once_and_refunds_update_the_cache():
+    client = LedgerClient()
+    db = CachedDatabase(AsyncDatabase(client))
+
+    async def scenario():
+        first = await db.get_user_balance(7)
+        second = await db.get_user_balance(7)
+        refund, error = await db.refund_order(1024, 'cafe closed')
+        return first, second, refund, error, await db.get_user_balance(7)
+
+    first, second, refund, error, after = asyncio.run(scenario())
+    assert (first, second) == (86.7, 86.7)
+    assert refund == {'telegram_id': 7, 'balance': 100.0} and error == ""
+    assert after == 100.0
+    assert [name for name, _ in client.calls] == ['user_balance', 'refund_order']
+    assert client.calls[1][1] == {'p_order_number': 1024, 'p_note': 'cafe closed'}
+
+    client.results['refund_order'] = None
+    refund, error = asyncio.run(db.refund_order(1024))
+    assert refund is None and 'already refunded' in error
+
+
+# === ROUTE PLANNER ===
+def test_route_planner_groups_orders_and_orders_blocks():
+    assert parse_place("Main: Block 12") == ('main', '12')
+    assert parse_place("tecno b-4") == ('tecno', '4')
+
+    planner = RoutePlanner(DistanceMatrix({'main': {'ሸዊት': {'1': 50}}}))
+    for number, block in enumerate(['9', '2', '5', '1', '5']):
+        planner.add({'order_number': number, 'cafe': 'ሸዊት', 'gender': 'M', 'time': 'ምሳ',
+                     'place': f"Main block {block}", 'created_at': '2026-01-05T12:00:00'})
+    planner.add({'order_number': 0, 'cafe': 'ሸዊት', 'gender': 'M', 'time': 'ምሳ',
+                 'place': "Main block 9", 'created_at': '2026-01-05T12:00:00'})
+
+    [((day, slot, channel), route)] = planner.plan('2026-01-05')
+    assert (slot, channel, len(route)) == ('lunch', 'male_main', 5)
+    assert route.pickups == ['ሸዊት']
+    # The cafe is next to block 1, so the courier walks up the blocks from there
+    assert route.dropoffs == ['1', '2', '5', '9']
+    assert route.block_orders['5'] == [2, 4]
+
+
+class OrdersDatabase:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def get_orders_since(self, start):
+        return self.rows
+
+
+def test_routes_are_planned_from_every_order_in_the_database():
+    """Orders confirmed by another worker show up; the local planner is the fallback"""
+    order = {'cafe': 'ሸዊት', 'gender': 'F', 'time': 'እራት', 'place': "Tecno block 3",
+             'created_at': '2026-01-05T18:00:00'}
+    local = RoutePlanner(DistanceMatrix())
+    local.add({**order, 'order_number': 1})
+    rows = [{**order, 'order_number': number} for number in (1, 2, 3)]
+
+    plan, complete = asyncio.run(local.plan_all(OrdersDatabase(rows), '2026-01-05'))
+    [((day, slot, channel), route)] = plan
+    assert complete and (slot, channel, len(route)) == ('dinner', 'female_tecno', 3)
+
+    plan, complete = asyncio.run(local.plan_all(OrdersDatabase(None), '2026-01-05'))
+    assert not complete and len(plan[0][1]) == 1
+
+
+# === STRUCTURED LOGGING ===
+def test_log_records_carry_the_bound_fields_through_the_queue():
+    stream = io.StringIO()
+    records = queue.SimpleQueue()
+    handler = logs.ContextQueueHandler(records)
+    handler.addFilter(logs.SamplingFilter(0.0))
+    handler.addFilter(logs.ContextFilter())
+    output = logging.StreamHandler(stream)
+    output.setFormatter(logs.JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    logger = logging.getLogger('test.structured')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    async def handle(user_id, order_number):
+        token = logs.bind(user_id=user_id, state='CONFIRM_ORDER')
+        await asyncio.sleep(0.01)
+        logs.bind(order_number=order_number)
+        logger.debug("Handled update", extra={'duration_ms': 1.0})
+        logger.info("Placed order #%s", order_number, extra={'cafe': 'ሸዊት'})
+        logs.unbind(token)
+
+    async def scenario():
+        await asyncio.gather(handle(1, 101), handle(2, 102))
+        logger.warning("No context here")
+
+    listener.start()
+    try:
+        asyncio.run(scenario())
+    finally:
+        listener.stop()
+        logger.removeHandler(handler)
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    # DEBUG records are sampled away at rate 0; each task sees only its own fields
+    assert [(e['message'], e.get('user_id'), e.get('order_number')) for e in entries] == [
+        ("Placed order #101", 1, 101), ("Placed order #102", 2, 102), ("No context here", None, None)]
+    assert entries[0]['cafe'] == 'ሸዊት' and entries[0]['state'] == 'CONFIRM_ORDER' and entries[0]['level'] == 'INFO'
+
+
+# === CHANGE FEED ===
+class CountingDatabase:
+    """Database stand-in that counts reads and can be edited behind the cache's back"""
+
+    def __init__(self):
+        self.users = {7: 10.0}
+        self.reads = 0
+        self.gate = None
+
+    async def is_user_authorized(self, user_id):
+        self.reads += 1
+        return user_id in self.users
+
+    async def get_user_balance(self, user_id):
+        self.reads += 1
+        balance = self.users.get(user_id, 0.0)
+        if self.gate:
+            await self.gate.wait()
+        return balance
+
+
+def test_change_feed_invalidates_indefinitely_cached_entries():
+    backend = CountingDatabase()
+    db = CachedDatabase(backend, ttl=60)
+    feed = LocalChangeFeed()
+    feed.subscribe(db)
+
+    async def scenario():
+        feed.start()
+        assert db.balances.ttl is None
+        assert await db.get_user_balance(7) == 10.0
+        assert await db.get_user_balance(7) == 10.0
+        assert backend.reads == 1
+
+        # A top-up made in the dashboard
+        backend.users[7] = 60.0
+        feed.publish('ledger', 'INSERT', {'telegram_id': 7, 'kind': 'credit', 'amount': 50})
+        assert await db.get_user_balance(7) == 60.0
+
+        # A user removed in the dashboard loses access at once
+        assert await db.is_user_authorized(7)
+        del backend.users[7]
+        feed.publish('users', 'DELETE', None, {'telegram_id': 7})
+        assert not await db.is_user_authorized(7)
+
+        # A change that lands while a read is in flight keeps the read out of the cache
+        backend.users[8] = 5.0
+        backend.gate = asyncio.Event()
+        read = asyncio.create_task(db.get_user_balance(8))
+        await asyncio.sleep(0)
+        backend.users[8] = 25.0
+        feed.publish('ledger', 'INSERT', {'telegram_id': 8, 'kind': 'credit', 'amount': 20})
+        backend.gate.set()
+        assert await read == 5.0
+        backend.gate = None
+        assert await db.get_user_balance(8) == 25.0
+
+        # Without a live feed, entries expire again
+        await feed.stop()
+        assert db.balances.ttl == 60 and len(db.balances) == 0
+
+    asyncio.run(scenario())
+
+
+# === THROTTLE ===
+def test_rate_limiter_allows_a_burst_then_the_rate():
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.allow('a', now=100.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow('b', now=100.0)
+    assert not limiter.allow('a', now=100.4)
+    assert limiter.allow('a', now=100.5) and not limiter.allow('a', now=100.5)
+    assert all(RateLimiter(rate=0, burst=0).allow('a') for _ in range(100))
+
+
+def test_unregistered_flood_costs_one_database_lookup(monkeypatch):
+    monkeypatch.setattr(config, 'ADMIN_IDS', [])
+    backend = CountingDatabase()
+    db = CachedDatabase(backend)
+    throttle = Throttle(db.is_known_unauthorized)
+    flooder = SimpleNamespace(effective_user=SimpleNamespace(id=666))
+
+    async def flood():
+        served = 0
+        for _ in range(50):
+            if throttle.check(flooder) is None:
+                served += 1
+                assert await db.is_user_authorized(666) is False
+        return served
+
+    served = asyncio.run(flood())
+    assert backend.reads == 1
+    # The first message is checked against the database, then only the small unauthorized bucket is left
+    assert served == 1 + config.THROTTLE_UNAUTHORIZED_BURST
+
+
+class ExpiredQuery(CountingQuery):
+    async def answer(self):
+        raise TelegramError("Query is too old")
+
+
+def test_a_dropped_button_press_is_still_answered(monkeypatch):
+    monkeypatch.setattr(config, 'ADMIN_IDS', [])
+    monkeypatch.setattr(config, 'THROTTLE_USER_BURST', 1)
+    throttle = Throttle(lambda user_id: False)
+    query = CountingQuery()
+    press = SimpleNamespace(effective_user=SimpleNamespace(id=5), callback_query=query)
+
+    async def presses(count):
+        dropped = 0
+        for _ in range(count):
+            try:
+                await throttle(press, None)
+            except ApplicationHandlerStop:
+                dropped += 1
+        return dropped
+
+    assert asyncio.run(presses(3)) == 2
+    assert query.answers == 2
+    press.callback_query = ExpiredQuery()
+    assert asyncio.run(presses(1)) == 1
+
+
+# === WEBHOOK ===
+class RecordingShards:
+    def __init__(self):
+        self.routed = []
+
+    def route(self, data):
+        self.routed.append(data)
+
+
+def test_webhook_refuses_updates_without_the_secret(monkeypatch):
+    shards = RecordingShards()
+    monkeypatch.setattr(webapp, 'sharded_bot', shards)
+    client = webapp.app.test_client()
+    update = {'update_id': 1}
+
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', 's3cret')
+    assert client.post(config.WEBHOOK_PATH, json=update).status_code == 403
+    assert client.post(config.WEBHOOK_PATH, json=update,
+                       headers={'X-Telegram-Bot-Api-Secret-Token': 'guess'}).status_code == 403
+    assert client.post(config.WEBHOOK_PATH, json=update,
+                       headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'}).status_code == 200
+    assert shards.routed == [update]
+
+    # An unset secret refuses everything rather than accepting everything
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', '')
+    assert client.post(config.WEBHOOK_PATH, json=update,
+                       headers={'X-Telegram-Bot-Api-Secret-Token': ''}).status_code == 403
+    monkeypatch.setattr(config, 'WEBHOOK_URL', 'https://bot.example')
+    with pytest.raises(RuntimeError):
+        webapp.start_bot()
+
+
+def test_webhook_answers_503_when_the_update_is_not_queued(monkeypatch):
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', 's3cret')
+    monkeypatch.setattr(config, 'WEBHOOK_QUEUE_TIMEOUT', 0.2)
+    monkeypatch.setattr(webapp, 'sharded_bot', None)
+    monkeypatch.setattr(webapp, 'bot_app', SimpleNamespace(bot=None, update_queue=asyncio.Queue()))
+    client = webapp.app.test_client()
+
+    def post():
+        return client.post(config.WEBHOOK_PATH, json={'update_id': 1},
+                           headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'}).status_code
+
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(webapp, 'bot_loop', loop)
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        assert post() == 200
+        assert webapp.bot_app.update_queue.qsize() == 1
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    # Stopped, then closed: the update is never put
+    assert post() == 503
+    loop.close()
+    assert post() == 503
+
+    class StuckQueue:
+        async def put(self, update):
+            await asyncio.sleep(10)
+    monkeypatch.setattr(webapp, 'bot_app', SimpleNamespace(bot=None, update_queue=StuckQueue()))
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(webapp, 'bot_loop', loop)
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        assert post() == 503
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+# === MENU PARSING ===
+MENU_ROWS = [
+    {'cafe': 'ሸዊት', 'name': 'ሽሮ', 'price': 30, 'aliases': ['shiro']},
+    {'cafe': 'ሸዊት', 'name': 'ሽሮ ፈሰስ', 'price': 40, 'aliases': []},
+    {'cafe': 'ሸዊት', 'name': 'Pasta', 'price': 50, 'aliases': ['ፓስታ']},
+]
+
+
+def test_alias_matcher_finds_leftmost_longest_word_starts():
+    shiro, fesese = MenuItem('ሽሮ', 30), MenuItem('ሽሮ ፈሰስ', 40)
+    matcher = AliasMatcher([('ሽሮ', shiro), ('ሽሮ ፈሰስ', fesese), ('Shiro', shiro)])
+    assert matcher.find('2 ሽሮ ፈሰስ እና 1 ሽሮ') == [(2, 8, fesese), (14, 16, shiro)]
+    # Case is ignored and a suffix is allowed, but not a prefix
+    assert matcher.find('SHIROs') == [(0, 5, shiro)]
+    assert matcher.find('አሽሮ') == []
+
+
+def test_menu_prices_only_orders_it_can_fully_match():
+    catalog = MenuCatalog()
+    catalog.build(MENU_ROWS)
+
+    assert catalog.parse('ሸዊት', '2 ሽሮ ፈሰስ, pasta x3 and shiro') == [
+        LineItem('ሽሮ ፈሰስ', 2, 40.0), LineItem('Pasta', 3, 50.0), LineItem('ሽሮ', 1, 30.0)]
+    assert catalog.price('ሸዊት', '2 ሽሮ 1 ፓስታ') == (True, 3, 110.0)
+
+    # ጥብስ is not on this menu: the whole order fails instead of charging for 2 ሽሮ
+    assert catalog.price('ሸዊት', '2 ሽሮ 1 ጥብስ') == (False, 0, 0.0)
+    assert catalog.unmatched('ሸዊት', '2 ሽሮ 1 ጥብስ') == ['1 ጥብስ']
+
+    # Phone numbers and decimals are not quantities
+    assert catalog.price('ሸዊት', '0911223344 ሽሮ') == (True, 1, 30.0)
+    assert catalog.parse('ሸዊት', '2.5 pasta') == [LineItem('Pasta', 1, 50.0)]
+
+    # Cafes without a menu keep the flat price
+    assert catalog.price('ሌላ', '2 ሽሮ 1 ጥብስ') == (True, 3, 3 * config.PRICE_PER_ITEM)
+
+
+def test_flat_price_counts_only_small_whole_quantities():
+    assert extract_numbers_from_text('1 አይነት እና 1አትክልት') == (True, 2, 2 * config.PRICE_PER_ITEM)
+    assert extract_numbers_from_text('99 ዳቦ') == (True, 99, 99 * config.PRICE_PER_ITEM)
+    assert extract_numbers_from_text('0911223344 ሽሮ')[0] is False
+    assert extract_numbers_from_text('2.5 pasta')[0] is False
+    assert extract_numbers_from_text('100 ዳቦ')[0] is False
+
+
+# === MULTI-WORKER ===
+class RegisteringDatabase(CountingDatabase):
+    async def add_user(self, telegram_id, name, initial_balance=0.0):
+        self.users[telegram_id] = initial_balance
+        return True, ""
+
+
+def test_a_user_added_on_one_worker_is_let_in_by_the_others():
+    """The other worker's cached "not registered" answer is dropped at once, not after UNAUTHORIZED_CACHE_TTL"""
+    backend = RegisteringDatabase()
+    queues = [queue.Queue(), queue.Queue()]
+    admin_shard, user_shard = CachedDatabase(backend), CachedDatabase(backend)
+    admin_shard.peers = ShardPeers(0, queues)
+
+    async def scenario():
+        assert await user_shard.is_user_authorized(5) is False
+        assert user_shard.is_known_unauthorized(5)
+        await admin_shard.add_user(5, "New", 20.0)
+        assert queues[0].empty()
+        await _control(queues[1].get_nowait(), 1, None, SimpleNamespace(db=user_shard))
+        assert not user_shard.is_known_unauthorized(5)
+        assert await user_shard.is_user_authorized(5) is True
+
+    asyncio.run(scenario())
+
+
+class BalanceWritingDatabase(CountingDatabase):
+    async def update_user_balance(self, user_id, amount):
+        self.users[user_id] = amount
+        return True
+
+
+def test_a_read_overlapping_a_balance_write_does_not_cache_the_old_value():
+    backend = BalanceWritingDatabase()
+    db = CachedDatabase(backend)
+
+    async def scenario():
+        backend.gate = asyncio.Event()
+        # The read fetches 10.0, then is held up until after the write
+        read = asyncio.create_task(db.get_user_balance(7))
+        await asyncio.sleep(0)
+        assert await db.update_user_balance(7, 50.0)
+        backend.gate.set()
+        assert await read == 10.0
+        backend.gate = None
+        assert await db.get_user_balance(7) == 50.0
+
+    asyncio.run(scenario())
+
+
+class TimingOutOrderDatabase(CountingDatabase):
+    async def place_order(self, order_data):
+        # Committed, but the reply was lost
+        self.users[order_data['user_telegram_id']] -= order_data['total_price']
+        return None
+
+
+def test_a_read_overlapping_a_timed_out_order_does_not_cache_the_old_balance():
+    backend = TimingOutOrderDatabase()
+    db = CachedDatabase(backend)
+
+    async def scenario():
+        backend.gate = asyncio.Event()
+        read = asyncio.create_task(db.get_user_balance(7))
+        await asyncio.sleep(0)
+        assert await db.place_order({'user_telegram_id': 7, 'total_price': 4.0}) is None
+        backend.gate.set()
+        assert await read == 10.0
+        backend.gate = None
+        assert await db.get_user_balance(7) == 6.0
+
+    asyncio.run(scenario())
+
+
+def test_orders_from_every_worker_share_one_digest_per_channel_and_slot(tmp_path, monkeypatch):
+    """Worker 1 hands its order to worker 0, which adds it to the digest it already opened"""
+    channel_bot = FakeChannelBot()
+    store = SQLiteStore(str(tmp_path / "outbox.sqlite3"))
+    queues = [queue.Queue(), queue.Queue()]
+    monkeypatch.setattr(bot.config, 'DIGEST_MODE', True)
+    monkeypatch.setattr(bot, 'channel_dispatcher',
+                        DigestDispatcher(channel_bot, store, channels={'female_tecno': -100}, window=0.05))
+    monkeypatch.setattr(bot, 'route_planner', RoutePlanner(DistanceMatrix()))
+
+    async def scenario():
+        await bot.channel_dispatcher.start()
+        # Worker 1 (another user's shard) confirms an order
+        monkeypatch.setattr(bot, 'channel_poster', ChannelPoster(queues))
+        await bot.post_order_to_channel({**digest_order(1), 'channel': 'female_tecno', 'gender': 'F'})
+        # Worker 0 confirms one of its own and then handles worker 1's
+        monkeypatch.setattr(bot, 'channel_poster', None)
+        await bot.post_order_to_channel({**digest_order(2), 'channel': 'female_tecno', 'gender': 'F'})
+        await _control(queues[0].get_nowait(), 0, None, bot)
+        await asyncio.sleep(0.2)
+        await bot.channel_dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert [call[0] for call in channel_bot.calls] == ['send']
+    assert '#1' in channel_bot.calls[0][1] and '#2' in channel_bot.calls[0][1]
+    [(_, route)] = bot.route_planner.plan('2024-05-01')
+    assert len(route) == 2
+    store.close()
+
+def test_metrics_add_up_the_workers_snapshots():
+    counter = metrics.Counter('test_total', "Test counter", ('reason',))
+    histogram = metrics.Histogram('test_seconds', "Test histogram", buckets=(0.1, 1.0))
+    counter.inc('user')
+    histogram.observe(0.05)
+    worker = {'test_total': {('user',): 2, ('global',): 1}, 'test_seconds': {(): [0, 1, 0, 0.5]}}
+
+    lines = counter.render([worker['test_total']]) + histogram.render([worker['test_seconds']])
+    assert 'test_total{reason="user"} 3' in lines and 'test_total{reason="global"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 2' in lines and 'test_seconds_count 2' in lines
+    assert lines.count("# TYPE test_total counter") == 1
+
+
+def test_nested_handlers_are_timed_once():
+    histogram = metrics.HANDLER_LATENCY
+
+    @metrics.timed_handler
+    async def inner(update, context):
+        return 1
+
+    @metrics.timed_handler
+    async def outer(update, context):
+        return await inner(update, context)
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=99))
+    assert asyncio.run(outer(update, None)) == 1
+    assert sum(histogram.series[('outer',)][:-1]) == 1
+    assert ('inner',) not in histogram.series
+
+
+def test_metrics_render_while_series_are_added():
+    """/metrics renders in the Flask thread while the event loop thread keeps adding label sets"""
+    histogram = metrics.Histogram('race_seconds', "Race test")
+    states = metrics.ConversationStates()
+    done = threading.Event()
+
+    def add():
+        for i in range(200000):
+            histogram.observe(0.01, str(i))
+            states.record(i, i % 5)
+        done.set()
+
+    writer = threading.Thread(target=add)
+    writer.start()
+    while not done.is_set():
+        histogram.render()
+        states.render()
+    writer.join()
+
+
+def test_abandoned_conversations_leave_the_gauge():
+    states = metrics.ConversationStates(max_age=60)
+    states.record(1, 3, now=0.0)
+    states.record(2, 3, now=10.0)
+    states.record(1, 4, now=30.0)
+    assert states.snapshot(now=75.0) == {'4': 1}
+    # User 2 was last seen at 10: dropped from the dict too once anything is recorded
+    states.record(3, 5, now=71.0)
+    assert states.by_user == {1: 4, 3: 5} and list(states.touched) == [1, 3]
+    states.record(1, -1, now=72.0)
+    states.record(3, 6, now=200.0)
+    assert states.by_user == {3: 6} and states.snapshot(now=200.0) == {'6': 1}
+
+
+# === BULK IMPORT ===
+def test_parse_user_csv_validates_imports_and_top_ups_alike():
+    rows, errors = parse_user_csv("telegram_id,name,balance\n1,Abebe,50\n2,,0\n1,Again,5\n3,Bad,-5\n4,NaN,nan\nx,y,z\n5,Short\n")
+    assert rows == [{'telegram_id': 1, 'name': 'Abebe', 'balance': 50.0},
+                    {'telegram_id': 2, 'name': 'User_2', 'balance': 0.0}]
+    assert [line for line, _ in errors] == [4, 5, 6, 7, 8]
+    assert errors[1] == (5, "balance can not be negative")
+
+    rows, errors = parse_user_csv("1,20\n2,-20\n3,inf\n", topup=True)
+    assert rows == [{'telegram_id': 1, 'amount': 20.0}]
+    assert errors == [(2, "amount can not be negative"), (3, "amount must be a number")]
+
+
+class BulkClient:
+    """Rejects any upsert_users call containing a bad row, like a failing statement would"""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def rpc(self, name, params):
+        rows = params['p_rows']
+        self.calls.append(len(rows))
+
+        async def execute():
+            if self.error:
+                raise self.error
+            if any(row['balance'] is None for row in rows):
+                raise ValueError("null value in column \"balance\"")
+            return SimpleNamespace(data=None)
+        return SimpleNamespace(execute=execute)
+
+
+def test_a_bad_row_fails_alone_instead_of_its_whole_chunk():
+    rows = [{'telegram_id': i, 'name': f"User_{i}", 'balance': None if i == 7 else 10.0} for i in range(10)]
+    client = BulkClient()
+    failures = asyncio.run(AsyncDatabase(client).bulk_upsert_users(rows, chunk_size=5))
+    assert [telegram_id for telegram_id, _ in failures] == [7]
+    # The rejected chunk of 5 was retried row by row; the other went through at once
+    assert client.calls == [5, 5, 1, 1, 1, 1, 1]
+
+    # When the database can't be reached, rows are not retried one by one
+    client = BulkClient(httpx.ConnectError("down"))
+    failures = asyncio.run(AsyncDatabase(client).bulk_upsert_users(rows, chunk_size=5))
+    assert len(failures) == 10 and client.calls == [5, 5]
+
+
+# === CHANNEL OUTBOX AND PERSISTENCE ===
+class FlakyStore(SQLiteStore):
+    """SQLiteStore whose next save() can be made to fail"""
+
+    fail = False
+
+    async def save(self, changes):
+        if self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError("disk I/O error")
+        await super().save(changes)
+
+
+def test_channel_outbox_survives_a_failed_save(tmp_path):
+    channel_bot = FakeChannelBot()
+    store = FlakyStore(str(tmp_path / "outbox.sqlite3"))
+    dispatcher = ChannelDispatcher(channel_bot, store, channels={'agri': -100, 'female_main': ''})
+
+    async def run():
+        await dispatcher.start()
+        assert not await dispatcher.post('female_main', "unconfigured")
+        assert await dispatcher.post('agri', "first")
+        store.fail = True
+        await dispatcher.queues['agri'].join()
+        # The worker outlived the failed save and keeps delivering
+        assert await dispatcher.post('agri', "second")
+        await dispatcher.queues['agri'].join()
+        await dispatcher.stop()
+        return await store.load(OUTBOX + 'agri')
+
+    outbox = asyncio.run(run())
+    assert channel_bot.calls == [('send', "first"), ('send', "second")]
+    # Only the post whose removal failed is left, to be re-sent after a restart
+    assert [value['text'] for value in outbox.values()] == ["first"]
+    store.close()
+
+
+def test_orders_are_posted_when_the_outbox_cannot_be_written(tmp_path, monkeypatch):
+    """The user has paid by the time the post is queued, so a failed save must not stop it"""
+    for digest_mode in (False, True):
+        channel_bot = FakeChannelBot()
+        store = FlakyStore(str(tmp_path / f"outbox{digest_mode}.sqlite3"))
+        dispatcher_class = DigestDispatcher if digest_mode else ChannelDispatcher
+        monkeypatch.setattr(bot.config, 'DIGEST_MODE', digest_mode)
+        monkeypatch.setattr(bot, 'channel_dispatcher', dispatcher_class(channel_bot, store, channels={'male_tecno': -100}))
+        if digest_mode:
+            bot.channel_dispatcher.window = 0
+
+        async def run():
+            await bot.channel_dispatcher.start()
+            store.fail = True
+            await bot.post_order_to_channel({**digest_order(7), 'channel': 'male_tecno', 'gender': 'M'})
+            await asyncio.sleep(0.1)
+            await bot.channel_dispatcher.stop()
+
+        asyncio.run(run())
+        assert len(channel_bot.calls) == 1 and '7' in channel_bot.calls[0][-1]
+        store.close()
+
+def test_persistence_batches_writes_and_keeps_them_when_a_save_fails(tmp_path):
+    store = FlakyStore(str(tmp_path / "state.sqlite3"))
+    persistence = BotPersistence(store)
+
+    async def run():
+        store.fail = True
+        await persistence.update_user_data(1, {'order': {'cafe': 'ሸዊት'}})
+        await persistence.update_conversation('ordering', (1, 1), 3)
+        await asyncio.sleep(0.05)
+        assert await store.load(USER_DATA) == {}
+        await persistence.update_user_data(2, {'order': {'cafe': 'ፍቄ'}})
+        await persistence.flush()
+
+    asyncio.run(run())
+    restored = BotPersistence(SQLiteStore(str(tmp_path / "state.sqlite3")))
+
+    async def load():
+        return await restored.get_user_data(), await restored.get_conversations('ordering')
+
+    user_data, conversations = asyncio.run(load())
+    assert user_data == {1: {'order': {'cafe': 'ሸዊት'}}, 2: {'order': {'cafe': 'ፍቄ'}}}
+    assert conversations == {(1, 1): 3}
+    restored.store.close()
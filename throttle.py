@@ -0,0 +1,92 @@
+import logging
+import time
+from typing import Callable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+import config
+from metrics import THROTTLED_UPDATES
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token buckets of rate tokens per second holding up to burst, one float per key.
+
+    Each key stores only the time its bucket will be full again (the GCRA form
+    of a token bucket); a key whose bucket is full is the same as a missing
+    one, so those are dropped whenever the table grows past max_keys. A rate
+    of 0 lets everything through.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: Optional[int] = None):
+        self.rate = rate
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.window = burst * self.interval
+        self.max_keys = max_keys or config.CACHE_MAX_SIZE
+        self._full_at: Dict[Hashable, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._full_at)
+
+    def allow(self, key: Hashable = None, now: Optional[float] = None) -> bool:
+        """Take a token for key if its bucket has one"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        full_at = max(self._full_at.get(key, now), now) + self.interval
+        if full_at - now > self.window:
+            return False
+        if key not in self._full_at and len(self._full_at) >= self.max_keys:
+            self._prune(now)
+        self._full_at[key] = full_at
+        return True
+
+    def _prune(self, now: float):
+        self._full_at = {key: full_at for key, full_at in self._full_at.items() if full_at > now}
+
+
+class Throttle:
+    """Drops updates over the per-user or global rate before any handler (or query) sees them.
+
+    Registered in handler group -1, ahead of everything setup_handlers adds.
+    Users the cache already knows are not authorized get a much smaller
+    bucket, so spamming /start from an unregistered account costs one
+    database lookup per UNAUTHORIZED_CACHE_TTL instead of one per message.
+    Admins are never throttled.
+    """
+
+    def __init__(self, is_unauthorized: Callable[[int], bool]):
+        self.is_unauthorized = is_unauthorized
+        self.users = RateLimiter(config.THROTTLE_USER_RATE, config.THROTTLE_USER_BURST)
+        self.unauthorized = RateLimiter(config.THROTTLE_UNAUTHORIZED_RATE, config.THROTTLE_UNAUTHORIZED_BURST)
+        self.everyone = RateLimiter(config.THROTTLE_GLOBAL_RATE, config.THROTTLE_GLOBAL_BURST)
+
+    def check(self, update: Update) -> Optional[str]:
+        """Return why the update should be dropped, or None to let it through"""
+        user = update.effective_user
+        if user is not None:
+            if user.id in config.ADMIN_IDS:
+                return None
+            if self.is_unauthorized(user.id):
+                if not self.unauthorized.allow(user.id):
+                    return 'unauthorized'
+            elif not self.users.allow(user.id):
+                return 'user'
+        if not self.everyone.allow():
+            return 'global'
+        return None
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        reason = self.check(update)
+        if reason is not None:
+            THROTTLED_UPDATES.inc(reason)
+            logger.debug("Dropped update", extra={'reason': reason, 'user_id': getattr(update.effective_user, 'id', None)})
+            if update.callback_query is not None:
+                # Otherwise the button keeps spinning until Telegram gives up on it
+                try:
+                    await update.callback_query.answer()
+                except Exception as e:
+                    logger.debug("Could not answer dropped callback query", extra={'error': str(e)})
+            raise ApplicationHandlerStop
@@ -1,17 +1,26 @@
+import csv
+import io
+import math
 import re
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+import config
+
+# A quantity is 1-99 written on its own: digits inside a decimal ("2.5") or a
+# longer run such as a phone number are not quantities. Digits may touch
+# Amharic letters ("1አትክልት"), so \b can't be used here
+MAX_QUANTITY = 99
+QUANTITY = re.compile(r'(?<![\d.,])([1-9]\d?)(?!\d|[.,]\d)')
 
 def extract_numbers_from_text(text: str) -> Tuple[bool, int, float]:
     """
     Extract numbers from food description and calculate total
     Returns: (success, total_items, total_price)
     """
-    numbers = re.findall(r'\b[1-9]\b', text)
-    if not numbers:
+    total_items = sum(int(num) for num in QUANTITY.findall(text))
+    if not total_items:
         return False, 0, 0.0
     
-    total_items = sum(int(num) for num in numbers)
-    total_price = total_items * 6.65  # Price per item
+    total_price = total_items * config.PRICE_PER_ITEM
     return True, total_items, total_price
 
 def validate_place_input(place: str) -> bool:
@@ -49,5 +58,140 @@ def format_order_preview(order_data: dict) -> str:
 ⏰Time: {order_data['time']}
 🍜Food: {order_data['food']}
 🏢Place: {order_data['place']}
-💰Total: {order_data['total_price']:.2f} ETB
-📦Order #: {order_data['order_number']}"""
\ No newline at end of file
+💰Total: {order_data['total_price']:.2f} ETB"""
+
+def _parse_amount(value: str, name: str) -> float:
+    """Parse a balance or top-up amount: a finite number that is not negative"""
+    amount = float(value)
+    if not math.isfinite(amount):
+        raise ValueError(f"{name} must be a number")
+    if amount < 0:
+        raise ValueError(f"{name} can not be negative")
+    return amount
+
+def parse_user_csv(text: str, topup: bool = False) -> Tuple[List[Dict], List[Tuple[int, str]]]:
+    """
+    Parse an admin CSV upload
+    Import rows: telegram_id,name,balance (name may be empty)
+    Top-up rows: telegram_id,amount
+    Returns: (valid_rows, [(line_number, error), ...])
+    """
+    rows = []
+    errors = []
+    seen = set()
+    for line_number, fields in enumerate(csv.reader(io.StringIO(text)), start=1):
+        fields = [field.strip() for field in fields]
+        if not any(fields):
+            continue
+        # Skip a header row
+        if line_number == 1 and not fields[0].lstrip('-').isdigit():
+            continue
+        
+        try:
+            telegram_id = int(fields[0])
+            if topup:
+                if len(fields) < 2:
+                    raise ValueError("expected telegram_id,amount")
+                row = {'telegram_id': telegram_id, 'amount': _parse_amount(fields[1], "amount")}
+            else:
+                if len(fields) < 3:
+                    raise ValueError("expected telegram_id,name,balance")
+                balance = _parse_amount(fields[2], "balance")
+                row = {'telegram_id': telegram_id, 'name': fields[1] or f"User_{telegram_id}", 'balance': balance}
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+            continue
+        
+        if telegram_id in seen:
+            errors.append((line_number, f"duplicate telegram_id {telegram_id}"))
+            continue
+        seen.add(telegram_id)
+        rows.append(row)
+    
+    return rows, errors
+
+def encode_history_cursor(order: dict) -> str:
+    """Callback data for the page of orders older than this one"""
+    return f"history:{order['created_at']}|{order['order_number']}"
+
+def decode_history_cursor(data: str) -> Optional[Tuple[str, int]]:
+    """Inverse of encode_history_cursor - returns (created_at, order_number) or None"""
+    try:
+        created_at, order_number = data[len("history:"):].rsplit('|', 1)
+        return created_at, int(order_number)
+    except ValueError:
+        return None
+
+def format_order_history(orders: List[Dict]) -> str:
+    """Format a page of /history"""
+    if not orders:
+        return "📭ምንም ትዕዛዝ የሎትም።"
+    lines = ["🧾የትዕዛዝ ታሪክ"]
+    for order in orders:
+        lines.append(
+            f"\n#{order['order_number']} • {str(order['created_at'])[:16].replace('T', ' ')}\n"
+            f"👩‍🍳{order['cafe']} • {order['food']}\n"
+            f"💰{float(order['total_price']):.2f} ETB ({order['total_items']} እቃዎች)"
+        )
+    return "\n".join(lines)
+
+def format_order_report(rows: List[Dict], group_by: str, days: int) -> str:
+    """Format the /report totals"""
+    lines = [f"📊Orders by {group_by}, last {days} days"]
+    for row in rows:
+        lines.append(f"{row['key']}: {row['orders']} orders, {row['items']} items, {float(row['revenue']):.2f} ETB")
+    total_orders = sum(row['orders'] for row in rows)
+    total_revenue = sum(float(row['revenue']) for row in rows)
+    lines.append(f"Total: {total_orders} orders, {total_revenue:.2f} ETB")
+    return "\n".join(lines)
+
+def summarize_rollup(rows: List[Dict], keys: Tuple[str, ...]) -> List[Dict]:
+    """Add up order_rollup rows over the given key columns, e.g. ('channel', 'meal_slot')"""
+    totals: Dict[tuple, Dict] = {}
+    for row in rows:
+        group = tuple(row[key] for key in keys)
+        total = totals.get(group)
+        if total is None:
+            total = totals[group] = dict(zip(keys, group), orders=0, items=0, revenue=0.0)
+        total['orders'] += row['orders']
+        total['items'] += row['items']
+        total['revenue'] += float(row['revenue'])
+    return [totals[group] for group in sorted(totals)]
+
+def format_rollup_stats(rows: List[Dict], start_day: str, end_day: str) -> str:
+    """Format the /stats dispatch summary"""
+    period = start_day if start_day == end_day else f"{start_day} – {end_day}"
+    lines = [f"📊{period}"]
+    
+    lines.append("\n🚚By channel and meal:")
+    for total in summarize_rollup(rows, ('channel', 'meal_slot')):
+        lines.append(f"{total['channel']} / {total['meal_slot']}: {total['orders']} orders, {total['items']} items")
+    
+    lines.append("\n👩‍🍳By cafe:")
+    for total in summarize_rollup(rows, ('cafe',)):
+        lines.append(f"{total['cafe']}: {total['orders']} orders, {total['items']} items, {total['revenue']:.2f} ETB")
+    
+    overall = summarize_rollup(rows, ())
+    if overall:
+        lines.append(f"\nTotal: {overall[0]['orders']} orders, {overall[0]['items']} items, {overall[0]['revenue']:.2f} ETB")
+    return "\n".join(lines)
+
+# Same mapping as meal_slot() in migrations/007_order_rollup.sql
+LUNCH = re.compile(r'ምሳ|lunch', re.IGNORECASE)
+DINNER = re.compile(r'ራት|dinner', re.IGNORECASE)
+BLOCK = re.compile(r'\b(?:block|blk|ብሎክ|b)\s*[-#.:]?\s*(\d+)', re.IGNORECASE)
+
+def meal_slot(time_text: str) -> str:
+    """Map the free-text lunch/dinner answer to 'lunch', 'dinner' or 'other'"""
+    if LUNCH.search(time_text):
+        return 'lunch'
+    if DINNER.search(time_text):
+        return 'dinner'
+    return 'other'
+
+def parse_block(place: str) -> str:
+    """Block number from a place like "Main block 12" or "Tecno B-4", else the first number, else '?'"""
+    match = BLOCK.search(place) or re.search(r'\d+', place)
+    if not match:
+        return '?'
+    return match.group(1) if match.re is BLOCK else match.group(0)